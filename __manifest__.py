@@ -9,7 +9,7 @@
 
 {
     'name': 'Izipay Payment Provider',
-    'version': '4.2.1',
+    'version': '4.3.0',
     'summary': 'Accept payments with Izipay secure payment gateway.',
     'category': 'Accounting/Payment Providers',
     'author': 'Lyra Network',
@@ -21,7 +21,9 @@
         'views/payment_micuentaweb_templates.xml',
         'data/payment_method_data.xml',
         'data/payment_provider_data.xml',
+        'data/ir_cron_data.xml',
         'security/ir.model.access.csv',
+        'views/micuentaweb_backoffice_views.xml',
     ],
     'assets': {
         'web.assets_frontend': [
@@ -0,0 +1,13 @@
+# coding: utf-8
+#
+# Copyright © Lyra Network.
+# This file is part of Izipay plugin for Odoo. See COPYING.md for license details.
+#
+# Author:    Lyra Network (https://www.lyra.com)
+# Copyright: Copyright © Lyra Network
+# License:   http://www.gnu.org/licenses/agpl.html GNU Affero General Public License (AGPL v3)
+
+from . import replay
+from . import export
+from . import settlement
+from . import ipn_receiver
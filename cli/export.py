@@ -0,0 +1,48 @@
+# coding: utf-8
+#
+# Copyright © Lyra Network.
+# This file is part of Izipay plugin for Odoo. See COPYING.md for license details.
+#
+# Author:    Lyra Network (https://www.lyra.com)
+# Copyright: Copyright © Lyra Network
+# License:   http://www.gnu.org/licenses/agpl.html GNU Affero General Public License (AGPL v3)
+
+import argparse
+from datetime import date, timedelta
+import sys
+
+from odoo.cli import Command
+from odoo.modules.registry import Registry
+from odoo.tools import config
+
+from ..helpers import export
+
+class MicuentawebExport(Command):
+    """ Export Izipay transactions as CSV or JSON lines for accounting. """
+
+    name = 'micuentaweb_export'
+
+    def run(self, cmdargs):
+        parser = argparse.ArgumentParser(prog='odoo-bin micuentaweb_export', description=self.__doc__.strip())
+        parser.add_argument('--date-from', required=True, type=date.fromisoformat, help='First creation date of exported transactions (YYYY-MM-DD).')
+        parser.add_argument('--date-to', required=True, type=date.fromisoformat, help='Last creation date of exported transactions (YYYY-MM-DD).')
+        parser.add_argument('--format', dest='export_format', choices=export.EXPORT_FORMATS, default='csv', help='Output format.')
+        parser.add_argument('--company', type=int, action='append', help='Only export transactions of this company ID, can be repeated.')
+        parser.add_argument('--output', help='Output file, standard output if not set.')
+        args, odoo_args = parser.parse_known_args(cmdargs)
+
+        config.parse_config(odoo_args)
+        if not config['db_name']:
+            sys.exit('A database must be given with -d.')
+
+        registry = Registry(config['db_name'])
+        chunks = export.iter_export(registry, args.date_from, args.date_to + timedelta(days=1), args.export_format,
+            company_ids=args.company)
+
+        output = open(args.output, 'wb') if args.output else sys.stdout.buffer
+        try:
+            for chunk in chunks:
+                output.write(chunk)
+        finally:
+            if args.output:
+                output.close()
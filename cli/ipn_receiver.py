@@ -0,0 +1,41 @@
+# coding: utf-8
+#
+# Copyright © Lyra Network.
+# This file is part of Izipay plugin for Odoo. See COPYING.md for license details.
+#
+# Author:    Lyra Network (https://www.lyra.com)
+# Copyright: Copyright © Lyra Network
+# License:   http://www.gnu.org/licenses/agpl.html GNU Affero General Public License (AGPL v3)
+
+import argparse
+import functools
+import sys
+
+from werkzeug.serving import run_simple
+
+from odoo.cli import Command
+from odoo.tools import config
+
+from ..helpers import ipn_receiver
+
+class MicuentawebIpnReceiver(Command):
+    """ Receive Izipay IPNs without Odoo workers: verify them and queue them for the Odoo drain cron. """
+
+    name = 'micuentaweb_ipn_receiver'
+
+    def run(self, cmdargs):
+        parser = argparse.ArgumentParser(prog='odoo-bin micuentaweb_ipn_receiver', description=self.__doc__.strip())
+        parser.add_argument('--queue', required=True, help='SQLite queue file, set as payment_micuentaweb.ipn_queue_path in Odoo.')
+        parser.add_argument('--host', default='0.0.0.0', help='Interface to listen on.')
+        parser.add_argument('--port', type=int, default=8079, help='Port to listen on.')
+        args, odoo_args = parser.parse_known_args(cmdargs)
+
+        config.parse_config(odoo_args)
+        if not config['db_name']:
+            sys.exit('A database must be given with -d.')
+
+        key_cache = ipn_receiver.KeyCache(functools.partial(ipn_receiver.load_keys, config['db_name']))
+        key_cache.get()
+
+        application = ipn_receiver.make_app(args.queue, key_cache)
+        run_simple(args.host, args.port, application, threaded=True)
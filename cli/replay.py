@@ -0,0 +1,62 @@
+# coding: utf-8
+#
+# Copyright © Lyra Network.
+# This file is part of Izipay plugin for Odoo. See COPYING.md for license details.
+#
+# Author:    Lyra Network (https://www.lyra.com)
+# Copyright: Copyright © Lyra Network
+# License:   http://www.gnu.org/licenses/agpl.html GNU Affero General Public License (AGPL v3)
+
+import argparse
+import sys
+
+from odoo.cli import Command
+from odoo.modules.registry import Registry
+from odoo.tools import config
+
+from ..helpers import replay
+
+class MicuentawebReplay(Command):
+    """ Replay stored Izipay notifications through the IPN pipeline. """
+
+    name = 'micuentaweb_replay'
+
+    def run(self, cmdargs):
+        parser = argparse.ArgumentParser(prog='odoo-bin micuentaweb_replay', description=self.__doc__.strip())
+        parser.add_argument('--file', help='JSON lines file of notifications with their signature, stored notifications are read from database if not set.')
+        parser.add_argument('--date-from', help='Only replay notifications received from this date (database source).')
+        parser.add_argument('--date-to', help='Only replay notifications received until this date (database source).')
+        parser.add_argument('--status', action='append', help='Only replay notifications with this transaction status, can be repeated.')
+        parser.add_argument('--reference', action='append', help='Only replay notifications for this transaction reference, can be repeated.')
+        parser.add_argument('--workers', type=int, default=4, help='Number of notifications processed in parallel.')
+        parser.add_argument('--dry-run', action='store_true', help='Parse and verify notifications without updating transactions.')
+        args, odoo_args = parser.parse_known_args(cmdargs)
+
+        if args.file and (args.date_from or args.date_to):
+            parser.error('--date-from and --date-to only apply to notifications read from database.')
+
+        config.parse_config(odoo_args)
+        if not config['db_name']:
+            sys.exit('A database must be given with -d.')
+
+        registry = Registry(config['db_name'])
+
+        if args.file:
+            payloads = replay.iter_file(args.file, references=args.reference, statuses=args.status)
+        else:
+            domain = []
+            if args.date_from:
+                domain.append(('received_date', '>=', args.date_from))
+            if args.date_to:
+                domain.append(('received_date', '<=', args.date_to))
+            if args.status:
+                domain.append(('status', 'in', args.status))
+            if args.reference:
+                domain.append(('reference', 'in', args.reference))
+
+            payloads = replay.iter_table(registry, domain)
+
+        # Only the stored notifications whose signature was verified when received are read from database, their
+        # redacted payload cannot be checked again. Notifications of a file are checked as when received.
+        stats = replay.replay(registry, payloads, workers=args.workers, dry_run=args.dry_run, verified=not args.file)
+        print(dict(stats))
@@ -0,0 +1,74 @@
+# coding: utf-8
+#
+# Copyright © Lyra Network.
+# This file is part of Izipay plugin for Odoo. See COPYING.md for license details.
+#
+# Author:    Lyra Network (https://www.lyra.com)
+# Copyright: Copyright © Lyra Network
+# License:   http://www.gnu.org/licenses/agpl.html GNU Affero General Public License (AGPL v3)
+
+import argparse
+import os
+import sys
+
+from odoo import api, SUPERUSER_ID
+from odoo.cli import Command
+from odoo.modules.registry import Registry
+from odoo.tools import config
+
+from ..helpers import settlement
+
+class MicuentawebSettlement(Command):
+    """ Import an Izipay settlement report, or generate a synthetic one. """
+
+    name = 'micuentaweb_settlement'
+
+    def run(self, cmdargs):
+        parser = argparse.ArgumentParser(prog='odoo-bin micuentaweb_settlement', description=self.__doc__.strip())
+        parser.add_argument('--file', required=True, help='Report file (CSV) to import, or to write with --generate.')
+        parser.add_argument('--generate', type=int, metavar='LINES', help='Write a synthetic report of this number of lines instead of importing.')
+        parser.add_argument('--error-rate', type=float, default=0.02, help='Share of generated lines with a mismatch, and of unknown transactions.')
+        parser.add_argument('--seed', type=int, help='Random seed of the generated report.')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Number of lines matched and written at once.')
+        args, odoo_args = parser.parse_known_args(cmdargs)
+
+        config.parse_config(odoo_args)
+
+        if args.generate is not None and not config['db_name']:
+            # Offline generation, lines reference random transactions.
+            with open(args.file, 'w', encoding='utf-8', newline='') as f:
+                settlement.generate_report(f, args.generate, error_rate=args.error_rate, seed=args.seed)
+            return
+
+        if not config['db_name']:
+            sys.exit('A database must be given with -d.')
+
+        registry = Registry(config['db_name'])
+        with registry.cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+
+            if args.generate is not None:
+                # Draw lines from existing transactions so that most of them match.
+                cr.execute("""
+                    SELECT tx.reference, tx.provider_reference, tx.amount, cur.name, COALESCE(tx.micuentaweb_trans_status, 'AUTHORISED')
+                      FROM payment_transaction tx
+                      JOIN payment_provider pp ON pp.id = tx.provider_id
+                      JOIN res_currency cur ON cur.id = tx.currency_id
+                     WHERE pp.code IN ('micuentaweb', 'micuentawebmulti') AND tx.state IN ('done', 'cancel')
+                     LIMIT %s
+                """, [args.generate])
+                references = [(row[0], row[1], float(row[2]), row[3], row[4]) for row in cr.fetchall()]
+
+                with open(args.file, 'w', encoding='utf-8', newline='') as f:
+                    settlement.generate_report(f, args.generate, references=references, error_rate=args.error_rate, seed=args.seed)
+                return
+
+            report = env['micuentaweb.settlement.import'].create({'name': os.path.basename(args.file)})
+            cr.commit()
+
+            with open(args.file, encoding='utf-8-sig', newline='') as f:
+                report._micuentaweb_import(f, chunk_size=args.chunk_size, commit=True)
+
+            cr.commit()
+            print('{}: {} lines, {} matched, {} mismatches, {} unknown transactions.'.format(report.name, report.line_count,
+                report.matched_count, report.mismatch_count, report.missing_count))
@@ -9,3 +9,4 @@
 
 from . import main
 from . import rest
+from . import post_processing
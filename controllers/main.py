@@ -7,19 +7,27 @@
 # Copyright: Copyright © Lyra Network
 # License:   http://www.gnu.org/licenses/agpl.html GNU Affero General Public License (AGPL v3)
 
+from datetime import timedelta
 import logging
-import pprint
+import re
+import requests
 
-from odoo import http
+from odoo import fields, http
 from odoo.http import request
 from odoo.exceptions import ValidationError
-from ..helpers import tools
+from ..helpers import constants, export, log, profiling, tools
 
 _logger = logging.getLogger(__name__)
 
+# Theme files of the embedded payment fields, downloaded once per worker.
+_embedded_assets_cache = {}
+
 class MicuentawebController(http.Controller):
     _notify_url = '/payment/micuentaweb/ipn'
     _return_url = '/payment/micuentaweb/return'
+    _assets_url = '/payment/micuentaweb/assets/'
+    _export_url = '/payment/micuentaweb/export'
+    _stats_url = '/payment/micuentaweb/stats'
 
     def _get_return_url(self, result, **pdt_data):
         return_url = pdt_data.pop('return_url', '')
@@ -33,9 +41,11 @@ class MicuentawebController(http.Controller):
         _return_url, type='http', auth='public', methods=['POST', 'GET'], csrf=False,
         save_session=False
     )
+    @profiling.sampled('return')
+    @profiling.query_budget('return')
     def micuentaweb_return_from_checkout(self, **pdt_data):
         # Check payment result and create transaction.
-        _logger.info('Izipay: entering _from_notification with data %s', pprint.pformat(pdt_data))
+        logger = log.get_logger(_logger, pdt_data)
 
         try:
             is_rest = False
@@ -47,6 +57,11 @@ class MicuentawebController(http.Controller):
                 data['is_rest'] = '1'
                 is_rest = True
 
+                logger = log.get_logger(_logger, data)
+
+            logger.info('Izipay: entering _from_notification, transaction status: %s.', data.get('vads_trans_status'))
+            logger.debug('Izipay: return data %s', log.LazyDump(pdt_data))
+
             tx_sudo = request.env['payment.transaction'].sudo()._get_tx_from_notification_data('micuentaweb', data)
 
             # Verify hash.
@@ -54,56 +69,99 @@ class MicuentawebController(http.Controller):
                 hmac256_key = tx_sudo.provider_id._micuentaweb_get_rest_sha256_key()
                 hash_checked = tools.check_hash(pdt_data, hmac256_key)
                 if not hash_checked:
-                    error_msg = 'Izipay: invalid signature for data {}'.format(pdt_data)
-                    _logger.info(error_msg)
+                    error_msg = 'Izipay: invalid signature for transaction {}'.format(tx_sudo.reference)
+                    logger.info(error_msg)
 
                     raise ValidationError(error_msg)
 
             # Handle the notification data.
             tx_sudo._handle_notification_data('micuentaweb', data)
         except ValidationError:
-            _logger.exception("Izipay: Unable to handle the return notification data; skipping to acknowledge.")
+            logger.exception("Izipay: Unable to handle the return notification data; skipping to acknowledge.")
 
         return request.redirect('/payment/status')
 
     @http.route(_notify_url, type='http', auth='public', methods=['POST'], csrf=False,
         save_session=False
     )
+    @profiling.sampled('ipn')
+    @profiling.query_budget('ipn')
     def micuentaweb_ipn(self, **post):
         # Check payment result and create transaction.
-        _logger.info('Izipay: entering IPN _get_tx_from_notification with post data %s', pprint.pformat(post))
-
-        try:
-            is_rest = False
-            data = post
-
-            # Check the type of integration.
-            if tools.check_rest_response(post):
-                if not tools.order_cycle_closed(post):
-                    return 'Payment failure.'
-
-                data = tools.convert_rest_result(post)
-                data['is_rest'] = '1'
-                is_rest = True
+        result = request.env['payment.transaction'].sudo()._micuentaweb_handle_ipn(post)
 
-            result = request.env['payment.transaction'].sudo()._get_tx_from_notification_data('micuentaweb', data)
+        # Keep the raw notification to be able to replay it.
+        request.env['micuentaweb.notification'].sudo()._micuentaweb_store('ipn', post, result)
 
-            if is_rest:
-                rest_password = result.provider_id._micuentaweb_get_rest_password()
-                hash_checked = tools.check_hash(post, rest_password)
-                if not hash_checked:
-                    error_msg = 'Izipay: invalid signature for data {}'.format(post)
-                    _logger.info(error_msg)
-
-                    raise ValidationError(error_msg)
+        return result['message']
 
-            if (data.get('vads_trans_status') == 'ABANDONED') or (data.get('vads_trans_status') == 'CANCELED') and (data.get('vads_order_status') == 'UNPAID') and (data.get('vads_order_cycle') == 'CLOSED'):
-                return 'Payment abandoned.'
+    @http.route(_assets_url + '<string:filename>', type='http', auth='public', methods=['GET'], csrf=False,
+        save_session=False
+    )
+    def micuentaweb_embedded_asset(self, filename):
+        # Only theme files of the embedded payment fields can be served.
+        if not re.fullmatch(r'(neon|classic)(-reset\.css|\.js)', filename):
+            return request.not_found()
+
+        content = _embedded_assets_cache.get(filename)
+        if content is None:
+            try:
+                response = requests.get(constants.MICUENTAWEB_PARAMS.get('STATIC_URL') + "js/krypton-client/V4.0/ext/" + filename, timeout=10)
+                response.raise_for_status()
+            except requests.exceptions.RequestException as exc:
+                _logger.error("Izipay: unable to download embedded payment fields asset {}: {}".format(filename, exc))
+                return request.not_found()
+
+            content = response.content
+            _embedded_assets_cache[filename] = content
+
+        content_type = 'text/css' if filename.endswith('.css') else 'application/javascript'
+        return request.make_response(content, headers=[
+            ('Content-Type', content_type + '; charset=utf-8'),
+            ('Cache-Control', 'public, max-age=86400'),
+        ])
+
+    @http.route(_export_url, type='http', auth='user', methods=['GET'])
+    def micuentaweb_export(self, date_from, date_to, export_format='csv', **kwargs):
+        # Stream Izipay transactions created between date_from and date_to (inclusive) for accounting.
+        if not request.env.user.has_group('base.group_system'):
+            return request.not_found()
+
+        if export_format not in export.EXPORT_FORMATS:
+            return request.make_response('Unsupported format.', status=400)
 
-            # Handle the notification data.
-            result._handle_notification_data('micuentaweb', data)
-        except ValidationError: # Acknowledge the notification to avoid getting spammed.
-            _logger.exception("Izipay: Unable to handle the IPN notification data; skipping to acknowledge.")
-            return 'Bad request received.'
+        try:
+            start = fields.Date.to_date(date_from)
+            end = fields.Date.to_date(date_to) + timedelta(days=1)
+        except ValueError:
+            return request.make_response('Invalid date.', status=400)
+
+        # The generator runs after the request cursor is closed, it reads on its own connection.
+        chunks = export.iter_export(request.env.registry, start, end, export_format, company_ids=request.env.companies.ids)
+
+        filename = 'izipay-transactions-{}-{}.{}'.format(start, end - timedelta(days=1), export_format)
+        content_type = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+        response = request.make_response(chunks, headers=[
+            ('Content-Type', content_type + '; charset=utf-8'),
+            ('Content-Disposition', 'attachment; filename="{}"'.format(filename)),
+            ('Cache-Control', 'no-store'),
+        ])
+        response.direct_passthrough = True
+
+        return response
+
+    @http.route(_stats_url, type='http', auth='user', methods=['GET'])
+    def micuentaweb_stats(self, date_from, date_to, provider_id=None, **kwargs):
+        # Payment analytics read from the daily aggregates.
+        if not request.env.user.has_group('base.group_system'):
+            return request.not_found()
 
-        return 'Payment processed, order has been updated.' if result else 'An error occurred while processing payment.'
\ No newline at end of file
+        try:
+            start = fields.Date.to_date(date_from)
+            end = fields.Date.to_date(date_to)
+            provider_ids = [int(provider_id)] if provider_id else None
+        except ValueError:
+            return request.make_response('Invalid parameter.', status=400)
+
+        summary = request.env['micuentaweb.stats.daily']._micuentaweb_get_summary(start, end, provider_ids=provider_ids)
+        return request.make_json_response(summary)
@@ -0,0 +1,34 @@
+# coding: utf-8
+#
+# Copyright © Lyra Network.
+# This file is part of Izipay plugin for Odoo. See COPYING.md for license details.
+#
+# Author:    Lyra Network (https://www.lyra.com)
+# Copyright: Copyright © Lyra Network
+# License:   http://www.gnu.org/licenses/agpl.html GNU Affero General Public License (AGPL v3)
+
+import logging
+
+from odoo import http
+from odoo.http import request
+from odoo.addons.payment.controllers.post_processing import PaymentPostProcessing
+
+_logger = logging.getLogger(__name__)
+
+class MicuentawebPostProcessing(PaymentPostProcessing):
+
+    @http.route()
+    def poll_status(self, **kwargs):
+        """ Override of payment to ask the gateway for the status of a transaction whose IPN is late. """
+        tx_id = request.session.get(self.MONITORED_TX_ID_KEY)
+        if tx_id:
+            tx = request.env['payment.transaction'].sudo().browse(tx_id).exists()
+            if tx.provider_code in ('micuentaweb', 'micuentawebmulti'):
+                # Polling must go on with the current state whatever happens with the gateway.
+                try:
+                    with request.env.cr.savepoint():
+                        tx._micuentaweb_pull_status()
+                except Exception:
+                    _logger.exception('Izipay: unable to pull the status of transaction %s from gateway.', tx.reference)
+
+        return super().poll_status(**kwargs)
@@ -8,19 +8,66 @@
 # License:   http://www.gnu.org/licenses/agpl.html GNU Affero General Public License (AGPL v3)
 
 import logging
-import base64
-import requests
 import json
+import time
 
 from odoo.tools import float_round
 from odoo import http
 from odoo.http import request
 
-from ..helpers import tools, constants
+from ..helpers import tools, constants, log, metrics, profiling
 _logger = logging.getLogger(__name__)
 
 class MicuentawebRestController(http.Controller):
+    _form_token_session_key = 'micuentaweb_form_token'
+
+    @http.route("/payment/micuentaweb/prewarmFormToken", type="http", auth='public', methods=['POST'], csrf=False)
+    def micuentaweb_prewarm_form_token(self, **post):
+        # Called in background from the address and confirmation steps of the checkout.
+        sale_order_id = request.session.get('sale_order_id')
+        if not sale_order_id:
+            return json.dumps({ "prewarmed": False })
+
+        sale_order = request.env['sale.order'].sudo().browse(sale_order_id).exists()
+        if not sale_order or sale_order.state != 'draft' or not sale_order.order_line:
+            return json.dumps({ "prewarmed": False })
+
+        # Same provider as the one the payment step will display for this website.
+        website = getattr(request, 'website', None)
+        Provider = request.env['payment.provider'].sudo()
+        payment_provider = Provider.browse(Provider._micuentaweb_get_embedded_provider_id(sale_order.company_id.id, website.id if website else False))
+        if not payment_provider or payment_provider.micuentaweb_embedded_prewarm != '1':
+            return json.dumps({ "enabled": False })
+
+        currency = payment_provider._micuentaweb_get_currency(sale_order.currency_id.id)
+        if currency is None:
+            return json.dumps({ "enabled": False })
+
+        processing_values = {
+            "order_id": sale_order.id,
+            "currency_id": sale_order.currency_id.id,
+            "partner_id": sale_order.partner_id.id,
+        }
+
+        processed_values = payment_provider.micuentaweb_generate_values_from_order(processing_values)
+        params = self.generate_form_token_data(processed_values, payment_provider, currency[0])
+        fingerprint = tools.form_token_fingerprint(payment_provider.id, payment_provider._get_ctx_mode(), params)
+
+        if self._micuentaweb_get_cached_form_token(fingerprint, count_use=False):
+            return json.dumps({ "prewarmed": True })
+
+        form_token = self.micuentaweb_create_form_token(params, payment_provider)
+        if not form_token:
+            return json.dumps({ "prewarmed": False })
+
+        cached = self._micuentaweb_cache_form_token(form_token, fingerprint, payment_provider.id, prewarmed=True)
+        self._micuentaweb_count_prewarm(cached, 'created')
+
+        return json.dumps({ "prewarmed": True })
+
     @http.route("/payment/micuentaweb/createFormToken", type="http", auth='public', methods=['POST'], csrf=False)
+    @profiling.sampled('form_token')
+    @profiling.query_budget('form_token')
     def micuentaweb_refresh_form_token(self, **post):
         processing_values = json.loads(request.httprequest.data.decode('utf-8'))
         provider_id = processing_values["provider_id"]
@@ -41,14 +88,88 @@ class MicuentawebRestController(http.Controller):
             if (compare_amounts(float(processing_values['amount']), sale_order.amount_total)):
                 return json.dumps({ "formToken": "NO_UPDATE" })
 
+            # The client sends the version of the token displayed on method selection, reuse it if the order did not change.
+            token_version = processing_values.get("token_version")
+            if token_version:
+                order_values = {
+                    "order_id": sale_order.id,
+                    "currency_id": processing_values["currency_id"],
+                    "partner_id": processing_values.get("partner_id") or sale_order.partner_id.id,
+                }
+
+                currency = payment_provider._micuentaweb_get_currency(order_values["currency_id"])[0]
+                params = self.generate_form_token_data(payment_provider.micuentaweb_generate_values_from_order(order_values), payment_provider, currency)
+                if tools.form_token_fingerprint(payment_provider.id, payment_provider._get_ctx_mode(), params) == token_version:
+                    return json.dumps({ "formToken": "NO_UPDATE", "version": token_version })
+
             processed_values = payment_transaction._get_specific_rendering_values(processing_values)
             processed_values["vads_order_id"] = processing_values["reference"].rpartition('-')[0]
 
         currency = payment_provider._micuentaweb_get_currency(processing_values["currency_id"])[0]
 
         params = self.generate_form_token_data(processed_values, payment_provider, currency)
-        form_token =  self.micuentaweb_create_form_token(params, payment_provider)
-        return json.dumps({ "formToken": form_token })
+        fingerprint = tools.form_token_fingerprint(payment_provider.id, payment_provider._get_ctx_mode(), params)
+
+        cached = self._micuentaweb_get_cached_form_token(fingerprint)
+        if not cached:
+            form_token = self.micuentaweb_create_form_token(params, payment_provider)
+            if not form_token:
+                return json.dumps({ "formToken": False })
+
+            cached = self._micuentaweb_cache_form_token(form_token, fingerprint, payment_provider.id)
+
+        return json.dumps({
+            "formToken": cached['token'],
+            "version": fingerprint,
+            # Expiry as a timestamp in milliseconds, to be compared with Date.now() on client side.
+            "expiresAt": int(cached['expires_at'] * 1000),
+        })
+
+    def _micuentaweb_get_cached_form_token(self, fingerprint, count_use=True):
+        cached = request.session.get(self._form_token_session_key)
+        if cached and cached.get('expires_at', 0) < time.time():
+            # A pre-warmed token expired before being used is wasted.
+            if cached.get('prewarmed') and not cached.get('used'):
+                self._micuentaweb_count_prewarm(cached, 'wasted')
+
+            request.session.pop(self._form_token_session_key)
+            return None
+
+        if not cached or cached.get('fingerprint') != fingerprint:
+            return None
+
+        if count_use and cached.get('prewarmed') and not cached.get('used'):
+            cached['used'] = True
+            request.session[self._form_token_session_key] = cached
+            self._micuentaweb_count_prewarm(cached, 'used')
+
+        return cached
+
+    def _micuentaweb_cache_form_token(self, form_token, fingerprint, provider_id, prewarmed=False):
+        # Keep one token per shopper session, a pre-warmed token replaced before being used is wasted.
+        cached = request.session.get(self._form_token_session_key)
+        if cached and cached.get('prewarmed') and not cached.get('used'):
+            self._micuentaweb_count_prewarm(cached, 'wasted')
+
+        cached = {
+            'token': form_token,
+            'fingerprint': fingerprint,
+            'provider_id': provider_id,
+            'expires_at': time.time() + constants.MICUENTAWEB_FORM_TOKEN_VALIDITY,
+            'prewarmed': prewarmed,
+            'used': False,
+        }
+
+        request.session[self._form_token_session_key] = cached
+        return cached
+
+    def _micuentaweb_count_prewarm(self, cached, event):
+        # Daily counters in database for all the workers, the process counters are only logged.
+        metrics.incr('prewarm_' + event)
+        if cached.get('provider_id'):
+            request.env['micuentaweb.prewarm.daily'].sudo()._micuentaweb_add(cached['provider_id'], event)
+
+        _logger.info("Izipay: pre-warmed form token %s, statistics: %s.", event, metrics.snapshot('prewarm_'))
 
     def generate_form_token_data(self, values, payment_provider, currency):
         params = {
@@ -102,6 +223,10 @@ class MicuentawebRestController(http.Controller):
         if retry and retry.isdigit():
             params["transactionOptions"]["cardOptions"]["retry"] = retry
 
+        # Let logged in customers save their card for one-click payments.
+        if payment_provider.allow_tokenization and not request.env.user._is_public():
+            params["formAction"] = "ASK_REGISTER_PAY"
+
         cards = payment_provider._micuentaweb_get_embedded_payment_means()
         if cards != []:
             params['paymentMethods'] = tuple(cards)
@@ -109,29 +234,25 @@ class MicuentawebRestController(http.Controller):
         return params
 
     def micuentaweb_create_form_token(self, values, payment_provider):
+        logger = log.get_logger(_logger, values)
+
         try:
-            identification = payment_provider.micuentaweb_site_id + ":" + payment_provider._micuentaweb_get_rest_password()
-            headers = {
-                "Authorization": "Basic " + base64.b64encode((identification.encode('utf-8'))).decode('utf-8'),
-                "Content-Type": "application/json"
-            }
-
-            request_url = constants.MICUENTAWEB_PARAMS.get('REST_URL') + 'V4/Charge/CreatePayment'
-
-            response = requests.post(url = request_url, json = values, headers = headers)
-            if response.json().get("status") != "SUCCESS":
-                _logger.error("Error while creating form token: " + response.json().get("answer", {}).get("errorMessage") + "(" + response.json().get("answer", {}).get("errorCode") + ").")
-                if "detailedErrorMessage" in response.json().get("answer", {}) and response.json().get("answer", {}).get("detailedErrorMessage") is not None:
-                    _logger.error("Detailed message: " + response.json().get("answer", {}).get("detailedErrorMessage") + "(" + response.json().get("answer", {}).get("detailedErrorCode") + ").")
+            result = payment_provider._micuentaweb_rest_request('V4/Charge/CreatePayment', values)
+            answer = result.get("answer", {})
+            if result.get("status") != "SUCCESS":
+                logger.error("Error while creating form token: %s (%s).", answer.get("errorMessage"), answer.get("errorCode"))
+                if answer.get("detailedErrorMessage") is not None:
+                    logger.error("Detailed message: %s (%s).", answer.get("detailedErrorMessage"), answer.get("detailedErrorCode"))
             else:
                 msg = ""
                 if "orderId" in values:
                     msg = " for order #" + values['orderId']
 
-                _logger.info("Form token created successfully {} with data: {}".format(msg, values))
+                logger.info("Form token created successfully%s.", msg)
+                logger.debug("Form token request data: %s", log.LazyDump(values))
 
-                return response.json().get("answer", {}).get("formToken")
+                return answer.get("formToken")
         except Exception as exc:
-            _logger.error(exc)
+            logger.error(exc)
 
-        return False
\ No newline at end of file
+        return False
@@ -31,7 +31,7 @@ MICUENTAWEB_PARAMS = {
     'LANGUAGE': 'es',
 
     'GATEWAY_VERSION': 'V2',
-    'PLUGIN_VERSION': '4.2.1',
+    'PLUGIN_VERSION': '4.3.0',
     'CMS_IDENTIFIER': 'Odoo_17-18',
     'REST_URL': 'https://api.micuentaweb.pe/api-payment/',
     'STATIC_URL': 'https://static.micuentaweb.pe/static/'
@@ -93,4 +93,74 @@ MICUENTAWEB_PAYMENT_DATA_ENTRY_MODE = {
     'embedded_extended_without_logos': _lt("Embedded payment fields extended on merchant site without logos (REST API)"),
 }
 
-MICUENTAWEB_REST_API_KEYS_DESC = 'REST API keys are available in your Izipay Back Office (menu: Settings > Shops > REST API keys).'
\ No newline at end of file
+MICUENTAWEB_REST_API_KEYS_DESC = 'REST API keys are available in your Izipay Back Office (menu: Settings > Shops > REST API keys).'
+
+# Gateway form tokens are valid for 15 minutes, keep a safety margin before reusing a cached one.
+MICUENTAWEB_FORM_TOKEN_VALIDITY = 14 * 60
+
+MICUENTAWEB_STATUSES = {
+    'success': ['AUTHORISED', 'CAPTURED', 'ACCEPTED', 'PARTIALLY_AUTHORISED'],
+    'pending': ['AUTHORISED_TO_VALIDATE', 'WAITING_AUTHORISATION', 'WAITING_AUTHORISATION_TO_VALIDATE', 'INITIAL', 'UNDER_VERIFICATION', 'WAITING_FOR_PAYMENT', 'PRE_AUTHORISED', 'SUSPENDED', 'PENDING', 'REFUND_TO_RETRY'],
+    'cancel': ['ABANDONED', 'NOT_CREATED', 'CANCELLED']
+}
+
+# Gateway transaction status => Odoo transaction state, any other status is an error.
+MICUENTAWEB_STATUS_TRANSITIONS = dict(
+    [(status, 'done') for status in MICUENTAWEB_STATUSES['success']] +
+    [(status, 'pending') for status in MICUENTAWEB_STATUSES['pending']] +
+    [(status, 'cancel') for status in MICUENTAWEB_STATUSES['cancel']]
+)
+
+# Odoo transaction states from which each target state can be reached, as accepted by the payment module.
+MICUENTAWEB_ALLOWED_FROM_STATES = {
+    'done': frozenset(['draft', 'pending', 'authorized', 'error', 'cancel']),
+    'pending': frozenset(['draft']),
+    'cancel': frozenset(['draft', 'pending', 'authorized']),
+    'error': frozenset(['draft', 'pending', 'authorized']),
+}
+
+# Odoo transaction states in which each gateway operation can be requested.
+MICUENTAWEB_OPERATION_STATES = {
+    'validate': frozenset(['pending', 'authorized']),
+    'cancel': frozenset(['pending', 'authorized']),
+    'refund': frozenset(['done']),
+}
+
+# Maximum number of SQL queries expected per request of each payment route, exceeding ones are logged.
+MICUENTAWEB_QUERY_BUDGETS = {
+    'ipn': 60,
+    'return': 50,
+    'form_token': 30,
+}
+
+# Recurring charges: failed attempts before giving up, and base delay in hours between attempts (doubled each time).
+MICUENTAWEB_RECURRING_MAX_ATTEMPTS = 4
+MICUENTAWEB_RECURRING_RETRY_DELAY = 6
+# Hours a batch of charges is reserved for the cron worker processing it, longer than any batch of REST calls.
+MICUENTAWEB_RECURRING_LEASE = 2
+
+# REST API client settings.
+MICUENTAWEB_REST_TIMEOUT = 30
+MICUENTAWEB_REST_POOL_SIZE = 10
+
+# Transaction columns searched by fragment in the back office, with a trigram index.
+MICUENTAWEB_TRIGRAM_COLUMNS = ['reference', 'provider_reference']
+
+# Transaction fields stored upper case, their searched values are upper-cased to match on the btree index.
+MICUENTAWEB_UPPER_CASE_FIELDS = ['micuentaweb_card_brand', 'micuentaweb_trans_status']
+
+# Gateway status pull from the payment status page: seconds before asking again, advisory lock namespace, seconds
+# to wait for the gateway answer.
+MICUENTAWEB_STATUS_PULL_TTL = 15
+MICUENTAWEB_STATUS_PULL_TIMEOUT = 5
+MICUENTAWEB_STATUS_PULL_LOCK = 74201
+
+# REST API error codes meaning that the gateway does not know the order or transaction.
+MICUENTAWEB_UNKNOWN_ORDER_ERRORS = ['PSP_010']
+
+# Standalone IPN receiver: seconds between shop keys reloads, minimum age of the keys before reloading them for an
+# unverified notification, maximum request body size, processing attempts before a queued notification is given up.
+MICUENTAWEB_IPN_KEYS_TTL = 60
+MICUENTAWEB_IPN_KEYS_MIN_AGE = 5
+MICUENTAWEB_IPN_MAX_BODY = 1024 * 1024
+MICUENTAWEB_IPN_MAX_ATTEMPTS = 5
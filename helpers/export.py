@@ -0,0 +1,120 @@
+# coding: utf-8
+#
+# Copyright © Lyra Network.
+# This file is part of Izipay plugin for Odoo. See COPYING.md for license details.
+#
+# Author:    Lyra Network (https://www.lyra.com)
+# Copyright: Copyright © Lyra Network
+# License:   http://www.gnu.org/licenses/agpl.html GNU Affero General Public License (AGPL v3)
+
+import csv
+import io
+import json
+import logging
+
+_logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = ('csv', 'jsonl')
+
+# Exported column name and SQL expression.
+EXPORT_COLUMNS = [
+    ('id', 'tx.id'),
+    ('reference', 'tx.reference'),
+    ('provider_reference', 'tx.provider_reference'),
+    ('provider', 'pp.code'),
+    ('state', 'tx.state'),
+    ('micuentaweb_trans_status', 'tx.micuentaweb_trans_status'),
+    ('micuentaweb_card_brand', 'tx.micuentaweb_card_brand'),
+    ('micuentaweb_card_number', 'tx.micuentaweb_card_number'),
+    ('amount', 'tx.amount'),
+    ('currency', 'cur.name'),
+    ('create_date', 'tx.create_date'),
+    ('last_state_change', 'tx.last_state_change'),
+]
+
+_QUERY = """
+    SELECT {columns}
+      FROM payment_transaction tx
+      JOIN payment_provider pp ON pp.id = tx.provider_id
+      LEFT JOIN res_currency cur ON cur.id = tx.currency_id
+     WHERE pp.code IN ('micuentaweb', 'micuentawebmulti')
+       AND tx.create_date >= %(date_from)s
+       AND tx.create_date < %(date_to)s
+       {company_clause}
+  ORDER BY tx.id
+""".format(columns=', '.join(expr for _name, expr in EXPORT_COLUMNS), company_clause='{company_clause}')
+
+def iter_rows(registry, date_from, date_to, company_ids=None, chunk_size=5000):
+    """ Yield Izipay transactions created in [date_from, date_to[ as tuples ordered like EXPORT_COLUMNS.
+
+    Rows are fetched by chunks from a server-side cursor opened on a dedicated connection, so the result set is never
+    loaded at once, whatever the date range.
+    """
+    params = {'date_from': date_from, 'date_to': date_to}
+    company_clause = ''
+    if company_ids:
+        company_clause = 'AND tx.company_id IN %(company_ids)s'
+        params['company_ids'] = tuple(company_ids)
+
+    count = 0
+    with registry.cursor() as cr:
+        # A named cursor lives on the PostgreSQL server, the ORM cursor would fetch all rows in the worker.
+        with cr._cnx.cursor('micuentaweb_export') as server_cr:
+            server_cr.itersize = chunk_size
+            server_cr.execute(_QUERY.format(company_clause=company_clause), params)
+
+            while True:
+                rows = server_cr.fetchmany(chunk_size)
+                if not rows:
+                    break
+
+                count += len(rows)
+                yield from rows
+
+    _logger.info('Izipay: %s transactions exported from %s to %s.', count, date_from, date_to)
+
+def _format_value(value):
+    if value is None:
+        return ''
+
+    if hasattr(value, 'isoformat'):
+        return value.isoformat(sep=' ') if hasattr(value, 'hour') else value.isoformat()
+
+    return value
+
+def iter_csv(rows, flush_every=1000):
+    """ Encode rows as CSV, yielding UTF-8 chunks of flush_every lines. """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow([name for name, _expr in EXPORT_COLUMNS])
+
+    for index, row in enumerate(rows, 1):
+        writer.writerow([_format_value(value) for value in row])
+        if index % flush_every == 0:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+
+    yield buffer.getvalue().encode('utf-8')
+
+def iter_jsonl(rows, flush_every=1000):
+    """ Encode rows as JSON lines, yielding UTF-8 chunks of flush_every lines. """
+    names = [name for name, _expr in EXPORT_COLUMNS]
+    lines = []
+
+    for row in rows:
+        record = {name: _format_value(value) for name, value in zip(names, row)}
+        lines.append(json.dumps(record, ensure_ascii=False, default=str))
+        if len(lines) >= flush_every:
+            yield ('\n'.join(lines) + '\n').encode('utf-8')
+            lines = []
+
+    if lines:
+        yield ('\n'.join(lines) + '\n').encode('utf-8')
+
+def iter_export(registry, date_from, date_to, export_format='csv', company_ids=None, chunk_size=5000):
+    rows = iter_rows(registry, date_from, date_to, company_ids=company_ids, chunk_size=chunk_size)
+    if export_format == 'jsonl':
+        return iter_jsonl(rows)
+
+    return iter_csv(rows)
@@ -0,0 +1,28 @@
+# coding: utf-8
+#
+# Copyright © Lyra Network.
+# This file is part of Izipay plugin for Odoo. See COPYING.md for license details.
+#
+# Author:    Lyra Network (https://www.lyra.com)
+# Copyright: Copyright © Lyra Network
+# License:   http://www.gnu.org/licenses/agpl.html GNU Affero General Public License (AGPL v3)
+
+from functools import lru_cache
+
+from markupsafe import Markup, escape
+
+@lru_cache(maxsize=128)
+def _compile(names):
+    # Static HTML before the value of each field, computed once per form layout (set of signed fields).
+    return tuple('<input type="hidden" name="{}" value="'.format(escape(name)) for name in names)
+
+def render(action, values, signature):
+    """ Return the payment form posting every vads_ field of values, i.e. exactly the fields that were signed. """
+    names = tuple(sorted(key for key in values if key.startswith('vads_')))
+
+    parts = ['<form action="', escape(action), '" method="post">']
+    for prefix, name in zip(_compile(names), names):
+        parts += (prefix, escape(values[name]), '" />')
+
+    parts += ('<input type="hidden" name="signature" value="', escape(signature), '" />', '</form>')
+    return Markup(''.join(parts))
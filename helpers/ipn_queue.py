@@ -0,0 +1,49 @@
+# coding: utf-8
+#
+# Copyright © Lyra Network.
+# This file is part of Izipay plugin for Odoo. See COPYING.md for license details.
+#
+# Author:    Lyra Network (https://www.lyra.com)
+# Copyright: Copyright © Lyra Network
+# License:   http://www.gnu.org/licenses/agpl.html GNU Affero General Public License (AGPL v3)
+
+import json
+import sqlite3
+import time
+
+# Durable local queue of the notifications accepted by the standalone IPN receiver, drained by an Odoo cron.
+# An entry is only deleted once processed and committed in Odoo: delivery is at least once, which the IPN
+# processing supports as a replayed notification does not change the transaction.
+
+_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS ipn (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        received_at REAL NOT NULL,
+        payload TEXT NOT NULL,
+        attempts INTEGER NOT NULL DEFAULT 0
+    )
+"""
+
+def connect(path):
+    cnx = sqlite3.connect(path, timeout=30, isolation_level=None)
+    # WAL lets the receiver append while the cron drains, FULL sync makes an acknowledged entry survive a crash.
+    cnx.execute('PRAGMA journal_mode=WAL')
+    cnx.execute('PRAGMA synchronous=FULL')
+    cnx.execute(_SCHEMA)
+    return cnx
+
+def push(cnx, post):
+    cnx.execute('INSERT INTO ipn (received_at, payload) VALUES (?, ?)', (time.time(), json.dumps(post, ensure_ascii=False)))
+
+def fetch(cnx, after_id, limit, max_attempts):
+    """ Return the (id, attempts, post) of the oldest entries after after_id not given up yet. """
+    rows = cnx.execute('SELECT id, attempts, payload FROM ipn WHERE id > ? AND attempts < ? ORDER BY id LIMIT ?',
+        (after_id, max_attempts, limit))
+    return [(entry_id, attempts, json.loads(payload)) for entry_id, attempts, payload in rows]
+
+def delete(cnx, entry_ids):
+    if entry_ids:
+        cnx.executemany('DELETE FROM ipn WHERE id = ?', [(entry_id,) for entry_id in entry_ids])
+
+def fail(cnx, entry_id):
+    cnx.execute('UPDATE ipn SET attempts = attempts + 1 WHERE id = ?', (entry_id,))
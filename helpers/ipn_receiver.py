@@ -0,0 +1,131 @@
+# coding: utf-8
+#
+# Copyright © Lyra Network.
+# This file is part of Izipay plugin for Odoo. See COPYING.md for license details.
+#
+# Author:    Lyra Network (https://www.lyra.com)
+# Copyright: Copyright © Lyra Network
+# License:   http://www.gnu.org/licenses/agpl.html GNU Affero General Public License (AGPL v3)
+
+from contextlib import closing
+import hmac
+import json
+import logging
+import threading
+import time
+from urllib.parse import parse_qsl
+
+from odoo import sql_db
+
+from . import constants, ipn_queue, tools
+
+_logger = logging.getLogger(__name__)
+
+def load_keys(dbname):
+    """ Read the keys of the enabled Izipay providers, as a dict of shop ID => list of (REST password, form key, algo).
+
+    Plain SQL on a pooled connection: the receiver never loads the registry.
+    """
+    keys = {}
+    with closing(sql_db.db_connect(dbname).cursor()) as cr:
+        cr.execute("""
+            SELECT micuentaweb_site_id, state, micuentaweb_test_password, micuentaweb_prod_password,
+                   micuentaweb_key_test, micuentaweb_key_prod, micuentaweb_sign_algo
+              FROM payment_provider
+             WHERE code IN ('micuentaweb', 'micuentawebmulti')
+               AND state != 'disabled'
+               AND micuentaweb_site_id IS NOT NULL
+        """)
+        for site_id, state, test_password, prod_password, key_test, key_prod, algo in cr.fetchall():
+            test = state == 'test'
+            keys.setdefault(site_id, []).append((
+                (test_password if test else prod_password) or '',
+                (key_test if test else key_prod) or '',
+                algo,
+            ))
+
+    return keys
+
+class KeyCache:
+    """ Shop keys shared by the receiver threads, reloaded every ttl seconds. The last keys are kept if reload fails. """
+
+    def __init__(self, loader, ttl=constants.MICUENTAWEB_IPN_KEYS_TTL):
+        self._loader = loader
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._keys = {}
+        self._loaded_at = 0
+
+    def get(self, max_age=None):
+        max_age = self._ttl if max_age is None else max_age
+        with self._lock:
+            if time.time() - self._loaded_at > max_age:
+                try:
+                    self._keys = self._loader()
+                except Exception as exc:
+                    _logger.error('Izipay: unable to load shop keys, keeping the previous ones: %s', exc)
+
+                self._loaded_at = time.time()
+
+            return self._keys
+
+def verify(post, keys):
+    """ Check the signature of a notification with the keys of its shop, as the IPN route does. """
+    try:
+        if tools.check_rest_response(post):
+            site_id = json.loads(post['kr-answer']).get('shopId')
+            return any(tools.check_hash(post, password) for password, _key, _algo in keys.get(site_id, ()) if password)
+
+        signature = (post.get('signature') or '').upper()
+        return bool(signature) and any(
+            hmac.compare_digest(tools.compute_signature(post, key, algo).upper(), signature)
+            for _password, key, algo in keys.get(post.get('vads_site_id'), ()) if key
+        )
+    except Exception:
+        return False
+
+def make_app(queue_path, key_cache):
+    """ WSGI application verifying the IPN signatures and queuing the verified ones to queue_path.
+
+    The gateway is acknowledged as soon as the notification is durably queued, Odoo processes it when draining the
+    queue. Notifications that cannot be verified are acknowledged and dropped, as the IPN route does.
+    """
+    local = threading.local()
+
+    def _queue():
+        # SQLite connections cannot be shared between threads.
+        if not hasattr(local, 'cnx'):
+            local.cnx = ipn_queue.connect(queue_path)
+
+        return local.cnx
+
+    def _respond(start_response, status, message):
+        body = message.encode('utf-8')
+        start_response(status, [('Content-Type', 'text/plain; charset=utf-8'), ('Content-Length', str(len(body)))])
+        return [body]
+
+    def application(environ, start_response):
+        if environ.get('REQUEST_METHOD') != 'POST':
+            return _respond(start_response, '405 Method Not Allowed', 'Method not allowed.')
+
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        if length > constants.MICUENTAWEB_IPN_MAX_BODY:
+            return _respond(start_response, '413 Request Entity Too Large', 'Request too large.')
+
+        post = dict(parse_qsl(environ['wsgi.input'].read(length).decode('utf-8'), keep_blank_values=True))
+
+        # Keys may have changed since the last reload, check again with fresh ones before dropping.
+        if not verify(post, key_cache.get()) and not verify(post, key_cache.get(constants.MICUENTAWEB_IPN_KEYS_MIN_AGE)):
+            _logger.info('Izipay: notification with invalid signature or unknown shop dropped by the IPN receiver.')
+            return _respond(start_response, '200 OK', 'Bad request received.')
+
+        try:
+            ipn_queue.push(_queue(), post)
+        except Exception:
+            # Not acknowledged, the gateway sends the notification again.
+            _logger.exception('Izipay: unable to queue notification.')
+            return _respond(start_response, '503 Service Unavailable', 'Notification not queued.')
+
+        return _respond(start_response, '200 OK', 'Notification received.')
+
+    return application
@@ -0,0 +1,84 @@
+# coding: utf-8
+#
+# Copyright © Lyra Network.
+# This file is part of Izipay plugin for Odoo. See COPYING.md for license details.
+#
+# Author:    Lyra Network (https://www.lyra.com)
+# Copyright: Copyright © Lyra Network
+# License:   http://www.gnu.org/licenses/agpl.html GNU Affero General Public License (AGPL v3)
+
+import json
+import logging
+import pprint
+import uuid
+
+REDACTED = '***'
+
+# Card, authentication and customer data that must never reach the logs.
+REDACTED_KEYS = frozenset([
+    'vads_card_number', 'vads_expiry_month', 'vads_expiry_year', 'vads_threeds_cavv', 'vads_identifier',
+    'signature', 'kr-hash', 'pan', 'expiryMonth', 'expiryYear', 'cavv', 'authenticationValue',
+    'paymentMethodToken', 'formToken', 'email', 'phoneNumber', 'firstName', 'lastName', 'address', 'zipCode',
+    'identityCode', 'cellPhoneNumber',
+])
+REDACTED_PREFIXES = ('vads_cust_', 'vads_ship_to_')
+
+def redact(data):
+    if isinstance(data, dict):
+        return {key: _redact_value(key, value) for key, value in data.items()}
+
+    if isinstance(data, (list, tuple)):
+        return [redact(value) for value in data]
+
+    return data
+
+def _redact_value(key, value):
+    if not value:
+        return value
+
+    if key in REDACTED_KEYS or (isinstance(key, str) and key.startswith(REDACTED_PREFIXES)):
+        return REDACTED
+
+    if key == 'kr-answer' and isinstance(value, str):
+        try:
+            return redact(json.loads(value))
+        except ValueError:
+            return REDACTED
+
+    return redact(value)
+
+def redact_post(post):
+    """ Redacted copy of a notification post in its original format, kr-answer stays a JSON string. """
+    redacted = redact(post)
+    if isinstance(redacted.get('kr-answer'), (dict, list)):
+        redacted['kr-answer'] = json.dumps(redacted['kr-answer'], ensure_ascii=False)
+
+    return redacted
+
+class LazyDump(object):
+    """ Redacted payload, only formatted if the log record is emitted. """
+
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return pprint.pformat(redact(self.data))
+
+class PaymentLoggerAdapter(logging.LoggerAdapter):
+    """ Prefix messages with the transaction correlation id, also available as record.micuentaweb_cid. """
+
+    def process(self, msg, kwargs):
+        kwargs['extra'] = dict(kwargs.get('extra') or {}, **self.extra)
+        return '[%s] %s' % (self.extra['micuentaweb_cid'], msg), kwargs
+
+def correlation_id(data):
+    # Use the transaction reference when available so that all the lines of a payment can be grepped together.
+    data = data or {}
+    reference = data.get('vads_ext_info_order_ref') or data.get('vads_order_id') or data.get('reference') or data.get('orderId')
+
+    return str(reference) if reference else uuid.uuid4().hex[:12]
+
+def get_logger(logger, data=None, cid=None):
+    return PaymentLoggerAdapter(logger, {'micuentaweb_cid': cid or correlation_id(data)})
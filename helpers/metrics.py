@@ -0,0 +1,23 @@
+# coding: utf-8
+#
+# Copyright © Lyra Network.
+# This file is part of Izipay plugin for Odoo. See COPYING.md for license details.
+#
+# Author:    Lyra Network (https://www.lyra.com)
+# Copyright: Copyright © Lyra Network
+# License:   http://www.gnu.org/licenses/agpl.html GNU Affero General Public License (AGPL v3)
+
+from collections import Counter
+import threading
+
+# Process-wide counters, shared by all the threads of an Odoo worker.
+_lock = threading.Lock()
+_counters = Counter()
+
+def incr(name, value=1):
+    with _lock:
+        _counters[name] += value
+
+def snapshot(prefix=''):
+    with _lock:
+        return {k: v for k, v in _counters.items() if k.startswith(prefix)}
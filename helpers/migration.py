@@ -0,0 +1,118 @@
+# coding: utf-8
+#
+# Copyright © Lyra Network.
+# This file is part of Izipay plugin for Odoo. See COPYING.md for license details.
+#
+# Author:    Lyra Network (https://www.lyra.com)
+# Copyright: Copyright © Lyra Network
+# License:   http://www.gnu.org/licenses/agpl.html GNU Affero General Public License (AGPL v3)
+
+from contextlib import closing
+import logging
+import time
+
+from odoo import sql_db
+from odoo.tools import sql
+
+_logger = logging.getLogger(__name__)
+
+_CHECKPOINT_KEY = 'payment_micuentaweb.migration.{}'
+
+def _get_checkpoint(cr, name):
+    cr.execute('SELECT value FROM ir_config_parameter WHERE key = %s', [_CHECKPOINT_KEY.format(name)])
+    row = cr.fetchone()
+    return int(row[0]) if row else 0
+
+def _set_checkpoint(cr, name, last_id):
+    # Raw SQL: the registry may not be ready during an upgrade.
+    cr.execute("""
+        INSERT INTO ir_config_parameter (key, value, create_uid, create_date, write_uid, write_date)
+        VALUES (%(key)s, %(value)s, 1, NOW() AT TIME ZONE 'UTC', 1, NOW() AT TIME ZONE 'UTC')
+        ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, write_date = EXCLUDED.write_date
+    """, {'key': _CHECKPOINT_KEY.format(name), 'value': str(last_id)})
+
+def _clear_checkpoint(cr, name):
+    cr.execute('DELETE FROM ir_config_parameter WHERE key = %s', [_CHECKPOINT_KEY.format(name)])
+
+def backfill(cr, name, table, set_clause, where_clause='TRUE', params=None, chunk_size=10000, sleep=0.0):
+    """ Run UPDATE table SET set_clause WHERE where_clause by ranges of chunk_size IDs, committing each range.
+
+    Each range only locks its own rows for a short transaction. The last updated ID is committed with each range under
+    the name of the backfill, so an interrupted upgrade resumes where it stopped. sleep (seconds) throttles the load
+    between ranges. The current transaction is committed first, do not call it in the middle of a change that must be
+    atomic.
+    """
+    params = dict(params or {})
+    cr.commit()
+
+    cr.execute('SELECT MIN(id), MAX(id) FROM "{}"'.format(table))
+    min_id, max_id = cr.fetchone()
+    if max_id is None:
+        return 0
+
+    last_id = max(_get_checkpoint(cr, name), (min_id or 1) - 1)
+    if last_id:
+        _logger.info('Izipay: resuming backfill %s after ID %s.', name, last_id)
+
+    query = 'UPDATE "{}" SET {} WHERE id > %(start_id)s AND id <= %(end_id)s AND ({})'.format(table, set_clause, where_clause)
+    total, started = 0, time.time()
+
+    while last_id < max_id:
+        end_id = min(last_id + chunk_size, max_id)
+        cr.execute(query, dict(params, start_id=last_id, end_id=end_id))
+        total += cr.rowcount
+
+        _set_checkpoint(cr, name, end_id)
+        cr.commit()
+        last_id = end_id
+
+        elapsed = time.time() - started
+        _logger.info('Izipay: backfill %s, %s rows updated, ID %s of %s (%.0f%%, %.0f rows/s).', name, total, last_id,
+            max_id, 100.0 * (last_id - min_id + 1) / (max_id - min_id + 1), total / elapsed if elapsed else 0)
+
+        if sleep:
+            time.sleep(sleep)
+
+    _clear_checkpoint(cr, name)
+    cr.commit()
+
+    _logger.info('Izipay: backfill %s done, %s rows updated in %.1fs.', name, total, time.time() - started)
+    return total
+
+def create_index_concurrently(cr, name, table, expression, method='btree', where=None):
+    """ Create an index without locking writes on the table, with CREATE INDEX CONCURRENTLY.
+
+    It cannot run in a transaction, so it uses its own autocommit connection. The current transaction is committed
+    first: PostgreSQL waits for all the transactions using the table before building the index. An invalid index left by
+    an interrupted build is dropped and built again.
+    """
+    cr.commit()
+
+    cr.execute('SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = %s', [name])
+    row = cr.fetchone()
+    if row and row[0]:
+        return False
+
+    started = time.time()
+    with closing(sql_db.db_connect(cr.dbname).cursor()) as index_cr:
+        index_cr._cnx.autocommit = True
+
+        if row:
+            _logger.info('Izipay: dropping invalid index %s.', name)
+            index_cr.execute('DROP INDEX CONCURRENTLY IF EXISTS "{}"'.format(name))
+
+        index_cr.execute('CREATE INDEX CONCURRENTLY IF NOT EXISTS "{}" ON "{}" USING {} ({}){}'.format(
+            name, table, method, expression, ' WHERE {}'.format(where) if where else ''
+        ))
+
+    _logger.info('Izipay: index %s created on %s in %.1fs.', name, table, time.time() - started)
+    return True
+
+def add_column(cr, table, column, column_type, comment=None):
+    """ Add a nullable column without default, which does not rewrite the table. Return False if it already exists. """
+    if sql.column_exists(cr, table, column):
+        return False
+
+    sql.create_column(cr, table, column, column_type, comment=comment)
+    cr.commit()
+    return True
@@ -0,0 +1,83 @@
+# coding: utf-8
+#
+# Copyright © Lyra Network.
+# This file is part of Izipay plugin for Odoo. See COPYING.md for license details.
+#
+# Author:    Lyra Network (https://www.lyra.com)
+# Copyright: Copyright © Lyra Network
+# License:   http://www.gnu.org/licenses/agpl.html GNU Affero General Public License (AGPL v3)
+
+import functools
+import logging
+import random
+import time
+
+from odoo.http import request
+from odoo.tools.profiler import Profiler
+
+from . import metrics
+from .constants import MICUENTAWEB_QUERY_BUDGETS
+
+_logger = logging.getLogger(__name__)
+
+SAMPLE_RATE_PARAM = 'payment_micuentaweb.profile_sample_rate'
+
+def _sample_rate():
+    # System parameters are cached by the registry, this costs a dict lookup when profiling is disabled.
+    try:
+        return int(request.env['ir.config_parameter'].sudo().get_param(SAMPLE_RATE_PARAM, '0') or 0)
+    except ValueError:
+        return 0
+
+def sampled(name):
+    """ Profile one call in N of the decorated route, N being the payment_micuentaweb.profile_sample_rate parameter.
+
+    Profiles (Python traces and SQL queries) are saved as ir.profile records, visible in Settings > Technical >
+    Profiling. A zero or missing parameter disables profiling.
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            rate = _sample_rate()
+            if rate <= 0 or random.randrange(rate):
+                return method(self, *args, **kwargs)
+
+            cr = request.env.cr
+            start_count, start = cr.sql_log_count, time.time()
+            description = 'Izipay {} {}'.format(name, request.httprequest.path)
+
+            with Profiler(collectors=['sql', 'traces_async'], db=request.db, description=description) as profiler:
+                result = method(self, *args, **kwargs)
+
+            sql_time = sum(entry['time'] for collector in profiler.collectors if collector.name == 'sql' for entry in collector.entries)
+            _logger.info('Izipay: profiled %s in %.1f ms, %s queries (%.1f ms in SQL).', name, (time.time() - start) * 1000,
+                cr.sql_log_count - start_count, sql_time * 1000)
+
+            return result
+
+        return wrapper
+
+    return decorator
+
+def query_budget(name):
+    """ Warn when a call of the decorated route runs more SQL queries than its budget in MICUENTAWEB_QUERY_BUDGETS. """
+    budget = MICUENTAWEB_QUERY_BUDGETS[name]
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            cr = request.env.cr
+            start_count = cr.sql_log_count
+
+            result = method(self, *args, **kwargs)
+
+            count = cr.sql_log_count - start_count
+            if count > budget:
+                metrics.incr('query_budget_exceeded_' + name)
+                _logger.warning('Izipay: %s route ran %s queries, over its budget of %s.', name, count, budget)
+
+            return result
+
+        return wrapper
+
+    return decorator
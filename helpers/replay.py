@@ -0,0 +1,120 @@
+# coding: utf-8
+#
+# Copyright © Lyra Network.
+# This file is part of Izipay plugin for Odoo. See COPYING.md for license details.
+#
+# Author:    Lyra Network (https://www.lyra.com)
+# Copyright: Copyright © Lyra Network
+# License:   http://www.gnu.org/licenses/agpl.html GNU Affero General Public License (AGPL v3)
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import json
+import logging
+import time
+
+from odoo import api, SUPERUSER_ID
+
+from . import tools
+
+_logger = logging.getLogger(__name__)
+
+def _post_reference_status(post):
+    data = tools.convert_rest_result(post) if tools.check_rest_response(post) else post
+    return data.get('vads_ext_info_order_ref') or data.get('vads_order_id'), data.get('vads_trans_status')
+
+def iter_file(filename, references=None, statuses=None):
+    """ Yield notifications from a JSON lines file, one line at a time.
+
+    Each line is either a raw IPN post or an exported micuentaweb.notification with a payload key. Their signature is
+    checked when replayed, exported notifications are redacted and can only be replayed from the database.
+    """
+    with open(filename, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+
+            record = json.loads(line)
+            if 'payload' in record:
+                reference, status = record.get('reference'), record.get('status')
+                payload = json.loads(record['payload']) if isinstance(record['payload'], str) else record['payload']
+            else:
+                payload = record
+                reference, status = _post_reference_status(payload)
+
+            if references and reference not in references:
+                continue
+
+            if statuses and status not in statuses:
+                continue
+
+            yield payload
+
+def iter_table(registry, domain, chunk_size=1000):
+    """ Yield the stored notifications whose signature was verified when received, read by chunks on a dedicated cursor. """
+    domain = domain + [('verified', '=', True)]
+    last_id = 0
+    with registry.cursor() as cr:
+        env = api.Environment(cr, SUPERUSER_ID, {})
+        Notification = env['micuentaweb.notification']
+
+        while True:
+            rows = Notification.search_read(domain + [('id', '>', last_id)], ['payload'], order='id', limit=chunk_size)
+            if not rows:
+                return
+
+            last_id = rows[-1]['id']
+
+            # Release the chunk before reading the next one.
+            env.invalidate_all()
+
+            for row in rows:
+                yield json.loads(row['payload'])
+
+def replay(registry, payloads, workers=4, dry_run=False, verified=False, progress_every=1000):
+    """ Process notifications through the IPN pipeline with a bounded number of parallel workers.
+
+    verified skips the signature check, for stored notifications which were verified when received and are redacted.
+
+    Only a bounded window of payloads is in flight at any time, so memory does not depend on the input size.
+    Return a counter of the processing states.
+    """
+    stats = Counter()
+    started = time.time()
+
+    def process(payload):
+        with registry.cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            result = env['payment.transaction']._micuentaweb_handle_ipn(payload, dry_run=dry_run, verified=verified)
+            if dry_run:
+                cr.rollback()
+
+            return result['state']
+
+    def collect(done):
+        for future in done:
+            try:
+                stats[future.result()] += 1
+            except Exception:
+                _logger.exception('Izipay: unable to replay notification.')
+                stats['exception'] += 1
+
+            total = sum(stats.values())
+            if total % progress_every == 0:
+                _logger.info('Izipay: %s notifications replayed (%.1f/s): %s.', total, total / (time.time() - started), dict(stats))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for payload in payloads:
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+
+            pending.add(executor.submit(process, payload))
+
+        done, _pending = wait(pending)
+        collect(done)
+
+    _logger.info('Izipay: replay finished, %s notifications in %.1fs: %s.', sum(stats.values()), time.time() - started, dict(stats))
+    return stats
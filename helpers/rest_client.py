@@ -0,0 +1,30 @@
+# coding: utf-8
+#
+# Copyright © Lyra Network.
+# This file is part of Izipay plugin for Odoo. See COPYING.md for license details.
+#
+# Author:    Lyra Network (https://www.lyra.com)
+# Copyright: Copyright © Lyra Network
+# License:   http://www.gnu.org/licenses/agpl.html GNU Affero General Public License (AGPL v3)
+
+import base64
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .constants import MICUENTAWEB_PARAMS, MICUENTAWEB_REST_POOL_SIZE, MICUENTAWEB_REST_TIMEOUT
+
+# Keep-alive connections to the REST API, shared by all the threads of a worker.
+_session = requests.Session()
+_session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=MICUENTAWEB_REST_POOL_SIZE))
+
+def post(site_id, password, endpoint, payload, timeout=MICUENTAWEB_REST_TIMEOUT):
+    """ Call a REST API web service and return the decoded JSON response. Network errors are not caught. """
+    identification = site_id + ':' + password
+    headers = {
+        'Authorization': 'Basic ' + base64.b64encode(identification.encode('utf-8')).decode('utf-8'),
+        'Content-Type': 'application/json',
+    }
+
+    response = _session.post(url=MICUENTAWEB_PARAMS.get('REST_URL') + endpoint, json=payload, headers=headers, timeout=timeout)
+    return response.json()
@@ -0,0 +1,113 @@
+# coding: utf-8
+#
+# Copyright © Lyra Network.
+# This file is part of Izipay plugin for Odoo. See COPYING.md for license details.
+#
+# Author:    Lyra Network (https://www.lyra.com)
+# Copyright: Copyright © Lyra Network
+# License:   http://www.gnu.org/licenses/agpl.html GNU Affero General Public License (AGPL v3)
+
+import csv
+from datetime import datetime, timedelta
+import itertools
+import random
+import uuid
+
+from .constants import MICUENTAWEB_CURRENCIES, MICUENTAWEB_STATUSES, MICUENTAWEB_STATUS_TRANSITIONS
+
+# Report line keys and the matching column headers of the gateway transaction / settlement reports.
+REPORT_COLUMNS = {
+    'order_reference': 'ORDER_ID',
+    'transaction_uuid': 'TRANSACTION_UUID',
+    'amount': 'AMOUNT',
+    'currency': 'CURRENCY',
+    'status': 'STATUS',
+    'date': 'TRANSACTION_DATE',
+}
+
+_CURRENCY_CODES = dict((numeric, alpha) for alpha, numeric, _decimals in MICUENTAWEB_CURRENCIES)
+_CURRENCY_DECIMALS = dict((alpha, decimals) for alpha, _numeric, decimals in MICUENTAWEB_CURRENCIES)
+
+def iter_report(fileobj, delimiter=None):
+    """ Yield the lines of a report file as dicts of REPORT_COLUMNS keys, reading the file one line at a time.
+
+    Amounts are converted from the smallest currency unit used by the gateway, numeric currency codes to ISO alpha codes.
+    """
+    if delimiter is None:
+        header = fileobj.readline()
+        delimiter = ';' if header.count(';') > header.count(',') else ','
+        lines = itertools.chain([header], fileobj)
+    else:
+        lines = fileobj
+
+    reader = csv.DictReader(lines, delimiter=delimiter)
+    headers = {(name or '').strip().upper(): name for name in reader.fieldnames or []}
+    missing = [column for column in REPORT_COLUMNS.values() if column not in headers and column != 'TRANSACTION_DATE']
+    if missing:
+        raise ValueError('Missing report columns: {}.'.format(', '.join(missing)))
+
+    for line_number, row in enumerate(reader, 2):
+        line = {key: (row.get(headers.get(column)) or '').strip() for key, column in REPORT_COLUMNS.items()}
+        currency = _CURRENCY_CODES.get(line['currency'], line['currency'].upper())
+
+        try:
+            amount = int(line['amount'] or 0) / 10 ** _CURRENCY_DECIMALS.get(currency, 2)
+        except ValueError:
+            amount = None
+
+        line.update(line_number=line_number, currency=currency, amount=amount, status=line['status'].upper())
+        yield line
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+
+        yield chunk
+
+def generate_report(fileobj, count, references=None, error_rate=0.02, seed=None):
+    """ Write a synthetic report of count lines, for offline tests of the matching engine.
+
+    references is an optional list of (order reference, transaction uuid, amount, currency, status) tuples of existing
+    transactions to draw lines from, otherwise random ones are generated. About error_rate of the lines get a wrong
+    amount, currency or status, and as many reference unknown transactions.
+    """
+    rng = random.Random(seed)
+    writer = csv.writer(fileobj, delimiter=';')
+    writer.writerow(REPORT_COLUMNS.values())
+
+    currencies = [currency for currency, _numeric, _decimals in MICUENTAWEB_CURRENCIES]
+    statuses = MICUENTAWEB_STATUSES['success'] + MICUENTAWEB_STATUSES['cancel']
+    start = datetime.now() - timedelta(days=1)
+
+    for index in range(count):
+        if references:
+            reference, trans_uuid, amount, currency, status = rng.choice(references)
+        else:
+            reference, trans_uuid = 'S{:08d}'.format(index), uuid.uuid4().hex
+            amount, currency, status = round(rng.uniform(1, 5000), 2), rng.choice(currencies), rng.choice(statuses)
+
+        draw = rng.random()
+        if draw < error_rate:
+            reference, trans_uuid = 'X{:08d}'.format(index), uuid.uuid4().hex
+        elif draw < error_rate * 2:
+            error = rng.randrange(3)
+            if error == 0:
+                amount += 1
+            elif error == 1:
+                currency = rng.choice([c for c in currencies if c != currency] or ['EUR'])
+            else:
+                state = MICUENTAWEB_STATUS_TRANSITIONS.get(status)
+                status = rng.choice([s for s in statuses if MICUENTAWEB_STATUS_TRANSITIONS[s] != state])
+
+        decimals = _CURRENCY_DECIMALS.get(currency, 2)
+        writer.writerow([
+            reference,
+            trans_uuid or '',
+            int(round(amount * 10 ** decimals)),
+            currency,
+            status,
+            (start + timedelta(seconds=index)).strftime('%Y-%m-%d %H:%M:%S'),
+        ])
@@ -11,6 +11,7 @@ from .constants import MICUENTAWEB_CURRENCIES, MICUENTAWEB_PARAMS
 from datetime import datetime
 from odoo import release
 
+import base64
 import hashlib
 import hmac
 import json
@@ -37,9 +38,37 @@ def generate_trans_id():
 
     return str(delta).rjust(6, '0')
 
+def form_token_fingerprint(provider_id, ctx_mode, params):
+    # Identify a form token by the provider, the context mode and the exact data sent to the gateway.
+    payload = json.dumps(params, sort_keys=True, default=str)
+
+    return hashlib.sha256((str(provider_id) + ':' + ctx_mode + ':' + payload).encode('utf-8')).hexdigest()
+
+def card_last4(number):
+    # Masked card numbers end with the last four digits of the PAN, e.g. 497010XXXXXX0003.
+    number = (number or '').strip()
+    return number[-4:] if len(number) >= 4 and number[-4:].isdigit() else False
+
+def normalize_card_brand(brand):
+    return (brand or '').strip().upper() or False
+
 def lang_translate(callback, v):
     return _(v)
 
+def compute_signature(values, key, algo):
+    """ Sign the vads_ fields of a redirect form or notification with the shop key, as the gateway does. """
+    sign = ''
+    for k in sorted(values.keys()):
+        if k.startswith('vads_'):
+            sign += values[k] + '+'
+
+    sign += key
+
+    if algo == 'SHA-1':
+        return hashlib.sha1(sign.encode('utf-8')).hexdigest()
+
+    return base64.b64encode(hmac.new(key.encode('utf-8'), sign.encode('utf-8'), hashlib.sha256).digest()).decode('utf-8')
+
 def check_hash(post, key):
     return hmac.new(key.encode("utf-8"), eval(json.dumps(post, ensure_ascii=False)).get("kr-answer").encode("utf-8"), hashlib.sha256).hexdigest() == eval(json.dumps(post, ensure_ascii=False)).get("kr-hash")
 
@@ -97,7 +126,7 @@ def convert_rest_result(post):
 
     metadata = transactions.get("metadata", False)
     if metadata:
-        for key, value in metadata:
+        for key, value in metadata.items():
             response["vads_ext_info_" + key] = value
 
     transaction_details = transactions.get("transactionDetails", False)
@@ -0,0 +1,37 @@
+# coding: utf-8
+#
+# Copyright © Lyra Network.
+# This file is part of Izipay plugin for Odoo. See COPYING.md for license details.
+#
+# Author:    Lyra Network (https://www.lyra.com)
+# Copyright: Copyright © Lyra Network
+# License:   http://www.gnu.org/licenses/agpl.html GNU Affero General Public License (AGPL v3)
+
+from odoo.tools import sql
+from odoo.addons.payment_micuentaweb.helpers import constants, migration
+
+def migrate(cr, version):
+    # Prepare the search columns and indexes before the registry update, which would otherwise backfill and index
+    # payment_transaction in one locking transaction. Indexes use the ORM names, so the update finds them existing.
+    migration.add_column(cr, 'payment_transaction', 'micuentaweb_card_last4', 'varchar')
+
+    migration.backfill(cr, 'card_search', 'payment_transaction', """
+        micuentaweb_card_last4 = CASE WHEN micuentaweb_card_number ~ '[0-9]{4}$' THEN RIGHT(micuentaweb_card_number, 4) END,
+        micuentaweb_card_brand = NULLIF(UPPER(TRIM(micuentaweb_card_brand)), '')
+    """, """
+        (micuentaweb_card_last4 IS NULL AND micuentaweb_card_number ~ '[0-9]{4}$')
+        OR micuentaweb_card_brand IS DISTINCT FROM NULLIF(UPPER(TRIM(micuentaweb_card_brand)), '')
+    """, sleep=0.1)
+
+    for column in ['provider_reference', 'micuentaweb_trans_status', 'micuentaweb_card_brand', 'micuentaweb_card_last4']:
+        migration.create_index_concurrently(cr, sql.make_index_name('payment_transaction', column), 'payment_transaction',
+            '"{}"'.format(column), where='"{}" IS NOT NULL'.format(column))
+
+    cr.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+    if cr.fetchone():
+        migration.create_index_concurrently(cr, sql.make_index_name('payment_transaction', 'micuentaweb_card_number'),
+            'payment_transaction', '"micuentaweb_card_number" gin_trgm_ops', method='gin')
+
+        for column in constants.MICUENTAWEB_TRIGRAM_COLUMNS:
+            migration.create_index_concurrently(cr, sql.make_index_name('payment_transaction', column + '_trgm'),
+                'payment_transaction', '"{}" gin_trgm_ops'.format(column), method='gin')
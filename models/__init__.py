@@ -8,5 +8,12 @@
 # License:   http://www.gnu.org/licenses/agpl.html GNU Affero General Public License (AGPL v3)
 
 from . import account_payment_method
+from . import card
+from . import language
+from . import notification
+from . import operation_wizard
 from . import payment_provider
 from . import payment_transaction
+from . import recurring
+from . import settlement
+from . import stats
@@ -20,10 +20,10 @@ class MicuentawebCard(models.Model):
     label = fields.Char()
 
     def init(self):
-        cards = constants.MICUENTAWEB_CARDS
+        # Seed all the supported cards at once, only one query on registry load if already in sync.
+        self.env.cr.execute('SELECT code FROM micuentaweb_card')
+        existing_codes = set(row[0] for row in self.env.cr.fetchall())
 
-        for c, l in cards.items():
-            card = self.search([('code', '=', c)])
-
-            if not card:
-                self.create({'code': c, 'label': l})
+        missing = [{'code': c, 'label': l} for c, l in constants.MICUENTAWEB_CARDS.items() if c not in existing_codes]
+        if missing:
+            self.create(missing)
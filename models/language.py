@@ -20,10 +20,10 @@ class MicuentawebLanguage(models.Model):
     label = fields.Char()
 
     def init(self):
-        languages = constants.MICUENTAWEB_LANGUAGES
+        # Seed all the supported languages at once, only one query on registry load if already in sync.
+        self.env.cr.execute('SELECT code FROM micuentaweb_language')
+        existing_codes = set(row[0] for row in self.env.cr.fetchall())
 
-        for c, l in languages.items():
-            lang = self.search([('code', '=', c)])
-
-            if not lang:
-                self.create({'code': c, 'label': l})
+        missing = [{'code': c, 'label': l} for c, l in constants.MICUENTAWEB_LANGUAGES.items() if c not in existing_codes]
+        if missing:
+            self.create(missing)
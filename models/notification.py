@@ -0,0 +1,145 @@
+# coding: utf-8
+#
+# Copyright © Lyra Network.
+# This file is part of Izipay plugin for Odoo. See COPYING.md for license details.
+#
+# Author:    Lyra Network (https://www.lyra.com)
+# Copyright: Copyright © Lyra Network
+# License:   http://www.gnu.org/licenses/agpl.html GNU Affero General Public License (AGPL v3)
+
+from contextlib import closing
+from datetime import timedelta
+import json
+import logging
+
+from odoo import api, fields, models
+
+from ..helpers import constants, ipn_queue, log
+
+_logger = logging.getLogger(__name__)
+
+class MicuentawebNotification(models.Model):
+    _name = 'micuentaweb.notification'
+    _description = 'Izipay notification'
+    _order = 'id desc'
+    _rec_name = 'reference'
+
+    received_date = fields.Datetime(string='Received on', default=fields.Datetime.now, required=True, readonly=True, index=True)
+    kind = fields.Selection(string='Type', selection=[('ipn', 'IPN'), ('return', 'Return')], default='ipn', required=True, readonly=True)
+    reference = fields.Char(string='Reference', readonly=True, index=True)
+    status = fields.Char(string='Transaction status', readonly=True, index=True)
+    payload = fields.Text(string='Raw data', readonly=True, required=True)
+    state = fields.Selection(string='Result', selection=[
+        ('processed', 'Processed'),
+        ('unchanged', 'Unchanged'),
+        ('ignored', 'Ignored'),
+        ('error', 'Error'),
+    ], readonly=True, index=True)
+    message = fields.Char(string='Message', readonly=True)
+    # Only notifications whose signature was valid when received can be replayed: the stored payload is redacted, its
+    # signature cannot be checked again.
+    verified = fields.Boolean(string='Signature verified', readonly=True, index=True)
+
+    @api.model
+    def _micuentaweb_store(self, kind, post, result):
+        # Card and customer data are never stored.
+        return self.create({
+            'kind': kind,
+            'reference': result.get('reference'),
+            'status': result.get('status'),
+            'payload': json.dumps(log.redact_post(post), ensure_ascii=False),
+            'state': result.get('state'),
+            'message': result.get('message'),
+            'verified': bool(result.get('verified')),
+        })
+
+    def action_micuentaweb_replay(self):
+        """ Server action: process the selected notifications again through the IPN pipeline. """
+        Transaction = self.env['payment.transaction'].sudo()
+        for notification in self.sorted('id'):
+            if not notification.verified:
+                _logger.info('Izipay: notification #%s not replayed, its signature was not verified when received.', notification.id)
+                continue
+
+            result = Transaction._micuentaweb_handle_ipn(json.loads(notification.payload), verified=True)
+            notification.write({'state': result['state'], 'message': result['message']})
+
+        return True
+
+    @api.model
+    def _micuentaweb_cron_cleanup_notifications(self):
+        """ Delete the notifications older than payment_micuentaweb.notification_retention_days, by chunks. """
+        params = self.env['ir.config_parameter'].sudo()
+        retention_days = int(params.get_param('payment_micuentaweb.notification_retention_days', 90))
+        chunk_size = int(params.get_param('payment_micuentaweb.notification_cleanup_chunk_size', 5000))
+        if retention_days <= 0:
+            return 0
+
+        limit_date = fields.Datetime.now() - timedelta(days=retention_days)
+        deleted = 0
+        while True:
+            self.env.cr.execute("""
+                DELETE FROM micuentaweb_notification
+                 WHERE id IN (SELECT id FROM micuentaweb_notification WHERE received_date < %s ORDER BY id LIMIT %s)
+            """, (limit_date, chunk_size))
+            deleted += self.env.cr.rowcount
+
+            if not self.env.registry.in_test_mode():
+                self.env.cr.commit()
+
+            if self.env.cr.rowcount < chunk_size:
+                break
+
+        self.env.invalidate_all()
+        _logger.info('Izipay: %s notifications older than %s days deleted.', deleted, retention_days)
+        return deleted
+
+    @api.model
+    def _micuentaweb_cron_drain_ipn_queue(self):
+        """ Process the notifications queued by the standalone IPN receiver, on the host of the queue file.
+
+        Each batch is committed before its entries are removed from the queue. A notification failing
+        MICUENTAWEB_IPN_MAX_ATTEMPTS times is stored in error, to be replayed once the cause is fixed.
+        """
+        params = self.env['ir.config_parameter'].sudo()
+        path = params.get_param('payment_micuentaweb.ipn_queue_path')
+        if not path:
+            return 0
+
+        batch_size = int(params.get_param('payment_micuentaweb.ipn_queue_batch_size', 200))
+        Transaction = self.env['payment.transaction'].sudo()
+        processed, last_id = 0, 0
+
+        with closing(ipn_queue.connect(path)) as cnx:
+            while True:
+                entries = ipn_queue.fetch(cnx, last_id, batch_size, constants.MICUENTAWEB_IPN_MAX_ATTEMPTS)
+                if not entries:
+                    break
+
+                done = []
+                for entry_id, attempts, post in entries:
+                    try:
+                        with self.env.cr.savepoint():
+                            result = Transaction._micuentaweb_handle_ipn(post)
+                            self._micuentaweb_store('ipn', post, result)
+                    except Exception as exc:
+                        _logger.exception('Izipay: unable to process queued notification #%s.', entry_id)
+                        if attempts + 1 < constants.MICUENTAWEB_IPN_MAX_ATTEMPTS:
+                            ipn_queue.fail(cnx, entry_id)
+                            continue
+
+                        # The receiver only queues notifications with a valid signature.
+                        self._micuentaweb_store('ipn', post, {'state': 'error', 'verified': True,
+                            'message': 'Given up after {} attempts: {}'.format(attempts + 1, exc)})
+
+                    done.append(entry_id)
+
+                if not self.env.registry.in_test_mode():
+                    self.env.cr.commit()
+
+                ipn_queue.delete(cnx, done)
+                processed += len(done)
+                last_id = entries[-1][0]
+
+        _logger.info('Izipay: %s queued notifications processed.', processed)
+        return processed
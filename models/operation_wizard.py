@@ -0,0 +1,83 @@
+# coding: utf-8
+#
+# Copyright © Lyra Network.
+# This file is part of Izipay plugin for Odoo. See COPYING.md for license details.
+#
+# Author:    Lyra Network (https://www.lyra.com)
+# Copyright: Copyright © Lyra Network
+# License:   http://www.gnu.org/licenses/agpl.html GNU Affero General Public License (AGPL v3)
+
+from odoo import api, fields, models, _
+from odoo.exceptions import ValidationError
+
+class MicuentawebOperationWizard(models.TransientModel):
+    _name = 'micuentaweb.operation.wizard'
+    _description = 'Izipay gateway operation'
+
+    transaction_ids = fields.Many2many('payment.transaction', string='Transactions', required=True)
+    transaction_count = fields.Integer(string='Transactions', compute='_compute_transaction_count')
+    operation = fields.Selection(string='Operation', selection=[
+        ('validate', 'Validate'),
+        ('cancel', 'Cancel'),
+        ('refund', 'Refund'),
+    ], default='validate', required=True)
+    currency_id = fields.Many2one('res.currency', compute='_compute_transaction_count')
+    amount = fields.Monetary(string='Amount to refund', help='Leave empty to refund the full amount. Partial refunds are only available for a single transaction.')
+    state = fields.Selection(selection=[('draft', 'Draft'), ('done', 'Done')], default='draft')
+    result_ids = fields.One2many('micuentaweb.operation.wizard.result', 'wizard_id', string='Results', readonly=True)
+    success_count = fields.Integer(string='Succeeded', readonly=True)
+    failure_count = fields.Integer(string='Failed', readonly=True)
+
+    @api.model
+    def default_get(self, fields_list):
+        res = super().default_get(fields_list)
+        if self.env.context.get('active_model') == 'payment.transaction' and 'transaction_ids' in fields_list:
+            res['transaction_ids'] = [(6, 0, self.env.context.get('active_ids', []))]
+
+        return res
+
+    @api.depends('transaction_ids')
+    def _compute_transaction_count(self):
+        for wizard in self:
+            wizard.transaction_count = len(wizard.transaction_ids)
+            wizard.currency_id = wizard.transaction_ids[:1].currency_id if len(wizard.transaction_ids) == 1 else False
+
+    def action_apply(self):
+        self.ensure_one()
+        amounts = {}
+        if self.operation == 'refund' and self.amount:
+            if len(self.transaction_ids) != 1:
+                raise ValidationError(_('A partial refund amount can only be given for a single transaction.'))
+
+            amounts[self.transaction_ids.id] = self.amount
+
+        results = self.transaction_ids._micuentaweb_run_operation(self.operation, amounts=amounts)
+
+        self.write({
+            'state': 'done',
+            'success_count': sum(1 for success, _message in results.values() if success),
+            'failure_count': sum(1 for success, _message in results.values() if not success),
+            'result_ids': [(0, 0, {
+                'transaction_id': tx_id,
+                'success': success,
+                'message': message,
+            }) for tx_id, (success, message) in results.items()],
+        })
+
+        return {
+            'type': 'ir.actions.act_window',
+            'res_model': self._name,
+            'res_id': self.id,
+            'view_mode': 'form',
+            'target': 'new',
+        }
+
+class MicuentawebOperationWizardResult(models.TransientModel):
+    _name = 'micuentaweb.operation.wizard.result'
+    _description = 'Izipay gateway operation result'
+    _order = 'success, id'
+
+    wizard_id = fields.Many2one('micuentaweb.operation.wizard', required=True, ondelete='cascade')
+    transaction_id = fields.Many2one('payment.transaction', string='Transaction', readonly=True)
+    success = fields.Boolean(string='Succeeded', readonly=True)
+    message = fields.Char(string='Result', readonly=True)
@@ -7,27 +7,23 @@
 # Copyright: Copyright © Lyra Network
 # License:   http://www.gnu.org/licenses/agpl.html GNU Affero General Public License (AGPL v3)
 
-import base64
 from datetime import datetime
-from hashlib import sha1, sha256
-import hmac
+import io
 import logging
 from os import path
 
-from pkg_resources import parse_version
+from lxml import etree
 
-from odoo import models, api, fields, _
+from odoo import models, api, fields, release, _
 from odoo.exceptions import ValidationError
 from odoo.tools import convert_xml_import
 from odoo.tools import float_round
 from odoo.tools import get_lang
-from odoo.tools.float_utils import float_compare
+from odoo.tools import ormcache
 from odoo.http import request
 
 from ..controllers.main import MicuentawebController
-from ..helpers import constants, tools
-from .card import MicuentawebCard
-from .language import MicuentawebLanguage
+from ..helpers import constants, rest_client, tools
 from odoo.addons.payment import utils as payment_utils
 
 import urllib.parse as urlparse
@@ -36,13 +32,40 @@ import json
 
 _logger = logging.getLogger(__name__)
 
+def _get_doc_field_value():
+    doc_field_html = ''
+    for lang, doc_uri in constants.MICUENTAWEB_ONLINE_DOC_URI.items():
+        doc_field_html += '<a href="%s%s">%s</a> '%(doc_uri,'odoo17/sitemap.html', constants.MICUENTAWEB_DOCUMENTATION.get(lang))
+
+    return doc_field_html
+
+_SIGN_ALGO_HELP = 'Algorithm used to compute the payment form signature. Selected algorithm must be the same as one configured in the Izipay Back Office.'
+if constants.MICUENTAWEB_PLUGIN_FEATURES.get('shatwo') == False:
+    _SIGN_ALGO_HELP += 'The HMAC-SHA-256 algorithm should not be activated if it is not yet available in the Izipay Back Office, the feature will be available soon.'
+
+_PROVIDERS = [('micuentaweb', 'Izipay - Standard payment')]
+_ONDELETE_POLICY = {'micuentaweb': 'set default'}
+if constants.MICUENTAWEB_PLUGIN_FEATURES.get('multi') == True:
+    _PROVIDERS.append(('micuentawebmulti', 'Izipay - Payment in installments'))
+    _ONDELETE_POLICY['micuentawebmulti'] = 'set default'
+
 class ProviderMicuentaweb(models.Model):
     _inherit = 'payment.provider'
 
     def _get_notify_url(self):
-        base_url = self.env['ir.config_parameter'].get_param('web.base.url')
+        return self._micuentaweb_get_notify_url()
+
+    @ormcache()
+    def _micuentaweb_get_notify_url(self):
+        # Cleared with the registry cache when a system parameter is updated.
+        base_url = self.env['ir.config_parameter'].sudo().get_param('web.base.url')
         return urlparse.urljoin(base_url, MicuentawebController._notify_url)
 
+    @ormcache('self.pool.ready')
+    def _micuentaweb_is_module_upgrading(self):
+        # Module state only changes while the registry is loading, a new registry is built after install or upgrade.
+        return bool(self.env['ir.module.module'].sudo().search_count([('state', '=', 'to upgrade'), ('name', '=', 'payment_micuentaweb')]))
+
     def _get_languages(self):
         languages = constants.MICUENTAWEB_LANGUAGES
         return [(c, l) for c, l in languages.items()]
@@ -51,45 +74,23 @@ class ProviderMicuentaweb(models.Model):
         for provider in self:
             provider.micuentaweb_multi_warning = (constants.MICUENTAWEB_PLUGIN_FEATURES.get('restrictmulti') == True) if (provider.code == 'micuentawebmulti') else False
 
-    def micuentaweb_get_doc_field_value():
-        docs_uri = constants.MICUENTAWEB_ONLINE_DOC_URI
-        doc_field_html = ''
-        for lang, doc_uri in docs_uri.items():
-            html = '<a href="%s%s">%s</a> '%(doc_uri,'odoo17/sitemap.html', constants.MICUENTAWEB_DOCUMENTATION.get(lang))
-            doc_field_html += html
-
-        return doc_field_html
-
     def _get_entry_modes(self):
         modes = constants.MICUENTAWEB_PAYMENT_DATA_ENTRY_MODE
         return [(c, l) for c, l in modes.items()]
 
     def _get_default_entry_mode(self):
-        module_upgrade = self.env['ir.module.module'].search([('state', '=', 'to upgrade'), ('name', '=', 'payment_micuentaweb')])
-        if module_upgrade:
+        if self._micuentaweb_is_module_upgrading():
             return ("redirect")
 
         return ("embedded")
 
-    sign_algo_help = 'Algorithm used to compute the payment form signature. Selected algorithm must be the same as one configured in the Izipay Back Office.'
+    code = fields.Selection(selection_add=_PROVIDERS, ondelete = _ONDELETE_POLICY)
 
-    if constants.MICUENTAWEB_PLUGIN_FEATURES.get('shatwo') == False:
-        sign_algo_help += 'The HMAC-SHA-256 algorithm should not be activated if it is not yet available in the Izipay Back Office, the feature will be available soon.'
-
-    providers = [('micuentaweb', 'Izipay - Standard payment')]
-    ondelete_policy = {'micuentaweb': 'set default'}
-
-    if constants.MICUENTAWEB_PLUGIN_FEATURES.get('multi') == True:
-        providers.append(('micuentawebmulti', 'Izipay - Payment in installments'))
-        ondelete_policy['micuentawebmulti'] = 'set default'
-
-    code = fields.Selection(selection_add=providers, ondelete = ondelete_policy)
-
-    micuentaweb_doc = fields.Html(string='Click to view the module configuration documentation', default=micuentaweb_get_doc_field_value(), readonly=True)
+    micuentaweb_doc = fields.Html(string='Click to view the module configuration documentation', default=_get_doc_field_value(), readonly=True)
     micuentaweb_site_id = fields.Char(string='Shop ID', help='The identifier provided by Izipay.', default=constants.MICUENTAWEB_PARAMS.get('SITE_ID'))
     micuentaweb_key_test = fields.Char(string='Key in test mode', help='Key provided by Izipay for test mode (available in Izipay Back Office).', default=constants.MICUENTAWEB_PARAMS.get('KEY_TEST'), readonly=constants.MICUENTAWEB_PLUGIN_FEATURES.get('qualif'))
     micuentaweb_key_prod = fields.Char(string='Key in production mode', help='Key provided by Izipay (available in Izipay Back Office after enabling production mode).', default=constants.MICUENTAWEB_PARAMS.get('KEY_PROD'))
-    micuentaweb_sign_algo = fields.Selection(string='Signature algorithm', help=sign_algo_help, selection=[('SHA-1', 'SHA-1'), ('SHA-256', 'HMAC-SHA-256')], default=constants.MICUENTAWEB_PARAMS.get('SIGN_ALGO'))
+    micuentaweb_sign_algo = fields.Selection(string='Signature algorithm', help=_SIGN_ALGO_HELP, selection=[('SHA-1', 'SHA-1'), ('SHA-256', 'HMAC-SHA-256')], default=constants.MICUENTAWEB_PARAMS.get('SIGN_ALGO'))
     micuentaweb_notify_url = fields.Char(string='Instant Payment Notification URL', help='URL to copy into your Izipay Back Office > Settings > Notification rules.', default=_get_notify_url, readonly=True)
     micuentaweb_language = fields.Selection(string='Default language', help='Default language on the payment page.', default=constants.MICUENTAWEB_PARAMS.get('LANGUAGE'), selection=_get_languages)
     micuentaweb_available_languages = fields.Many2many('micuentaweb.language', string='Available languages', column1='code', column2='label', help='Languages available on the payment page. If you do not select any, all the supported languages will be available.')
@@ -121,12 +122,51 @@ class ProviderMicuentaweb(models.Model):
     micuentaweb_embedded_pop_in = fields.Selection(string='Display in a pop-in', help='This option allows to display the embedded payment fields in a pop-in.', selection=[('0', 'No'), ('1', 'Yes')], default='0')
     micuentaweb_embedded_theme = fields.Selection(string='Theme', help='Select a theme to use to display the embedded payment fields.', selection=[('neon', 'Neon'), ('classic', 'Classic')], default='neon')
     micuentaweb_embedded_compact_mode = fields.Selection(string='Compact mode', help='This option allows to display the embedded payment fields in a compact mode.', selection=[('0', 'Disabled'), ('1', 'Enabled')], default='0')
+    micuentaweb_embedded_prewarm = fields.Selection(string='Pre-create form token', help='If enabled, the payment form token is created in background during the address and confirmation steps of the checkout so that the embedded payment fields are displayed without waiting for the gateway.', selection=[('0', 'Disabled'), ('1', 'Enabled')], default='0')
+    micuentaweb_embedded_self_hosted = fields.Selection(string='Serve theme files from shop', help='If enabled, the theme files of the embedded payment fields are downloaded once from the gateway and served by your shop with long-lived browser caching.', selection=[('0', 'No'), ('1', 'Yes')], default='0')
     micuentaweb_embedded_payment_attempts = fields.Char(string='Payment attempts number for cards', help='Maximum number of payment by cards retries after a failed payment (between 0 and 2). If blank, the gateway default value is 2.')
 
     image = fields.Char()
     environment = fields.Char()
 
-    micuentaweb_redirect = False
+    @api.model_create_multi
+    def create(self, values_list):
+        providers = super().create(values_list)
+        if any(provider.code in ['micuentaweb', 'micuentawebmulti'] for provider in providers):
+            self.env.registry.clear_cache()
+
+        return providers
+
+    def write(self, values):
+        res = super().write(values)
+        if any(provider.code in ['micuentaweb', 'micuentawebmulti'] for provider in self):
+            self.env.registry.clear_cache()
+
+        return res
+
+    def unlink(self):
+        # Codes read before the records are deleted.
+        is_micuentaweb = any(provider.code in ['micuentaweb', 'micuentawebmulti'] for provider in self)
+        res = super().unlink()
+        if is_micuentaweb:
+            self.env.registry.clear_cache()
+
+        return res
+
+    def _get_redirect_form_view(self, is_validation=False):
+        """ Override of payment: the redirect form is rendered by the transaction, see _get_processing_values. """
+        if self.env.context.get('micuentaweb_skip_redirect_view') and self.code in ['micuentaweb', 'micuentawebmulti']:
+            return None
+
+        return super()._get_redirect_form_view(is_validation=is_validation)
+
+    def _compute_feature_support_fields(self):
+        """ Override of payment to enable refunds and saved cards through the REST API. """
+        super()._compute_feature_support_fields()
+        self.filtered(lambda p: p.code == 'micuentaweb').update({
+            'support_refund': 'partial',
+            'support_tokenization': True,
+        })
 
     @api.model
     def _get_compatible_providers(self, *args, currency_id=None, **kwargs):
@@ -144,10 +184,49 @@ class ProviderMicuentaweb(models.Model):
     @api.model
     def multi_add(self, filename, noupdate):
         if (constants.MICUENTAWEB_PLUGIN_FEATURES.get('multi') == True):
-            module_upgrade = self.env['ir.module.module'].search([('state', '=', 'to upgrade'), ('name', '=', 'payment_micuentaweb')])
+            mode = 'update' if self._micuentaweb_is_module_upgrading() else 'init'
+
+            # Import each file only once per registry and install or upgrade mode.
+            loaded_files = self.pool.__dict__.setdefault('_micuentaweb_multi_loaded', set())
+            if (filename, mode) in loaded_files:
+                return None
+
             file = path.join(path.dirname(path.dirname(path.abspath(__file__)))) + filename
-            mode = 'update' if module_upgrade else 'init'
             convert_xml_import(self.env, 'payment_micuentaweb', file, None, mode, noupdate)
+            loaded_files.add((filename, mode))
+
+        return None
+
+    @api.model
+    def micuentaweb_load_views(self, filenames):
+        """ Load back-office view files written for Odoo 18, with tree views instead of list views on Odoo 17. """
+        mode = 'update' if self._micuentaweb_is_module_upgrading() else 'init'
+        module_path = path.dirname(path.dirname(path.abspath(__file__)))
+
+        for filename in filenames:
+            doc = etree.parse(path.join(module_path, filename))
+
+            if release.version_info[0] < 18:
+                for node in doc.xpath("//field[@name='arch']//list"):
+                    node.tag = 'tree'
+
+                for node in doc.xpath("//field[@name='view_mode']"):
+                    node.text = ','.join('tree' if view_mode == 'list' else view_mode for view_mode in node.text.split(','))
+
+            xmlfile = io.BytesIO(etree.tostring(doc, encoding='utf-8'))
+            xmlfile.name = filename
+            convert_xml_import(self.env, 'payment_micuentaweb', xmlfile, None, mode, False)
+
+        return None
+
+    @api.model
+    def micuentaweb_setup_crons(self, xml_ids):
+        # Scheduled actions only run once by default in Odoo 17, the number of calls does not exist anymore in Odoo 18.
+        if 'numbercall' in self.env['ir.cron']._fields:
+            for xml_id in xml_ids:
+                cron = self.env.ref(xml_id, raise_if_not_found=False)
+                if cron:
+                    cron.sudo().write({'numbercall': -1})
 
         return None
 
@@ -160,19 +239,7 @@ class ProviderMicuentaweb(models.Model):
     def _micuentaweb_generate_sign(self, provider, values):
         key = self.micuentaweb_key_prod if self._get_ctx_mode() == 'PRODUCTION' else self.micuentaweb_key_test
 
-        sign = ''
-        for k in sorted(values.keys()):
-            if k.startswith('vads_'):
-                sign += values[k] + '+'
-
-        sign += key
-
-        if self.micuentaweb_sign_algo == 'SHA-1':
-            shasign = sha1(sign.encode('utf-8')).hexdigest()
-        else:
-            shasign = base64.b64encode(hmac.new(key.encode('utf-8'), sign.encode('utf-8'), sha256).digest()).decode('utf-8')
-
-        return shasign
+        return tools.compute_signature(values, key, self.micuentaweb_sign_algo)
 
     def _micuentaweb_payment_config(self, amount):
         if self.code == 'micuentawebmulti':
@@ -222,8 +289,8 @@ class ProviderMicuentaweb(models.Model):
         # Validation mode.
         validation_mode = self.micuentaweb_validation_mode if self.micuentaweb_validation_mode != '-1' else ''
 
-        # Enable redirection?
-        ProviderMicuentaweb.micuentaweb_redirect = True if str(self.micuentaweb_redirect_enabled) == '1' else False
+        # Enable redirection? Kept local, the provider class is shared by all the requests of the worker.
+        redirect_enabled = str(self.micuentaweb_redirect_enabled) == '1'
 
         order_id = re.sub("[^0-9a-zA-Z_-]+", "", values.get('reference'))
 
@@ -235,7 +302,7 @@ class ProviderMicuentaweb(models.Model):
             'vads_trans_date': str(datetime.utcnow().strftime("%Y%m%d%H%M%S")),
             'vads_trans_id': tools.generate_trans_id(),
             'vads_ctx_mode': str(self._get_ctx_mode()),
-            'vads_page_action': u'PAYMENT',
+            'vads_page_action': u'REGISTER_PAY' if self.code == 'micuentaweb' and values.get('should_tokenize') else u'PAYMENT',
             'vads_action_mode': u'INTERACTIVE',
             'vads_payment_config': self._micuentaweb_payment_config(amount),
             'vads_version': constants.MICUENTAWEB_PARAMS.get('GATEWAY_VERSION'),
@@ -253,7 +320,7 @@ class ProviderMicuentaweb(models.Model):
             'vads_threeds_mpi': threeds_mpi
         })
 
-        if ProviderMicuentaweb.micuentaweb_redirect:
+        if redirect_enabled:
             tx_values.update({
                 'vads_redirect_success_timeout': self.micuentaweb_redirect_success_timeout or '',
                 'vads_redirect_success_message': self.micuentaweb_redirect_success_message or '',
@@ -374,6 +441,31 @@ class ProviderMicuentaweb(models.Model):
 
         return str(self.micuentaweb_prod_password)
 
+    def _micuentaweb_has_rest_credentials(self):
+        return bool(self.micuentaweb_site_id and (self.micuentaweb_test_password if self.state == 'test' else self.micuentaweb_prod_password))
+
+    @api.model
+    @ormcache()
+    def _micuentaweb_get_site_index(self):
+        """ Map each shop ID to the (provider ID, REST password) of the enabled Izipay providers using it.
+
+        Built with one query and cleared with the registry cache when a provider is updated.
+        """
+        index = {}
+        providers = self.sudo().search([('code', 'in', [code for code, _label in _PROVIDERS]), ('state', '!=', 'disabled'), ('micuentaweb_site_id', '!=', False)])
+        for provider in providers:
+            index.setdefault(provider.micuentaweb_site_id, []).append((provider.id, provider._micuentaweb_get_rest_password()))
+
+        return {site_id: tuple(entries) for site_id, entries in index.items()}
+
+    @api.model
+    def _micuentaweb_get_site_providers(self, site_id):
+        return self._micuentaweb_get_site_index().get(site_id, ())
+
+    def _micuentaweb_rest_request(self, endpoint, payload, timeout=None):
+        return rest_client.post(self.micuentaweb_site_id, self._micuentaweb_get_rest_password(), endpoint, payload,
+            timeout=timeout or constants.MICUENTAWEB_REST_TIMEOUT)
+
     def _micuentaweb_get_rest_public_key(self):
         if self.state == 'test':
             return str(self.micuentaweb_public_test_key)
@@ -395,6 +487,66 @@ class ProviderMicuentaweb(models.Model):
     def _micuentaweb_get_embedded_stylesheet_script_url(self):
         return constants.MICUENTAWEB_PARAMS.get('STATIC_URL') + "js/krypton-client/V4.0/ext/" + self.micuentaweb_embedded_theme + ".js"
 
+    def _micuentaweb_get_embedded_assets(self, language):
+        # Assets are loaded by the frontend only when the embedded payment fields are about to be displayed.
+        if self.micuentaweb_embedded_self_hosted == '1':
+            stylesheet_url = MicuentawebController._assets_url + self.micuentaweb_embedded_theme + "-reset.css"
+            stylesheet_script_url = MicuentawebController._assets_url + self.micuentaweb_embedded_theme + ".js"
+        else:
+            stylesheet_url = self._micuentaweb_get_embedded_stylesheet_url()
+            stylesheet_script_url = self._micuentaweb_get_embedded_stylesheet_script_url()
+
+        return json.dumps({
+            "script_url": self._micuentaweb_get_javascript_server_url(),
+            "public_key": self._micuentaweb_get_rest_public_key(),
+            "return_url": self._micuentaweb_get_return_url(),
+            "language": language,
+            "stylesheet_url": stylesheet_url,
+            "stylesheet_script_url": stylesheet_script_url,
+        })
+
+    def _micuentaweb_get_static_origin(self):
+        static_url = urlparse.urlparse(constants.MICUENTAWEB_PARAMS.get('STATIC_URL'))
+        return static_url.scheme + "://" + static_url.netloc
+
+    def _micuentaweb_get_embedded_render_context(self):
+        website = getattr(request, 'website', None) if request else None
+        return self._micuentaweb_get_cached_render_context(website.id if website else False, self._micuentaweb_get_embedded_language())
+
+    @ormcache('self.id', 'website_id', 'language')
+    def _micuentaweb_get_cached_render_context(self, website_id, language):
+        # Values used by the embedded payment fields template, cleared on provider or system parameters update.
+        return {
+            "assets": self._micuentaweb_get_embedded_assets(language),
+            "static_origin": self._micuentaweb_get_static_origin(),
+        }
+
+    @api.model
+    def _micuentaweb_get_embedded_provider(self):
+        website = getattr(request, 'website', None) if request else None
+        provider_id = self._micuentaweb_get_embedded_provider_id(self.env.company.id, website.id if website else False)
+
+        return self.sudo().browse(provider_id)
+
+    @api.model
+    @ormcache('company_id', 'website_id')
+    def _micuentaweb_get_embedded_provider_id(self, company_id, website_id):
+        domain = [
+            ('code', '=', 'micuentaweb'),
+            ('state', '!=', 'disabled'),
+            ('company_id', '=', company_id),
+            ('micuentaweb_payment_data_entry_mode', '!=', 'redirect'),
+        ]
+        if website_id and 'website_id' in self._fields:
+            domain.append(('website_id', 'in', [False, website_id]))
+
+        providers = self.sudo().search(domain)
+        if website_id and 'website_id' in self._fields:
+            # Prefer the provider dedicated to the current website.
+            providers = providers.sorted(lambda p: not p.website_id)
+
+        return providers[:1].id
+
     def _micuentaweb_get_return_url(self):
         return urlparse.urljoin(self.env['ir.config_parameter'].get_param('web.base.url'), MicuentawebController._return_url)
 
@@ -418,9 +570,11 @@ class ProviderMicuentaweb(models.Model):
         return None
 
     def _micuentaweb_get_inline_form_values(
-        self, amount, currency, partner_id, is_validation, payment_method_sudo, sale_order_id, **kwargs
+        self, amount, currency, partner_id, is_validation, payment_method_sudo, sale_order_id, sale_order=None, **kwargs
     ):
-        sale_order = request.env['sale.order'].sudo().search([('id', '=', sale_order_id)]).exists()
+        if not sale_order:
+            sale_order = self.env['sale.order'].sudo().browse(sale_order_id).exists()
+
         values = {
             "provider_id": self.id,
             "provider_code" : "micuentaweb",
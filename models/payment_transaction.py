@@ -7,40 +7,91 @@
 # Copyright: Copyright © Lyra Network
 # License:   http://www.gnu.org/licenses/agpl.html GNU Affero General Public License (AGPL v3)
 
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+import json
 import logging
+import re
 
 from odoo import models, api, fields, _
 from odoo.addons.payment import utils as payment_utils
-from odoo.exceptions import ValidationError
+from odoo.exceptions import UserError, ValidationError
+from odoo.tools import sql
 from odoo.tools.float_utils import float_compare
 
-from ..helpers import tools
+from ..helpers import constants, form_renderer, log, metrics, rest_client, tools
 
 _logger = logging.getLogger(__name__)
 
+# Transaction fields => the notification field they are built from, if it may be redacted.
+_REDACTED_SOURCES = {
+    'micuentaweb_card_number': 'vads_card_number',
+    'micuentaweb_card_last4': 'vads_card_number',
+    'micuentaweb_expiration_date': 'vads_expiry_month',
+    'micuentaweb_html_3ds': 'vads_threeds_cavv',
+}
+
 class TransactionMicuentaweb(models.Model):
     _inherit = 'payment.transaction'
 
-    micuentaweb_trans_status = fields.Char('Transaction status')
-    micuentaweb_card_brand = fields.Char('Means of payment')
-    micuentaweb_card_number = fields.Char('Card number')
+    # Transaction UUID, looked up when matching settlement reports.
+    provider_reference = fields.Char(index='btree_not_null')
+
+    # Support searches: statuses and brands by exact value, masked card numbers by fragment, last digits exactly.
+    micuentaweb_trans_status = fields.Char('Transaction status', index='btree_not_null')
+    micuentaweb_card_brand = fields.Char('Means of payment', index='btree_not_null')
+    micuentaweb_card_number = fields.Char('Card number', index='trigram', unaccent=False)
+    micuentaweb_card_last4 = fields.Char('Card last digits', readonly=True, index='btree_not_null')
     micuentaweb_expiration_date = fields.Char('Expiration date')
     micuentaweb_auth_result = fields.Char('Authorization result')
     micuentaweb_raw_data = fields.Text(string='Transaction log', readonly=True)
 
     micuentaweb_html_3ds = fields.Char('3D Secure HTML')
+    micuentaweb_stats_key = fields.Char('Statistics key', readonly=True, copy=False)
+    micuentaweb_recurring_charge_id = fields.Many2one('micuentaweb.recurring.charge', string='Recurring charge', readonly=True, copy=False, index='btree_not_null')
+    micuentaweb_idempotency_key = fields.Char('Idempotency key', readonly=True, copy=False, index='btree_not_null')
+    micuentaweb_status_pulled_at = fields.Datetime('Status asked to gateway on', readonly=True, copy=False)
+
+    micuentaweb_statuses = constants.MICUENTAWEB_STATUSES
+
+    def init(self):
+        # Fragment searches on references and transaction UUIDs, the fields keep their btree for exact lookups.
+        if not self.env.registry.has_trigram:
+            return
+
+        for column in constants.MICUENTAWEB_TRIGRAM_COLUMNS:
+            sql.create_index(self.env.cr, sql.make_index_name(self._table, column + '_trgm'), self._table,
+                ['"{}" gin_trgm_ops'.format(column)], method='gin')
 
-    micuentaweb_statuses = {
-        'success': ['AUTHORISED', 'CAPTURED', 'ACCEPTED', 'PARTIALLY_AUTHORISED'],
-        'pending': ['AUTHORISED_TO_VALIDATE', 'WAITING_AUTHORISATION', 'WAITING_AUTHORISATION_TO_VALIDATE', 'INITIAL', 'UNDER_VERIFICATION', 'WAITING_FOR_PAYMENT', 'PRE_AUTHORISED', 'SUSPENDED', 'PENDING', 'REFUND_TO_RETRY'],
-        'cancel': ['ABANDONED', 'NOT_CREATED', 'CANCELLED']
-    }
+    def _condition_to_sql(self, alias, fname, operator, value, query):
+        # Brands and statuses typed in any case: exact searches of the stored upper case values.
+        if fname in constants.MICUENTAWEB_UPPER_CASE_FIELDS and operator in ('=', '!=', 'in', 'not in'):
+            if isinstance(value, str):
+                value = value.upper()
+            elif isinstance(value, (list, tuple)):
+                value = [item.upper() if isinstance(item, str) else item for item in value]
+
+        return super()._condition_to_sql(alias, fname, operator, value, query)
 
     # --------------------------------------------------
     # FORM RELATED METHODS
     # --------------------------------------------------
 
+    def _get_processing_values(self):
+        """ Override of payment to render the redirect form from the signed fields instead of the QWeb template. """
+        if self.provider_code not in ['micuentaweb', 'micuentawebmulti'] \
+                or not self.provider_id._get_redirect_form_view(is_validation=self.operation == 'validation'):
+            return super()._get_processing_values()
+
+        processing_values = super(TransactionMicuentaweb, self.with_context(micuentaweb_skip_redirect_view=True))._get_processing_values()
+
+        rendering_values = self._get_specific_rendering_values(processing_values)
+        processing_values['redirect_form_html'] = form_renderer.render(
+            rendering_values['api_url'], rendering_values, rendering_values['micuentaweb_signature']
+        )
+
+        return processing_values
+
     def _get_specific_rendering_values(self, processing_values):
         """ Override of payment to return Micuentaweb specific rendering values. """
         res = super()._get_specific_rendering_values(processing_values)
@@ -131,15 +182,94 @@ class TransactionMicuentaweb(models.Model):
             raise ValidationError(error_msg)
 
          # Verify signature.
-        if shasign:
+        if shasign and not self.env.context.get('micuentaweb_verified_notification'):
             shasign_check = tx.provider_id._micuentaweb_generate_sign('out', notification_data)
             if shasign_check.upper() != shasign.upper():
-                error_msg = 'Izipay: invalid signature, received {}, computed {}, for data {}'.format(shasign, shasign_check, notification_data)
-                _logger.info(error_msg)
+                # Neither signature is logged nor returned: the computed one is valid for the received data.
+                error_msg = 'Izipay: invalid signature for transaction {}, signature mismatch: True'.format(reference)
+                logger = log.get_logger(_logger, notification_data)
+                logger.info(error_msg)
+                logger.debug('Izipay: invalid signature data %s', log.LazyDump(notification_data))
 
                 raise ValidationError(error_msg)
         return tx
 
+    @api.model
+    def _micuentaweb_handle_ipn(self, post, dry_run=False, verified=False):
+        """ Parse, verify and process an IPN as received from the gateway.
+
+        With verified, the signature is not checked again: stored notifications were verified when received, and their
+        card and customer data are redacted. Return a dict with the message to acknowledge the gateway with, the processing state (processed, unchanged,
+        ignored or error), the reference and status of the transaction when known, and whether the signature was verified.
+        """
+        logger = log.get_logger(_logger, post)
+        result = {'reference': False, 'status': False, 'verified': False}
+
+        try:
+            is_rest = False
+            data = post
+
+            # Check the type of integration.
+            if tools.check_rest_response(post):
+                if not tools.order_cycle_closed(post):
+                    logger.debug('Izipay: IPN received for an open order cycle %s', log.LazyDump(post))
+                    return dict(result, state='ignored', message='Payment failure.')
+
+                data = tools.convert_rest_result(post)
+                data['is_rest'] = '1'
+                is_rest = True
+
+                logger = log.get_logger(_logger, data)
+
+            result.update(reference=data.get('vads_ext_info_order_ref') or data.get('vads_order_id'), status=data.get('vads_trans_status'))
+
+            logger.info('Izipay: entering IPN _get_tx_from_notification, transaction status: %s.', data.get('vads_trans_status'))
+            logger.debug('Izipay: IPN post data %s', log.LazyDump(post))
+
+            # Route by shop ID: only the providers of this shop may have sent the notification.
+            site_id = json.loads(post['kr-answer']).get('shopId') if is_rest else post.get('vads_site_id')
+            site_providers = self.env['payment.provider']._micuentaweb_get_site_providers(site_id)
+            if is_rest and not verified:
+                # Check the signature before any transaction lookup.
+                site_providers = tuple(entry for entry in site_providers if tools.check_hash(post, entry[1]))
+
+            if not site_providers:
+                error_msg = 'Izipay: invalid signature or unknown shop {} for transaction {}'.format(site_id, result['reference'])
+                logger.info(error_msg)
+                metrics.incr('ipn_unknown_shop')
+
+                raise ValidationError(error_msg)
+
+            tx = self.sudo().with_context(micuentaweb_verified_notification=verified)._get_tx_from_notification_data('micuentaweb', data)
+            result['reference'] = tx.reference
+
+            if tx.provider_id.id not in [provider_id for provider_id, _password in site_providers]:
+                error_msg = 'Izipay: transaction {} does not belong to shop {}'.format(tx.reference, site_id)
+                logger.info(error_msg)
+
+                raise ValidationError(error_msg)
+
+            # Signature checked against the keys of the shop owning the transaction.
+            result['verified'] = True
+
+            if (data.get('vads_trans_status') == 'ABANDONED') or (data.get('vads_trans_status') == 'CANCELED') and (data.get('vads_order_status') == 'UNPAID') and (data.get('vads_order_cycle') == 'CLOSED'):
+                return dict(result, state='ignored', message='Payment abandoned.')
+
+            state_before = tx.state
+            if dry_run:
+                target_state = constants.MICUENTAWEB_STATUS_TRANSITIONS.get(data.get('vads_trans_status'), 'error')
+                return dict(result, state='unchanged' if target_state == state_before else 'processed',
+                    message='Dry run: transaction would go from {} to {}.'.format(state_before, target_state))
+
+            # Handle the notification data.
+            tx._handle_notification_data('micuentaweb', data)
+        except ValidationError: # Acknowledge the notification to avoid getting spammed.
+            logger.exception("Izipay: Unable to handle the IPN notification data; skipping to acknowledge.")
+            return dict(result, state='error', message='Bad request received.')
+
+        return dict(result, state='processed' if tx.state != state_before else 'unchanged',
+            message='Payment processed, order has been updated.')
+
     def _get_tx_from_notification_data(self, provider_code, notification_data):
         tx = super()._get_tx_from_notification_data(provider_code, notification_data)
         if provider_code != 'micuentaweb' and self.provider_code != 'micuentawebmulti':
@@ -152,52 +282,501 @@ class TransactionMicuentaweb(models.Model):
         if self.provider_code != 'micuentaweb' and self.provider_code != 'micuentawebmulti':
             return
 
-        self.provider_reference = notification_data.get('vads_ext_info_order_ref') or notification_data.get('vads_order_id')
+        status = notification_data.get('vads_trans_status')
+        target_state = constants.MICUENTAWEB_STATUS_TRANSITIONS.get(status, 'error')
+        logger = log.get_logger(_logger, cid=self.reference)
 
-        html_3ds = _('3DS authentication: ')
-        if notification_data.get('vads_threeds_status') == 'Y':
-            html_3ds += _('YES')
-            html_3ds += '<br />' + _('3DS certificate: ') + notification_data.get('vads_threeds_cavv')
+        # Reject transitions the payment state machine would refuse before writing anything.
+        if self.state != target_state and self.state not in constants.MICUENTAWEB_ALLOWED_FROM_STATES[target_state]:
+            metrics.incr('notification_illegal_transition')
+            logger.warning('Izipay: ignored notification with status %s for transaction in state %s.', status, self.state)
+            return
+
+        if target_state == 'cancel':
+            values = {
+                'provider_reference': notification_data.get('vads_ext_info_order_ref') or notification_data.get('vads_order_id'),
+            }
         else:
-            html_3ds += _('NO')
-
-        expiry = ''
-        if notification_data.get('vads_expiry_month') and notification_data.get('vads_expiry_year'):
-            expiry = notification_data.get('vads_expiry_month').zfill(2) + '/' + notification_data.get('vads_expiry_year')
-
-        values = {
-            'provider_reference': notification_data.get('vads_trans_uuid'),
-            'micuentaweb_raw_data': '{}'.format(notification_data),
-            'micuentaweb_html_3ds': html_3ds,
-            'micuentaweb_trans_status': notification_data.get('vads_trans_status'),
-            'micuentaweb_card_brand': notification_data.get('vads_card_brand'),
-            'micuentaweb_card_number': notification_data.get('vads_card_number'),
-            'micuentaweb_expiration_date': expiry,
-        }
+            html_3ds = _('3DS authentication: ')
+            if notification_data.get('vads_threeds_status') == 'Y':
+                html_3ds += _('YES')
+                html_3ds += '<br />' + _('3DS certificate: ') + notification_data.get('vads_threeds_cavv')
+            else:
+                html_3ds += _('NO')
+
+            expiry = ''
+            if notification_data.get('vads_expiry_month') and notification_data.get('vads_expiry_year'):
+                expiry = notification_data.get('vads_expiry_month').zfill(2) + '/' + notification_data.get('vads_expiry_year')
+
+            values = {
+                'provider_reference': notification_data.get('vads_trans_uuid'),
+                'micuentaweb_html_3ds': html_3ds,
+                'micuentaweb_trans_status': status,
+                'micuentaweb_card_brand': tools.normalize_card_brand(notification_data.get('vads_card_brand')),
+                'micuentaweb_card_number': notification_data.get('vads_card_number'),
+                'micuentaweb_card_last4': tools.card_last4(notification_data.get('vads_card_number')),
+                'micuentaweb_expiration_date': expiry,
+            }
+
+        if target_state == 'error':
+            auth_result = notification_data.get('vads_auth_result')
+            values['micuentaweb_auth_result'] = _('See the transaction details for more information ({}).').format(auth_result)
 
-        status = notification_data.get('vads_trans_status')
-        if status in self.micuentaweb_statuses['success']:
-            self.write(values)
+            logger.info('Izipay payment error, transaction status: %s, authorization result: %s.', status, auth_result)
+
+        # Redacted data of a replayed stored notification never replaces the known values.
+        values = {key: value for key, value in values.items() if notification_data.get(_REDACTED_SOURCES.get(key)) != log.REDACTED}
+
+        # Only write the values that changed, a replayed notification does not touch the record.
+        changed_values = {key: value for key, value in values.items() if (self[key] or False) != (value or False)}
+        if changed_values:
+            if target_state != 'cancel':
+                # Only formatted when the transaction is written, redacted as in the logs.
+                changed_values['micuentaweb_raw_data'] = str(log.LazyDump(notification_data))
+
+            self.write(changed_values)
+
+        if target_state == 'done' and not self.token_id and notification_data.get('vads_identifier') not in (None, '', log.REDACTED) \
+                and notification_data.get('vads_identifier_status') in ('CREATED', 'UPDATED'):
+            self._micuentaweb_tokenize_from_notification_data(notification_data)
+
+        if self.state == target_state:
+            if not changed_values:
+                metrics.incr('notification_noop')
+
+            return
+
+        state_before = self.state
+        if target_state == 'done':
             self._set_done()
-        elif status in self.micuentaweb_statuses['pending']:
-            self.write(values)
+        elif target_state == 'pending':
             self._set_pending()
-        elif status in self.micuentaweb_statuses['cancel']:
-            self.write({
-                'state_message': 'Payment for transaction #%s is cancelled (%s).' % (self.reference, notification_data.get('vads_result')),
-            })
-            self._set_canceled()
+        elif target_state == 'cancel':
+            self._set_canceled(state_message='Payment for transaction #%s is cancelled (%s).' % (self.reference, notification_data.get('vads_result')))
         else:
-            auth_result = notification_data.get('vads_auth_result')
-            auth_message = _('See the transaction details for more information ({}).').format(auth_result)
+            self._set_error('Payment for transaction #%s is refused (%s).' % (self.reference, notification_data.get('vads_result')))
+
+        if self.state != state_before:
+            self.env['micuentaweb.stats.daily'].sudo()._micuentaweb_track(self, notification_data)
+
+    def _micuentaweb_tokenize_from_notification_data(self, notification_data):
+        """ Store the card registered with this payment as a payment token of the customer. """
+        identifier = notification_data['vads_identifier']
+        token = self.env['payment.token'].search([
+            ('provider_id', '=', self.provider_id.id),
+            ('partner_id', '=', self.partner_id.id),
+            ('provider_ref', '=', identifier),
+        ], limit=1)
+
+        if not token:
+            token = self.env['payment.token'].create({
+                'provider_id': self.provider_id.id,
+                'payment_method_id': self.payment_method_id.id,
+                'partner_id': self.partner_id.id,
+                'provider_ref': identifier,
+                'payment_details': (notification_data.get('vads_card_number') or '')[-4:],
+            })
 
-            error_msg = 'Izipay payment error, transaction status: {}, authorization result: {}.'.format(status, auth_result)
-            _logger.info(error_msg)
+        self.write({'token_id': token.id, 'tokenize': False})
+        log.get_logger(_logger, cid=self.reference).info('Izipay: payment token #%s saved for partner #%s.', token.id, self.partner_id.id)
 
-            values.update({
-                'state_message': 'Payment for transaction #%s is refused (%s).' % (self.reference, notification_data.get('vads_result')),
-                'micuentaweb_auth_result': auth_message,
-            })
+    def _send_payment_request(self):
+        """ Override of payment to pay with a saved card through a server-to-server REST call. """
+        super()._send_payment_request()
+        if self.provider_code != 'micuentaweb':
+            return
+
+        if not self.token_id:
+            raise UserError(_('Izipay: the transaction is not linked to a payment token.'))
+
+        try:
+            result = self.provider_id._micuentaweb_rest_request('V4/Charge/CreatePayment', self._micuentaweb_prepare_token_payment())
+        except Exception as exc:
+            log.get_logger(_logger, cid=self.reference).error('Izipay: unable to send payment with token: %s', exc)
+            self._set_error(_('Izipay: could not reach the payment gateway, please try again later.'))
+            return
+
+        self._micuentaweb_apply_token_payment(result)
+
+    def _micuentaweb_prepare_token_payment(self):
+        params = {
+            'amount': payment_utils.to_minor_currency_units(self.amount, self.currency_id),
+            'currency': self.currency_id.name,
+            'orderId': self._micuentaweb_get_gateway_order_id(),
+            'paymentMethodToken': self.token_id.provider_ref,
+            'formAction': 'SILENT',
+            'customer': {
+                'reference': str(self.partner_id.id),
+                'email': self.partner_email or '',
+            },
+            'metadata': {
+                'order_ref': self.reference,
+            },
+            'contrib': tools._micuentaweb_get_contrib(),
+        }
+
+        if self.micuentaweb_idempotency_key:
+            # Identifies the period of a recurring charge on the gateway side, whatever the attempt.
+            params['metadata']['idempotency_key'] = self.micuentaweb_idempotency_key
+
+        validation_mode = self.provider_id.micuentaweb_validation_mode
+        if validation_mode in ('0', '1'):
+            params['transactionOptions'] = {'cardOptions': {'manualValidation': 'YES' if validation_mode == '1' else 'NO'}}
+
+        return params
+
+    def _micuentaweb_apply_token_payment(self, result):
+        logger = log.get_logger(_logger, cid=self.reference)
+        answer = result.get('answer') or {}
+
+        if result.get('status') != 'SUCCESS':
+            logger.info('Izipay: payment with token #%s refused: %s (%s).', self.token_id.id, answer.get('errorMessage'), answer.get('errorCode'))
+            self._set_error(_('Izipay: payment with saved card refused: %s', answer.get('detailedErrorMessage') or answer.get('errorMessage')))
+            return
+
+        # The answer is a payment object, as posted to the IPN URL.
+        data = tools.convert_rest_result({'kr-answer': json.dumps(answer)})
+        data['is_rest'] = '1'
+
+        logger.debug('Izipay: payment with token answer %s', log.LazyDump(answer))
+        self._handle_notification_data('micuentaweb', data)
+
+    # --------------------------------------------------
+    # GATEWAY STATUS AND MAINTENANCE
+    # --------------------------------------------------
+
+    def _micuentaweb_get_gateway_order_id(self):
+        if self.provider_id.micuentaweb_payment_data_entry_mode == 'redirect' or self.provider_code == 'micuentawebmulti' \
+                or self.micuentaweb_recurring_charge_id:
+            return re.sub("[^0-9a-zA-Z_-]+", "", self.reference)
+
+        # Embedded payment fields use the sale order name.
+        return self.sale_order_ids[:1].name or self.reference.rpartition('-')[0] or self.reference
+
+    def _micuentaweb_get_gateway_status(self, timeout=None):
+        """ Query the gateway for the order of this transaction.
+
+        Return the notification data of the gateway transaction matching this one, an empty dict if the gateway does not
+        know it, or None if the gateway could not be queried.
+        """
+        logger = log.get_logger(_logger, cid=self.reference)
+        try:
+            result = self.provider_id._micuentaweb_rest_request('V4/Order/Get', {'orderId': self._micuentaweb_get_gateway_order_id()}, timeout=timeout)
+        except Exception as exc:
+            logger.error('Izipay: unable to get order status from gateway: %s', exc)
+            return None
+
+        answer = result.get('answer') or {}
+        if result.get('status') != 'SUCCESS':
+            logger.info('Izipay: order status not available from gateway: %s (%s).', answer.get('errorMessage'), answer.get('errorCode'))
+            return {} if answer.get('errorCode') in constants.MICUENTAWEB_UNKNOWN_ORDER_ERRORS else None
+
+        transaction = self._micuentaweb_match_gateway_transaction(answer.get('transactions') or [])
+        if not transaction:
+            logger.info('Izipay: no transaction of the gateway order matches this transaction.')
+            return {}
+
+        data = tools.convert_rest_result({'kr-answer': json.dumps(dict(answer, transactions=[transaction]))})
+        data['is_rest'] = '1'
+
+        return data
+
+    def _micuentaweb_match_gateway_transaction(self, transactions):
+        # An order may hold the attempts of several Odoo transactions (e.g. embedded payments of a sale order).
+        for transaction in transactions:
+            if self.provider_reference and transaction.get('uuid') == self.provider_reference:
+                return transaction
+
+        for transaction in transactions:
+            if (transaction.get('metadata') or {}).get('order_ref') == self.reference:
+                return transaction
+
+        # Orders identified by the transaction reference only hold attempts of this transaction.
+        if transactions and self._micuentaweb_get_gateway_order_id() == re.sub("[^0-9a-zA-Z_-]+", "", self.reference):
+            return transactions[0]
+
+        return None
+
+    def _micuentaweb_pull_status(self):
+        """ Ask the gateway for the status of this transaction if its IPN is late, and process the answer as a notification.
+
+        Enabled by the payment_micuentaweb.status_pull_delay parameter: seconds after creation before the first query.
+        Single-flight per transaction across workers, with an advisory lock, and queried at most once every
+        MICUENTAWEB_STATUS_PULL_TTL seconds: concurrent and later polls read the transaction state updated by the last
+        query. Return True if the gateway was queried.
+        """
+        self.ensure_one()
+        delay = int(self.env['ir.config_parameter'].sudo().get_param('payment_micuentaweb.status_pull_delay', 0) or 0)
+        now = fields.Datetime.now()
+        if not delay or self.state not in ('draft', 'pending') or self.create_date > now - timedelta(seconds=delay):
+            return False
+
+        ttl = timedelta(seconds=constants.MICUENTAWEB_STATUS_PULL_TTL)
+        if self.micuentaweb_status_pulled_at and self.micuentaweb_status_pulled_at > now - ttl:
+            return False
+
+        # Another poll is already asking the gateway, its result is read on next poll.
+        self.env.cr.execute('SELECT pg_try_advisory_xact_lock(%s, %s)', (constants.MICUENTAWEB_STATUS_PULL_LOCK, self.id))
+        if not self.env.cr.fetchone()[0]:
+            return False
+
+        # Queried by another worker between the read and the lock.
+        self.env.cr.execute('SELECT micuentaweb_status_pulled_at FROM payment_transaction WHERE id = %s', [self.id])
+        pulled_at = self.env.cr.fetchone()[0]
+        if pulled_at and pulled_at > now - ttl:
+            self.invalidate_recordset()
+            return False
+
+        # Short timeout, the shopper is waiting. The row is only written once the answer is received, so a concurrent
+        # IPN is not blocked by the call.
+        metrics.incr('status_pull')
+        data = self._micuentaweb_get_gateway_status(timeout=constants.MICUENTAWEB_STATUS_PULL_TIMEOUT)
+
+        self.env.cr.execute('UPDATE payment_transaction SET micuentaweb_status_pulled_at = %s WHERE id = %s', (now, self.id))
+        self.invalidate_recordset(['micuentaweb_status_pulled_at'])
+
+        if data and data.get('vads_trans_status'):
+            log.get_logger(_logger, cid=self.reference).info('Izipay: IPN late, status %s pulled from gateway.', data['vads_trans_status'])
+            self._process_notification_data(data)
+            metrics.incr('status_pull_resolved')
+
+        return True
+
+    @api.model
+    def _micuentaweb_cron_cleanup_stale_transactions(self):
+        """ Cancel the abandoned Izipay transactions, by chunks committed one by one.
+
+        Only draft transactions never notified by the gateway are expired as is. Pending transactions may be paid or
+        waiting for a manual validation, they are only considered with payment_micuentaweb.cleanup_check_gateway and
+        cancelled if the gateway does not know them.
+        """
+        params = self.env['ir.config_parameter'].sudo()
+        age_hours = int(params.get_param('payment_micuentaweb.cleanup_age_hours', 24))
+        batch_size = int(params.get_param('payment_micuentaweb.cleanup_batch_size', 500))
+        max_batches = int(params.get_param('payment_micuentaweb.cleanup_max_batches', 20))
+        check_gateway = params.get_param('payment_micuentaweb.cleanup_check_gateway') == '1'
+        last_id = start_id = int(params.get_param('payment_micuentaweb.cleanup_last_id', 0))
+
+        limit_date = fields.Datetime.now() - timedelta(hours=age_hours)
+        processed = expired = 0
+
+        for batch in range(max_batches):
+            self.env.cr.execute("""
+                SELECT tx.id
+                  FROM payment_transaction tx
+                  JOIN payment_provider provider ON provider.id = tx.provider_id
+                 WHERE provider.code IN %s
+                   AND ((tx.state = 'draft' AND tx.micuentaweb_trans_status IS NULL) OR (%s AND tx.state IN ('draft', 'pending')))
+                   AND tx.create_date < %s
+                   AND tx.id > %s
+              ORDER BY tx.id
+                 LIMIT %s
+            """, (('micuentaweb', 'micuentawebmulti'), check_gateway, limit_date, last_id, batch_size))
+            tx_ids = [row[0] for row in self.env.cr.fetchall()]
+            if not tx_ids:
+                # Whole backlog scanned, start from the beginning on next run.
+                if start_id:
+                    params.set_param('payment_micuentaweb.cleanup_last_id', 0)
+                break
+
+            commit = not self.env.registry.in_test_mode()
+            expired += len(self.browse(tx_ids)._micuentaweb_expire(check_gateway, commit=commit))
+            processed += len(tx_ids)
+            last_id = tx_ids[-1]
+
+            # Checkpoint committed with the batch: an interrupted run resumes after the last processed batch.
+            params.set_param('payment_micuentaweb.cleanup_last_id', last_id)
+            if commit:
+                self.env.cr.commit()
+
+            _logger.info('Izipay: stale transactions cleanup, batch %s: %s checked, %s cancelled, last id %s.', batch + 1, processed, expired, last_id)
+
+        return processed
+
+    def _micuentaweb_expire(self, check_gateway=False, commit=False):
+        """ Cancel the transactions of the recordset the gateway never received, return the cancelled ones.
+
+        With check_gateway, the gateway is asked first, without holding any lock: its status prevails and a transaction
+        is only cancelled if the gateway does not know it. The rows are then locked just for the writes, the ones locked
+        by a notification being processed are skipped until next run. With commit, the transaction is committed before
+        the calls and before the locks, so that rows are locked from a fresh snapshot.
+        """
+        statuses = {}
+        if check_gateway:
+            if commit:
+                self.env.cr.commit()
+
+            for tx in self.filtered(lambda tx: tx.provider_id._micuentaweb_has_rest_credentials()):
+                statuses[tx.id] = tx._micuentaweb_get_gateway_status()
+
+            if commit:
+                self.env.cr.commit()
+
+        self.env.cr.execute("""
+            SELECT id FROM payment_transaction WHERE id IN %s AND state IN ('draft', 'pending') FOR UPDATE SKIP LOCKED
+        """, [tuple(self.ids)])
+        locked = self.browse([row[0] for row in self.env.cr.fetchall()])
+        locked.invalidate_recordset()
+
+        expired = self.browse()
+        for tx in locked:
+            if tx.id in statuses:
+                data = statuses[tx.id]
+                if data is None:
+                    # Gateway not reachable, checked again on next run.
+                    continue
+
+                # The gateway knows the payment, its status prevails.
+                if data.get('vads_trans_status'):
+                    tx._process_notification_data(data)
+                    continue
+            elif tx.state != 'draft' or tx.micuentaweb_trans_status:
+                # Never cancel a payment the gateway may have accepted without asking it.
+                continue
+
+            tx._set_canceled(state_message=_('Izipay: no payment received for this transaction, it has expired.'))
+            self.env['micuentaweb.stats.daily'].sudo()._micuentaweb_track(tx)
+            expired |= tx
+
+        return expired
+
+    # --------------------------------------------------
+    # GATEWAY OPERATIONS
+    # --------------------------------------------------
+
+    def _send_refund_request(self, amount_to_refund=None):
+        """ Override of payment to refund the transaction through the REST API. """
+        refund_tx = super()._send_refund_request(amount_to_refund=amount_to_refund)
+        if self.provider_code != 'micuentaweb':
+            return refund_tx
+
+        self._micuentaweb_run_operation('refund', amounts={self.id: -refund_tx.amount}, refund_txs={self.id: refund_tx})
+        return refund_tx
+
+    def _micuentaweb_check_operation(self, operation):
+        """ Return the reason why the operation cannot be run on this transaction, or None. """
+        if self.provider_code not in ('micuentaweb', 'micuentawebmulti'):
+            return _('Not an Izipay transaction.')
+
+        if not self.provider_reference or not self.micuentaweb_trans_status:
+            return _('The transaction is not known by the gateway.')
+
+        if not self.provider_id._micuentaweb_has_rest_credentials():
+            return _('REST API keys are not configured for provider %s.', self.provider_id.name)
+
+        if self.state not in constants.MICUENTAWEB_OPERATION_STATES[operation] or self.operation == 'refund':
+            return _('Operation not allowed for a transaction in state %s.', self.state)
+
+        return None
+
+    def _micuentaweb_prepare_operation(self, operation, amount=None):
+        """ Return the REST endpoint and payload of a gateway operation on this transaction. """
+        if operation == 'validate':
+            return 'V4/Transaction/Validate', {'uuid': self.provider_reference}
+
+        return 'V4/Transaction/CancelOrRefund', {
+            'uuid': self.provider_reference,
+            'amount': payment_utils.to_minor_currency_units(amount or self.amount, self.currency_id),
+            'currency': self.currency_id.name,
+            'resolutionMode': 'CANCELLATION_ONLY' if operation == 'cancel' else 'REFUND_ONLY',
+        }
+
+    def _micuentaweb_run_operation(self, operation, amounts=None, refund_txs=None):
+        """ Validate, cancel or refund the transactions of the recordset on the gateway.
+
+        Requests are prepared and results applied in the current thread: only the HTTP calls run in parallel, over the
+        pooled REST client. Return a dict of transaction ID => (success, message).
+        """
+        amounts, refund_txs = amounts or {}, refund_txs or {}
+        results, calls = {}, {}
+
+        for tx in self:
+            error = tx._micuentaweb_check_operation(operation)
+            if error:
+                results[tx.id] = (False, error)
+                continue
+
+            endpoint, payload = tx._micuentaweb_prepare_operation(operation, amounts.get(tx.id))
+            calls[tx.id] = (tx.provider_id.micuentaweb_site_id, tx.provider_id._micuentaweb_get_rest_password(), endpoint, payload)
+
+        answers = {}
+        with ThreadPoolExecutor(max_workers=constants.MICUENTAWEB_REST_POOL_SIZE) as executor:
+            futures = {executor.submit(rest_client.post, *call): tx_id for tx_id, call in calls.items()}
+            for future in as_completed(futures):
+                try:
+                    answers[futures[future]] = future.result()
+                except Exception as exc:
+                    answers[futures[future]] = {'status': 'ERROR', 'answer': {'errorMessage': str(exc), 'errorCode': 'NETWORK'}}
+
+        succeeded = {}
+        for tx_id, response in answers.items():
+            answer = response.get('answer') or {}
+            if response.get('status') == 'SUCCESS':
+                succeeded[tx_id] = answer
+            else:
+                message = _('Rejected by the gateway: %(message)s (%(code)s).', message=answer.get('detailedErrorMessage') or answer.get('errorMessage'), code=answer.get('errorCode'))
+                results[tx_id] = (False, message)
+                metrics.incr('operation_' + operation + '_error')
+
+        results.update(self.browse(list(succeeded))._micuentaweb_apply_operation(operation, succeeded, amounts, refund_txs))
+
+        failed_refunds = self.env['payment.transaction'].union(*[refund_txs[tx_id] for tx_id, (success, _message) in results.items() if not success and tx_id in refund_txs])
+        for refund_tx in failed_refunds:
+            refund_tx._set_error(results[refund_tx.source_transaction_id.id][1])
+
+        _logger.info('Izipay: %s operation run on %s transactions, %s succeeded.', operation, len(self), len(succeeded))
+        return results
+
+    def _micuentaweb_apply_operation(self, operation, answers, amounts, refund_txs):
+        # Group the records by resulting gateway status to write them at once.
+        by_status = {}
+        for tx in self:
+            by_status.setdefault(answers[tx.id].get('detailedStatus') or False, []).append(tx.id)
+
+        results = {}
+        if operation == 'refund':
+            for status, tx_ids in by_status.items():
+                txs = self.browse(tx_ids)
+                refunds = self.env['payment.transaction']
+                for tx in txs:
+                    refund_tx = refund_txs.get(tx.id) or tx._create_child_transaction(amounts.get(tx.id) or tx.amount, is_refund=True)
+                    refund_tx.provider_reference = answers[tx.id].get('uuid')
+                    refunds |= refund_tx
+
+                refunds.write({'micuentaweb_trans_status': status})
+                self._micuentaweb_set_state(refunds, status)
+                results.update((tx.id, (True, _('Refunded (%s).', status))) for tx in txs)
+        else:
+            for status, tx_ids in by_status.items():
+                txs = self.browse(tx_ids)
+                txs.write({'micuentaweb_trans_status': status})
+                if operation == 'cancel':
+                    self._micuentaweb_set_state(txs, status, target_state='cancel', state_message=_('Izipay: payment cancelled from Odoo.'))
+                else:
+                    self._micuentaweb_set_state(txs, status)
+
+                label = _('Cancelled (%s).', status) if operation == 'cancel' else _('Validated (%s).', status)
+                results.update((tx_id, (True, label)) for tx_id in tx_ids)
+
+        metrics.incr('operation_' + operation + '_success', len(self))
+        return results
+
+    @api.model
+    def _micuentaweb_set_state(self, txs, status, target_state=None, state_message=None):
+        """ Apply the result of a gateway operation and count the payments changing state in the daily statistics. """
+        target_state = target_state or constants.MICUENTAWEB_STATUS_TRANSITIONS.get(status, 'error')
+        states_before = {tx.id: tx.state for tx in txs}
+
+        if target_state == 'done':
+            txs._set_done(state_message=state_message)
+        elif target_state == 'pending':
+            txs._set_pending(state_message=state_message)
+        elif target_state == 'cancel':
+            txs._set_canceled(state_message=state_message)
+        else:
+            txs._set_error(state_message or _('Izipay: unexpected gateway status %s.', status))
 
-            self.write(values)
-            self._set_error('Payment for transaction #%s is refused.' % (self.reference))
+        # Refunds are not payments, they are not counted.
+        Stats = self.env['micuentaweb.stats.daily'].sudo()
+        for tx in txs.filtered(lambda tx: tx.operation != 'refund' and tx.state != states_before[tx.id]):
+            Stats._micuentaweb_track(tx)
@@ -0,0 +1,232 @@
+# coding: utf-8
+#
+# Copyright © Lyra Network.
+# This file is part of Izipay plugin for Odoo. See COPYING.md for license details.
+#
+# Author:    Lyra Network (https://www.lyra.com)
+# Copyright: Copyright © Lyra Network
+# License:   http://www.gnu.org/licenses/agpl.html GNU Affero General Public License (AGPL v3)
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timedelta
+import logging
+
+from dateutil.relativedelta import relativedelta
+
+from odoo import api, fields, models, _
+
+from ..helpers import constants, metrics, rest_client
+
+_logger = logging.getLogger(__name__)
+
+class MicuentawebRecurringCharge(models.Model):
+    _name = 'micuentaweb.recurring.charge'
+    _description = 'Izipay recurring charge'
+    _order = 'next_date, id'
+
+    name = fields.Char(string='Description', required=True)
+    partner_id = fields.Many2one('res.partner', string='Customer', required=True, index=True)
+    token_id = fields.Many2one('payment.token', string='Saved card', required=True,
+        domain="[('partner_id', '=', partner_id), ('provider_id.code', '=', 'micuentaweb')]")
+    company_id = fields.Many2one('res.company', string='Company', required=True, default=lambda self: self.env.company)
+    currency_id = fields.Many2one('res.currency', string='Currency', required=True, default=lambda self: self.env.company.currency_id)
+    amount = fields.Monetary(string='Amount', required=True)
+    interval_number = fields.Integer(string='Repeat every', required=True, default=1)
+    interval_type = fields.Selection(string='Interval', selection=[
+        ('days', 'Days'),
+        ('weeks', 'Weeks'),
+        ('months', 'Months'),
+        ('years', 'Years'),
+    ], required=True, default='months')
+    next_date = fields.Date(string='Next charge', required=True, default=fields.Date.context_today, index=True)
+    state = fields.Selection(string='Status', selection=[
+        ('active', 'Active'),
+        ('paused', 'Paused'),
+        ('failed', 'Failed'),
+    ], required=True, default='active', index=True)
+    attempt_count = fields.Integer(string='Failed attempts', readonly=True, copy=False)
+    next_retry = fields.Datetime(string='Next retry', readonly=True, copy=False)
+    last_message = fields.Char(string='Last result', readonly=True, copy=False)
+    transaction_ids = fields.One2many('payment.transaction', 'micuentaweb_recurring_charge_id', string='Transactions', readonly=True)
+
+    def action_micuentaweb_resume(self):
+        self.write({'state': 'active', 'attempt_count': 0, 'next_retry': False})
+        return True
+
+    def action_micuentaweb_pause(self):
+        self.write({'state': 'paused'})
+        return True
+
+    def _micuentaweb_idempotency_key(self):
+        # One charge per period: all the attempts of a period share the key.
+        return '{}-{}'.format(self.id, self.next_date.strftime('%Y%m%d'))
+
+    @api.model
+    def _micuentaweb_cron_process_recurring_charges(self):
+        """ Charge the due recurring payments by batches, each one committed when processed.
+
+        A batch is leased before the first commit releases its row locks, so that no other cron worker picks its charges
+        while their payment requests are in flight. A charge is processed at most once per run: an overdue charge paid
+        for one period waits for the next run to be charged for the following one.
+        """
+        params = self.env['ir.config_parameter'].sudo()
+        batch_size = int(params.get_param('payment_micuentaweb.recurring_batch_size', 500))
+        max_batches = int(params.get_param('payment_micuentaweb.recurring_max_batches', 100))
+
+        processed_ids = []
+        for batch in range(max_batches):
+            now = fields.Datetime.now()
+            self.env.cr.execute("""
+                SELECT id
+                  FROM micuentaweb_recurring_charge
+                 WHERE state = 'active'
+                   AND next_date <= %s
+                   AND (next_retry IS NULL OR next_retry <= %s)
+                   AND NOT (id = ANY(%s))
+              ORDER BY next_date, id
+                 LIMIT %s
+                   FOR UPDATE SKIP LOCKED
+            """, (fields.Date.context_today(self), now, processed_ids, batch_size))
+            charge_ids = [row[0] for row in self.env.cr.fetchall()]
+            if not charge_ids:
+                break
+
+            # The outcome of each charge replaces the lease. Should the worker die, the charges are taken again once
+            # it has expired, their transactions are then checked on the gateway.
+            self.env.cr.execute('UPDATE micuentaweb_recurring_charge SET next_retry = %s WHERE id IN %s',
+                (now + timedelta(hours=constants.MICUENTAWEB_RECURRING_LEASE), tuple(charge_ids)))
+            if not self.env.registry.in_test_mode():
+                self.env.cr.commit()
+
+            charges = self.browse(charge_ids)
+            charges.invalidate_recordset(['next_retry'])
+            charges._micuentaweb_charge()
+            processed_ids += charge_ids
+
+            if not self.env.registry.in_test_mode():
+                self.env.cr.commit()
+
+            self.env.invalidate_all()
+
+        _logger.info('Izipay: %s recurring charges processed.', len(processed_ids))
+        return len(processed_ids)
+
+    def _micuentaweb_charge(self):
+        """ Charge the recurring payments of the recordset with their saved card.
+
+        Transactions are created and committed before any call, so that a charge interrupted after the payment request
+        is found on next run from its idempotency key and its status asked to the gateway instead of charging again.
+        Only the HTTP calls run in parallel, over the pooled REST client.
+        """
+        Transaction = self.env['payment.transaction'].sudo()
+        keys = {charge.id: charge._micuentaweb_idempotency_key() for charge in self}
+        existing = Transaction.search([('micuentaweb_idempotency_key', 'in', list(keys.values()))])
+        existing_by_key = {}
+        for tx in existing:
+            existing_by_key[tx.micuentaweb_idempotency_key] = existing_by_key.get(tx.micuentaweb_idempotency_key, Transaction) | tx
+
+        paid, pending, vals_list = self.browse(), Transaction, []
+        for charge in self:
+            txs = existing_by_key.get(keys[charge.id], Transaction)
+            if txs.filtered(lambda tx: tx.state in ('done', 'authorized')):
+                paid |= charge
+                continue
+
+            if txs.filtered(lambda tx: tx.state in ('draft', 'pending')):
+                pending |= txs.filtered(lambda tx: tx.state in ('draft', 'pending'))
+                continue
+
+            vals_list.append({
+                'provider_id': charge.token_id.provider_id.id,
+                'payment_method_id': charge.token_id.payment_method_id.id,
+                'token_id': charge.token_id.id,
+                'partner_id': charge.partner_id.id,
+                'company_id': charge.company_id.id,
+                'amount': charge.amount,
+                'currency_id': charge.currency_id.id,
+                'operation': 'offline',
+                'reference': 'REC-{}-{}'.format(keys[charge.id], len(txs) + 1),
+                'micuentaweb_idempotency_key': keys[charge.id],
+                'micuentaweb_recurring_charge_id': charge.id,
+            })
+
+        # Interrupted charges: the gateway status prevails. A payment request the gateway never received is a failed
+        # attempt, retried with backoff. Without an answer from the gateway, the status is asked again on next run.
+        for tx in pending:
+            data = tx._micuentaweb_get_gateway_status(timeout=constants.MICUENTAWEB_STATUS_PULL_TIMEOUT)
+            if data is None:
+                continue
+
+            if data.get('vads_trans_status'):
+                tx._process_notification_data(data)
+            else:
+                tx._set_canceled(state_message=_('Izipay: payment request not received by the gateway.'))
+
+        new_txs = Transaction.create(vals_list)
+        if not self.env.registry.in_test_mode():
+            self.env.cr.commit()
+
+        calls = {
+            tx.id: (tx.provider_id.micuentaweb_site_id, tx.provider_id._micuentaweb_get_rest_password(), 'V4/Charge/CreatePayment', tx._micuentaweb_prepare_token_payment())
+            for tx in new_txs
+        }
+
+        results = {}
+        with ThreadPoolExecutor(max_workers=constants.MICUENTAWEB_REST_POOL_SIZE) as executor:
+            futures = {executor.submit(rest_client.post, *call): tx_id for tx_id, call in calls.items()}
+            for future in as_completed(futures):
+                try:
+                    results[futures[future]] = future.result()
+                except Exception as exc:
+                    # Left in draft: the status is asked to the gateway on next run.
+                    _logger.error('Izipay: recurring charge request failed for transaction #%s: %s', futures[future], exc)
+
+        for tx in new_txs.filtered(lambda tx: tx.id in results):
+            tx._micuentaweb_apply_token_payment(results[tx.id])
+
+        # Outcome of each charge, from all the transactions of its period.
+        txs = existing | new_txs
+        paid |= txs.filtered(lambda tx: tx.state in ('done', 'authorized')).micuentaweb_recurring_charge_id
+        failed = txs.filtered(lambda tx: tx.state in ('error', 'cancel')).micuentaweb_recurring_charge_id - paid
+        failed -= txs.filtered(lambda tx: tx.state in ('draft', 'pending')).micuentaweb_recurring_charge_id
+
+        waiting = txs.filtered(lambda tx: tx.state in ('draft', 'pending')).micuentaweb_recurring_charge_id - paid
+
+        paid._micuentaweb_schedule_next()
+        failed._micuentaweb_schedule_retry()
+        # Final status not known yet, checked again later without counting a failed attempt.
+        waiting.write({'next_retry': fields.Datetime.now() + timedelta(hours=1), 'last_message': _('Waiting for the payment status.')})
+
+        metrics.incr('recurring_paid', len(paid))
+        metrics.incr('recurring_failed', len(failed))
+
+    def _micuentaweb_schedule_next(self):
+        # Charges of a wave share their next date, so they are written together.
+        groups = {}
+        for charge in self:
+            next_date = charge.next_date + relativedelta(**{charge.interval_type: charge.interval_number})
+            groups.setdefault(next_date, []).append(charge.id)
+
+        for next_date, charge_ids in groups.items():
+            self.browse(charge_ids).write({
+                'next_date': next_date,
+                'attempt_count': 0,
+                'next_retry': False,
+                'last_message': _('Paid.'),
+            })
+
+    def _micuentaweb_schedule_retry(self):
+        now = fields.Datetime.now()
+        groups = {}
+        for charge in self:
+            groups.setdefault(charge.attempt_count + 1, []).append(charge.id)
+
+        for attempt_count, charge_ids in groups.items():
+            if attempt_count >= constants.MICUENTAWEB_RECURRING_MAX_ATTEMPTS:
+                values = {'state': 'failed', 'next_retry': False, 'last_message': _('Payment refused, no more retries.')}
+            else:
+                # Exponential backoff: 1, 2, 4... times the base delay.
+                delay = constants.MICUENTAWEB_RECURRING_RETRY_DELAY * 2 ** (attempt_count - 1)
+                values = {'next_retry': now + timedelta(hours=delay), 'last_message': _('Payment refused, retry %s planned.', attempt_count)}
+
+            self.browse(charge_ids).write(dict(values, attempt_count=attempt_count))
@@ -0,0 +1,181 @@
+# coding: utf-8
+#
+# Copyright © Lyra Network.
+# This file is part of Izipay plugin for Odoo. See COPYING.md for license details.
+#
+# Author:    Lyra Network (https://www.lyra.com)
+# Copyright: Copyright © Lyra Network
+# License:   http://www.gnu.org/licenses/agpl.html GNU Affero General Public License (AGPL v3)
+
+import io
+import logging
+import time
+
+from odoo import fields, models, _
+from odoo.exceptions import ValidationError
+from odoo.tools.float_utils import float_compare
+
+from ..helpers import constants, settlement
+
+_logger = logging.getLogger(__name__)
+
+class MicuentawebSettlementImport(models.Model):
+    _name = 'micuentaweb.settlement.import'
+    _description = 'Izipay settlement report import'
+    _order = 'id desc'
+
+    name = fields.Char(string='Report', required=True)
+    report_file = fields.Binary(string='Report file', attachment=True)
+    import_date = fields.Datetime(string='Imported on', readonly=True)
+    state = fields.Selection(string='Status', selection=[('draft', 'Draft'), ('done', 'Imported')], default='draft', required=True, readonly=True)
+    line_ids = fields.One2many('micuentaweb.settlement.line', 'import_id', string='Lines', readonly=True)
+    line_count = fields.Integer(string='Lines', readonly=True)
+    matched_count = fields.Integer(string='Matched', readonly=True)
+    mismatch_count = fields.Integer(string='Mismatches', readonly=True)
+    missing_count = fields.Integer(string='Unknown transactions', readonly=True)
+
+    def action_micuentaweb_import(self):
+        for report in self:
+            attachment = self.env['ir.attachment'].sudo().search([
+                ('res_model', '=', report._name), ('res_id', '=', report.id), ('res_field', '=', 'report_file')
+            ], limit=1)
+            if not attachment:
+                raise ValidationError(_('Please select the report file to import.'))
+
+            # Read the file from the filestore, it is never loaded as a whole.
+            if attachment.store_fname:
+                fileobj = open(attachment._full_path(attachment.store_fname), encoding='utf-8-sig', newline='')
+            else:
+                fileobj = io.StringIO(attachment.raw.decode('utf-8-sig'), newline='')
+
+            with fileobj:
+                report._micuentaweb_import(fileobj)
+
+        return True
+
+    def _micuentaweb_import(self, fileobj, chunk_size=2000, commit=False):
+        """ Match the lines of a report file with Izipay transactions and store the results.
+
+        Lines are read, matched and written by chunks, so memory does not depend on the file size. With commit, each
+        chunk is committed to keep transactions short on large files.
+        """
+        self.ensure_one()
+        started = time.time()
+
+        # Lines of a previous import of the same report, deleted without loading them.
+        self.env.cr.execute('DELETE FROM micuentaweb_settlement_line WHERE import_id = %s', [self.id])
+        self.env.invalidate_all()
+
+        counters = {'line_count': 0, 'matched_count': 0, 'mismatch_count': 0, 'missing_count': 0}
+        Line = self.env['micuentaweb.settlement.line']
+
+        try:
+            lines = settlement.iter_report(fileobj)
+            for chunk in settlement.chunked(lines, chunk_size):
+                vals_list = self._micuentaweb_match(chunk)
+                Line.create(vals_list)
+
+                counters['line_count'] += len(vals_list)
+                for vals in vals_list:
+                    counters[vals['match_state'] + '_count'] += 1
+
+                # Release the chunk before reading the next one.
+                self.env.flush_all()
+                self.env.invalidate_all()
+                if commit:
+                    self.env.cr.commit()
+
+                _logger.info('Izipay: %s settlement report lines imported.', counters['line_count'])
+        except ValueError as exc:
+            raise ValidationError(_('Invalid settlement report: %s', exc))
+
+        self.write(dict(counters, state='done', import_date=fields.Datetime.now()))
+        _logger.info('Izipay: settlement report %s imported in %.1fs: %s.', self.name, time.time() - started, counters)
+
+    def _micuentaweb_match(self, lines):
+        # One indexed lookup per chunk, on transaction UUID first then on order reference.
+        references = list({line['order_reference'] for line in lines if line['order_reference']})
+        uuids = list({line['transaction_uuid'] for line in lines if line['transaction_uuid']})
+
+        self.env.cr.execute("""
+            SELECT tx.id, tx.reference, tx.provider_reference, tx.amount, cur.name, cur.decimal_places, tx.state
+              FROM payment_transaction tx
+              JOIN payment_provider pp ON pp.id = tx.provider_id
+              JOIN res_currency cur ON cur.id = tx.currency_id
+             WHERE pp.code IN ('micuentaweb', 'micuentawebmulti')
+               AND (tx.provider_reference = ANY(%s) OR tx.reference = ANY(%s))
+        """, [uuids, references])
+
+        by_uuid, by_reference = {}, {}
+        for row in self.env.cr.fetchall():
+            by_reference[row[1]] = row
+            if row[2]:
+                by_uuid[row[2]] = row
+
+        vals_list = []
+        for line in lines:
+            vals = {
+                'import_id': self.id,
+                'line_number': line['line_number'],
+                'order_reference': line['order_reference'],
+                'transaction_uuid': line['transaction_uuid'],
+                'report_amount': line['amount'] or 0.0,
+                'report_currency': line['currency'],
+                'report_status': line['status'],
+                'report_date': line['date'] or False,
+            }
+
+            tx = by_uuid.get(line['transaction_uuid']) or by_reference.get(line['order_reference'])
+            if not tx:
+                vals.update(match_state='missing', message=_('No matching transaction.'))
+                vals_list.append(vals)
+                continue
+
+            tx_id, _reference, _provider_reference, amount, currency, decimal_places, state = tx
+            amount = float(amount)
+            expected_state = constants.MICUENTAWEB_STATUS_TRANSITIONS.get(line['status'], 'error')
+
+            messages = []
+            vals.update(
+                transaction_id=tx_id,
+                amount_mismatch=line['amount'] is None or float_compare(line['amount'], amount, precision_digits=decimal_places) != 0,
+                currency_mismatch=line['currency'] != currency,
+                status_mismatch=state != expected_state,
+            )
+
+            if vals['amount_mismatch']:
+                messages.append(_('Amount %(report)s, %(odoo)s in Odoo.', report=line['amount'], odoo=amount))
+            if vals['currency_mismatch']:
+                messages.append(_('Currency %(report)s, %(odoo)s in Odoo.', report=line['currency'], odoo=currency))
+            if vals['status_mismatch']:
+                messages.append(_('Status %(report)s, transaction %(odoo)s in Odoo.', report=line['status'], odoo=state))
+
+            vals.update(match_state='mismatch' if messages else 'matched', message=' '.join(messages))
+            vals_list.append(vals)
+
+        return vals_list
+
+class MicuentawebSettlementLine(models.Model):
+    _name = 'micuentaweb.settlement.line'
+    _description = 'Izipay settlement report line'
+    _order = 'import_id desc, line_number'
+    _rec_name = 'order_reference'
+
+    import_id = fields.Many2one('micuentaweb.settlement.import', string='Report', required=True, readonly=True, index=True, ondelete='cascade')
+    line_number = fields.Integer(string='Line', readonly=True)
+    order_reference = fields.Char(string='Order reference', readonly=True)
+    transaction_uuid = fields.Char(string='Transaction UUID', readonly=True)
+    report_amount = fields.Float(string='Amount', readonly=True)
+    report_currency = fields.Char(string='Currency', readonly=True)
+    report_status = fields.Char(string='Status', readonly=True)
+    report_date = fields.Char(string='Date', readonly=True)
+    transaction_id = fields.Many2one('payment.transaction', string='Transaction', readonly=True, index='btree_not_null', ondelete='set null')
+    match_state = fields.Selection(string='Result', selection=[
+        ('matched', 'Matched'),
+        ('mismatch', 'Mismatch'),
+        ('missing', 'Unknown transaction'),
+    ], required=True, readonly=True, index=True)
+    amount_mismatch = fields.Boolean(string='Amount mismatch', readonly=True)
+    currency_mismatch = fields.Boolean(string='Currency mismatch', readonly=True)
+    status_mismatch = fields.Boolean(string='Status mismatch', readonly=True)
+    message = fields.Char(string='Message', readonly=True)
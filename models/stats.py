@@ -0,0 +1,231 @@
+# coding: utf-8
+#
+# Copyright © Lyra Network.
+# This file is part of Izipay plugin for Odoo. See COPYING.md for license details.
+#
+# Author:    Lyra Network (https://www.lyra.com)
+# Copyright: Copyright © Lyra Network
+# License:   http://www.gnu.org/licenses/agpl.html GNU Affero General Public License (AGPL v3)
+
+import json
+
+from odoo import api, fields, models
+
+# Outcome counted for each final transaction state.
+_OUTCOMES = {
+    'done': 'approved',
+    'error': 'declined',
+    'cancel': 'cancelled',
+}
+
+# Columns identifying an aggregate row, in the order of the stats key stored on transactions.
+_KEY_COLUMNS = ('date', 'provider_id', 'currency_id', 'card_brand', 'result_code', 'auth_result')
+
+_UPSERT_QUERY = """
+    INSERT INTO micuentaweb_stats_daily AS s (
+        date, provider_id, currency_id, card_brand, result_code, auth_result,
+        count_total, count_approved, count_declined, count_cancelled, count_3ds, amount_approved,
+        create_uid, create_date, write_uid, write_date
+    )
+    VALUES (
+        %(date)s, %(provider_id)s, %(currency_id)s, %(card_brand)s, %(result_code)s, %(auth_result)s,
+        %(count_total)s, %(count_approved)s, %(count_declined)s, %(count_cancelled)s, %(count_3ds)s, %(amount_approved)s,
+        %(uid)s, NOW() AT TIME ZONE 'UTC', %(uid)s, NOW() AT TIME ZONE 'UTC'
+    )
+    ON CONFLICT (date, provider_id, currency_id, card_brand, result_code, auth_result) DO UPDATE SET
+        count_total = s.count_total + EXCLUDED.count_total,
+        count_approved = s.count_approved + EXCLUDED.count_approved,
+        count_declined = s.count_declined + EXCLUDED.count_declined,
+        count_cancelled = s.count_cancelled + EXCLUDED.count_cancelled,
+        count_3ds = s.count_3ds + EXCLUDED.count_3ds,
+        amount_approved = s.amount_approved + EXCLUDED.amount_approved,
+        write_uid = EXCLUDED.write_uid,
+        write_date = EXCLUDED.write_date
+"""
+
+# Pre-warmed form tokens: event counted in each aggregate row. Nothing is counted for a provider deleted meanwhile.
+_PREWARM_EVENTS = ('created', 'used', 'wasted')
+
+_PREWARM_UPSERT_QUERY = """
+    INSERT INTO micuentaweb_prewarm_daily AS s (
+        date, provider_id, count_created, count_used, count_wasted,
+        create_uid, create_date, write_uid, write_date
+    )
+    SELECT %(date)s, provider.id, %(count_created)s, %(count_used)s, %(count_wasted)s,
+        %(uid)s, NOW() AT TIME ZONE 'UTC', %(uid)s, NOW() AT TIME ZONE 'UTC'
+      FROM payment_provider provider
+     WHERE provider.id = %(provider_id)s
+    ON CONFLICT (date, provider_id) DO UPDATE SET
+        count_created = s.count_created + EXCLUDED.count_created,
+        count_used = s.count_used + EXCLUDED.count_used,
+        count_wasted = s.count_wasted + EXCLUDED.count_wasted,
+        write_uid = EXCLUDED.write_uid,
+        write_date = EXCLUDED.write_date
+"""
+
+class MicuentawebStatsDaily(models.Model):
+    _name = 'micuentaweb.stats.daily'
+    _description = 'Izipay daily payment statistics'
+    _order = 'date desc, provider_id'
+
+    date = fields.Date(string='Date', required=True, readonly=True, index=True)
+    provider_id = fields.Many2one('payment.provider', string='Provider', required=True, readonly=True, ondelete='cascade')
+    currency_id = fields.Many2one('res.currency', string='Currency', required=True, readonly=True)
+    card_brand = fields.Char(string='Means of payment', readonly=True)
+    result_code = fields.Char(string='Result code', readonly=True)
+    auth_result = fields.Char(string='Authorization result', readonly=True)
+    count_total = fields.Integer(string='Payments', readonly=True)
+    count_approved = fields.Integer(string='Approved', readonly=True)
+    count_declined = fields.Integer(string='Declined', readonly=True)
+    count_cancelled = fields.Integer(string='Cancelled', readonly=True)
+    count_3ds = fields.Integer(string='3DS authenticated', readonly=True)
+    amount_approved = fields.Monetary(string='Approved amount', readonly=True)
+
+    _sql_constraints = [
+        ('key_unique', 'UNIQUE(date, provider_id, currency_id, card_brand, result_code, auth_result)',
+            'Statistics are aggregated once per day, provider, currency, means of payment and result.'),
+    ]
+
+    @api.model
+    def _micuentaweb_track(self, tx, notification_data=None):
+        """ Move the transaction from the aggregate row of its previous outcome to the one of its current state.
+
+        Called on each state change, so the table is kept up to date without scanning transactions. The key of the row
+        a transaction is counted in is kept on the transaction, a later change (e.g. error to done) is moved exactly.
+        Without notification data (state changed from Odoo), the means of payment and results already known are kept.
+        """
+        previous = json.loads(tx.micuentaweb_stats_key) if tx.micuentaweb_stats_key else None
+        if previous:
+            self._micuentaweb_add(previous, -1)
+
+        if notification_data is None:
+            previous = previous or {}
+            notification_data = {
+                'vads_card_brand': previous.get('card_brand', tx.micuentaweb_card_brand),
+                'vads_result': previous.get('result_code'),
+                'vads_auth_result': previous.get('auth_result'),
+                'vads_threeds_status': 'Y' if previous.get('is_3ds') else None,
+            }
+
+        outcome = _OUTCOMES.get(tx.state)
+        key = False
+        if outcome:
+            values = {
+                'date': fields.Date.to_string(tx.create_date.date()),
+                'provider_id': tx.provider_id.id,
+                'currency_id': tx.currency_id.id,
+                'card_brand': notification_data.get('vads_card_brand') or '',
+                'result_code': notification_data.get('vads_result') or '',
+                'auth_result': notification_data.get('vads_auth_result') or '',
+                'outcome': outcome,
+                'is_3ds': notification_data.get('vads_threeds_status') == 'Y',
+                'amount': tx.amount if outcome == 'approved' else 0.0,
+            }
+
+            self._micuentaweb_add(values, 1)
+            key = json.dumps(values)
+
+        tx.micuentaweb_stats_key = key
+
+    @api.model
+    def _micuentaweb_add(self, values, sign):
+        params = {column: values[column] for column in _KEY_COLUMNS}
+        params.update({
+            'count_total': sign,
+            'count_approved': sign if values['outcome'] == 'approved' else 0,
+            'count_declined': sign if values['outcome'] == 'declined' else 0,
+            'count_cancelled': sign if values['outcome'] == 'cancelled' else 0,
+            'count_3ds': sign if values['is_3ds'] else 0,
+            'amount_approved': sign * values['amount'],
+            'uid': self.env.uid,
+        })
+
+        self.env.cr.execute(_UPSERT_QUERY, params)
+        self.invalidate_model()
+
+    @api.model
+    def _micuentaweb_get_summary(self, date_from, date_to, provider_ids=None):
+        """ Return approval rate, 3DS share, decline reasons and volume by means of payment for a date range.
+
+        Only the aggregate rows of the range are read, the cost does not depend on the transaction history.
+        """
+        domain = [('date', '>=', date_from), ('date', '<=', date_to)]
+        if provider_ids:
+            domain.append(('provider_id', 'in', provider_ids))
+
+        aggregates = ['count_total:sum', 'count_approved:sum', 'count_declined:sum', 'count_cancelled:sum', 'count_3ds:sum']
+
+        days = []
+        for day, provider, total, approved, declined, cancelled, count_3ds in self._read_group(
+                domain, ['date:day', 'provider_id'], aggregates, order='date:day, provider_id'):
+            days.append({
+                'date': fields.Date.to_string(day),
+                'provider_id': provider.id,
+                'total': total,
+                'approved': approved,
+                'declined': declined,
+                'cancelled': cancelled,
+                'approval_rate': approved / total if total else 0.0,
+                'threeds_share': count_3ds / total if total else 0.0,
+            })
+
+        decline_reasons = []
+        for result_code, auth_result, declined in self._read_group(
+                domain + [('count_declined', '!=', 0)], ['result_code', 'auth_result'], ['count_declined:sum'],
+                order='count_declined:sum desc'):
+            decline_reasons.append({'result_code': result_code or '', 'auth_result': auth_result or '', 'count': declined})
+
+        card_brands = []
+        for card_brand, currency, total, approved, amount in self._read_group(
+                domain, ['card_brand', 'currency_id'], ['count_total:sum', 'count_approved:sum', 'amount_approved:sum'],
+                order='count_total:sum desc'):
+            card_brands.append({
+                'card_brand': card_brand or '',
+                'currency': currency.name,
+                'total': total,
+                'approved': approved,
+                'amount_approved': amount,
+            })
+
+        return {
+            'date_from': fields.Date.to_string(date_from),
+            'date_to': fields.Date.to_string(date_to),
+            'days': days,
+            'decline_reasons': decline_reasons,
+            'card_brands': card_brands,
+        }
+
+class MicuentawebPrewarmDaily(models.Model):
+    _name = 'micuentaweb.prewarm.daily'
+    _description = 'Izipay daily pre-warmed form token statistics'
+    _order = 'date desc, provider_id'
+
+    date = fields.Date(string='Date', required=True, readonly=True, index=True)
+    provider_id = fields.Many2one('payment.provider', string='Provider', required=True, readonly=True, ondelete='cascade')
+    count_created = fields.Integer(string='Pre-warmed', readonly=True)
+    count_used = fields.Integer(string='Used', readonly=True)
+    count_wasted = fields.Integer(string='Wasted', readonly=True, help='Pre-warmed tokens replaced or expired before being used.')
+    waste_rate = fields.Float(string='Waste rate', compute='_compute_waste_rate',
+        help='Share of the pre-warmed tokens not used, including the ones of abandoned checkouts never counted as wasted.')
+
+    _sql_constraints = [
+        ('key_unique', 'UNIQUE(date, provider_id)', 'Pre-warmed form tokens are counted once per day and provider.'),
+    ]
+
+    @api.depends('count_created', 'count_used')
+    def _compute_waste_rate(self):
+        for row in self:
+            row.waste_rate = max(row.count_created - row.count_used, 0) / row.count_created if row.count_created else 0.0
+
+    @api.model
+    def _micuentaweb_add(self, provider_id, event):
+        """ Count a pre-warmed form token event of the provider in the row of the day, shared by all the workers. """
+        params = {'count_' + name: 1 if name == event else 0 for name in _PREWARM_EVENTS}
+        params.update({
+            'date': fields.Date.to_string(fields.Date.today()),
+            'provider_id': provider_id,
+            'uid': self.env.uid,
+        })
+
+        self.env.cr.execute(_PREWARM_UPSERT_QUERY, params)
+        self.invalidate_model()
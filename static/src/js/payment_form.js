@@ -14,16 +14,100 @@ import paymentForm from '@payment/js/payment_form';
 let can_process_payment = true;
 let popin = false;
 
+let assetsPromise = null;
+
+/**
+ * Load the embedded payment fields client and theme on demand, only once per page.
+ */
+function loadMicuentawebAssets(assets) {
+    if (assetsPromise !== null) {
+        return assetsPromise;
+    }
+
+    const loadScript = (src, attributes = {}) => new Promise((resolve, reject) => {
+        const script = document.createElement('script');
+        for (const [name, value] of Object.entries(attributes)) {
+            script.setAttribute(name, value);
+        }
+
+        script.onload = resolve;
+        script.onerror = reject;
+        script.src = src;
+        document.head.appendChild(script);
+    });
+
+    performance.mark('micuentaweb-assets-start');
+
+    const stylesheet = document.createElement('link');
+    stylesheet.rel = 'stylesheet';
+    stylesheet.href = assets.stylesheet_url;
+    document.head.appendChild(stylesheet);
+
+    assetsPromise = loadScript(assets.script_url, {
+        'kr-public-key': assets.public_key,
+        'kr-post-url-success': assets.return_url,
+        'kr-post-url-refused': assets.return_url,
+        'kr-language': assets.language,
+    })
+        .then(() => loadScript(assets.stylesheet_script_url))
+        .then(() => {
+            performance.measure('micuentaweb-assets', 'micuentaweb-assets-start');
+        })
+        .catch((error) => {
+            // Allow a new attempt on next method selection.
+            assetsPromise = null;
+            throw error;
+        });
+
+    return assetsPromise;
+}
+
+// Checkout steps on which the form token can be created in background.
+const PREWARM_PATHS = ['/shop/checkout', '/shop/address', '/shop/confirm_order', '/shop/extra_info'];
+
+$(document).ready(function () {
+    if (!PREWARM_PATHS.includes(window.location.pathname) || sessionStorage.getItem('micuentawebPrewarm') === '0') {
+        return;
+    }
+
+    fetch('/payment/micuentaweb/prewarmFormToken', {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+        },
+        body: '{}',
+    })
+        .then((response) => response.json())
+        .then((data) => {
+            // Do not call again during this browser session if pre-warming is disabled.
+            if (data.enabled === false) {
+                sessionStorage.setItem('micuentawebPrewarm', '0');
+            }
+        })
+        .catch(() => {});
+});
+
 paymentForm.include({
     init() {
         this._super(...arguments);
 
         // Update form token on amount update.
-        $(document).ready(function () {
-            if (typeof KR === 'undefined') {
+        $(document).ready(() => {
+            const container = document.querySelector('[name="o_micuentaweb_element_container"]');
+            if (!container) {
                 return;
             }
 
+            // Start loading the assets as soon as the shopper is about to select the payment method.
+            document.querySelectorAll("[data-payment-method-code='micuentaweb']").forEach((radio) => {
+                const option = radio.closest('[name="o_payment_option"]') || radio.parentElement;
+                const preload = () => loadMicuentawebAssets(JSON.parse(container.dataset.micuentawebAssets)).catch(() => {});
+
+                ['pointerenter', 'touchstart', 'focusin'].forEach((eventName) => {
+                    option.addEventListener(eventName, preload, { once: true, passive: true });
+                });
+            });
+
             const amount_total_summary = document.querySelector('#amount_total_summary');
             if (!amount_total_summary) {
                 // En algunas páginas este elemento no existe, evitamos error.
@@ -46,18 +130,21 @@ paymentForm.include({
         });
     },
 
-    _micuentawebGetInlineValues() {
+    _micuentawebGetInlineContainer() {
         const radio = document.querySelector('input[name="o_payment_radio"]:checked');
         const inlineForm = this._getInlineForm(radio);
-        const micuentawebInlineForm = inlineForm.querySelector('[name="o_micuentaweb_element_container"]');
 
+        return inlineForm.querySelector('[name="o_micuentaweb_element_container"]');
+    },
+
+    _micuentawebGetInlineValues() {
         return JSON.parse(
-            micuentawebInlineForm.dataset.micuentawebInlineFormValues
+            this._micuentawebGetInlineContainer().dataset.micuentawebInlineFormValues
         );
     },
 
     async _prepareInlineForm(providerId, providerCode, paymentOptionId, paymentMethodCode, flow) {
-        if (typeof KR === 'undefined' || paymentMethodCode !== 'micuentaweb') {
+        if (paymentMethodCode !== 'micuentaweb') {
             // Devolvemos el comportamiento estándar de Odoo para otros métodos.
             return this._super(...arguments);
         }
@@ -67,24 +154,32 @@ paymentForm.include({
             return;
         }
 
+        try {
+            await loadMicuentawebAssets(JSON.parse(this._micuentawebGetInlineContainer().dataset.micuentawebAssets));
+        } catch (error) {
+            console.error('Unable to load embedded payment fields. Fallback to redirect flow.', error);
+            this._setPaymentFlow('redirect');
+
+            return;
+        }
+
         // Set the flow to direct to avoid redirection to payment page on Odoo payment button click.
         this._setPaymentFlow('direct');
         this._disableButton(false);
 
+        // Delivery carrier update changes the amount without changing the inline values, always ask the server.
         const deliveryCarrier = document.querySelector('#delivery_carrier');
         if (deliveryCarrier !== null) {
             localStorage.removeItem('micuentawebFormToken');
-            localStorage.removeItem('micuentawebFormTokenData');
         }
 
-        // If there is already a stored token, check if payment data has changed.
-        let formToken = localStorage.getItem('micuentawebFormToken');
-        const tokenData = localStorage.getItem('micuentawebFormTokenData');
+        // If there is already a valid stored token, check if payment data has changed.
+        const cachedToken = this._micuentawebGetCachedToken(inlineValues);
 
-        if (formToken !== null && tokenData === JSON.stringify(inlineValues)) {
+        if (cachedToken !== null) {
             console.log('Payment details did not change on method display. Use the existing token.');
 
-            this._micuentawebDisplayEmbeddedForm(formToken, inlineValues);
+            this._micuentawebDisplayEmbeddedForm(cachedToken.formToken, inlineValues);
         } else {
             await fetch('/payment/micuentaweb/createFormToken', {
                 method: 'POST',
@@ -101,17 +196,47 @@ paymentForm.include({
                         this._enableButton();
 
                         return;
-                    } else {
-                        formToken = data.formToken;
-                        localStorage.setItem('micuentawebFormToken', formToken);
-                        localStorage.setItem('micuentawebFormTokenData', JSON.stringify(inlineValues));
                     }
 
-                    this._micuentawebDisplayEmbeddedForm(formToken, inlineValues);
+                    this._micuentawebStoreToken(data, inlineValues);
+                    this._micuentawebDisplayEmbeddedForm(data.formToken, inlineValues);
                 });
         }
     },
 
+    /**
+     * Return the stored form token if it was created for the same inline values and is not expired, null otherwise.
+     */
+    _micuentawebGetCachedToken(inlineValues) {
+        let cachedToken = null;
+        try {
+            cachedToken = JSON.parse(localStorage.getItem('micuentawebFormToken'));
+        } catch {
+            // Token stored by a previous version of the module.
+        }
+
+        if (
+            !cachedToken ||
+            !cachedToken.formToken ||
+            cachedToken.expiresAt <= Date.now() ||
+            cachedToken.data !== JSON.stringify(inlineValues)
+        ) {
+            localStorage.removeItem('micuentawebFormToken');
+            return null;
+        }
+
+        return cachedToken;
+    },
+
+    _micuentawebStoreToken(data, inlineValues) {
+        localStorage.setItem('micuentawebFormToken', JSON.stringify({
+            formToken: data.formToken,
+            version: data.version,
+            expiresAt: data.expiresAt,
+            data: JSON.stringify(inlineValues),
+        }));
+    },
+
     _micuentawebDisplayEmbeddedForm(formToken, inlineValues) {
         const wrapper = document.getElementById('micuentaweb-embedded-wrapper');
         if (!wrapper) {
@@ -166,90 +291,88 @@ paymentForm.include({
             return;
         }
 
-        let formToken = localStorage.getItem('micuentawebFormToken');
         const inlineValues = this._micuentawebGetInlineValues();
-        const storedTokenData = localStorage.getItem('micuentawebFormTokenData');
-
-        if (storedTokenData === JSON.stringify(inlineValues)) {
-            console.log('Payment details did not change on payment submit. Use the existing token.');
-        } else {
-            await fetch('/payment/micuentaweb/createFormToken', {
-                method: 'POST',
-                headers: {
-                    'Content-Type': 'application/json',
-                },
-                body: JSON.stringify(processingValues),
-            })
-                .then((response) => response.json())
-                .then(async (data) => {
-                    if (!data.formToken) {
-                        console.log('Error while creating form token. Fallback to redirect flow.');
-                        this._setPaymentFlow('redirect');
-                        this._enableButton();
+        const cachedToken = this._micuentawebGetCachedToken(inlineValues);
+        let formToken = cachedToken ? cachedToken.formToken : null;
+
+        // Send the version of the displayed token, the server only creates a new one if the order has changed.
+        const requestValues = cachedToken ? { ...processingValues, token_version: cachedToken.version } : processingValues;
+
+        await fetch('/payment/micuentaweb/createFormToken', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json',
+            },
+            body: JSON.stringify(requestValues),
+        })
+            .then((response) => response.json())
+            .then(async (data) => {
+                if (!data.formToken) {
+                    console.log('Error while creating form token. Fallback to redirect flow.');
+                    this._setPaymentFlow('redirect');
+                    this._enableButton();
 
-                        // Fallback 1: redirigir directamente si tenemos URL.
-                        if (processingValues && processingValues.redirect_url) {
-                            console.log('Redirecting to:', processingValues.redirect_url);
-                            window.location.href = processingValues.redirect_url;
-                            return;
-                        }
+                    // Fallback 1: redirigir directamente si tenemos URL.
+                    if (processingValues && processingValues.redirect_url) {
+                        console.log('Redirecting to:', processingValues.redirect_url);
+                        window.location.href = processingValues.redirect_url;
+                        return;
+                    }
 
-                        // Fallback 2: usar el flujo redirect de Odoo sólo si existe el formulario.
-                        // Esperamos un momento para asegurar que el DOM esté listo.
-                        await new Promise(resolve => setTimeout(resolve, 100));
+                    // Fallback 2: usar el flujo redirect de Odoo sólo si existe el formulario.
+                    // Esperamos un momento para asegurar que el DOM esté listo.
+                    await new Promise(resolve => setTimeout(resolve, 100));
+                    
+                    const redirectForm = document.querySelector('#o_payment_redirect_form');
+                    if (redirectForm) {
+                        console.log('Redirect form found, processing redirect flow...');
                         
-                        const redirectForm = document.querySelector('#o_payment_redirect_form');
-                        if (redirectForm) {
-                            console.log('Redirect form found, processing redirect flow...');
-                            
-                            // Verificar que el formulario tenga los elementos necesarios
-                            try {
-                                return this._processRedirectFlow(
-                                    providerCode,
-                                    paymentOptionId,
-                                    paymentMethodCode,
-                                    processingValues
-                                );
-                            } catch (error) {
-                                console.error('Error in _processRedirectFlow:', error);
-                                this._displayErrorDialog(
-                                    'Payment Error',
-                                    'Unable to process payment redirect. Please try again or contact support.'
-                                );
-                                this._enableButton();
-                                return;
-                            }
-                        } else {
-                            console.error(
-                                'Redirect form not found (#o_payment_redirect_form). Cannot process redirect flow.'
+                        // Verificar que el formulario tenga los elementos necesarios
+                        try {
+                            return this._processRedirectFlow(
+                                providerCode,
+                                paymentOptionId,
+                                paymentMethodCode,
+                                processingValues
                             );
-                            
-                            // Mostrar mensaje de error al usuario
+                        } catch (error) {
+                            console.error('Error in _processRedirectFlow:', error);
                             this._displayErrorDialog(
                                 'Payment Error',
-                                'Unable to initialize payment form. Please refresh the page and try again.'
+                                'Unable to process payment redirect. Please try again or contact support.'
                             );
                             this._enableButton();
                             return;
                         }
-                    } else if (data.formToken === 'NO_UPDATE') {
-                        console.log('Payment details did not change on payment submit. Use the existing token.');
                     } else {
-                        formToken = data.formToken;
-                        localStorage.setItem('micuentawebFormToken', formToken);
-                        localStorage.setItem('micuentawebFormTokenData', JSON.stringify(inlineValues));
+                        console.error(
+                            'Redirect form not found (#o_payment_redirect_form). Cannot process redirect flow.'
+                        );
+                        
+                        // Mostrar mensaje de error al usuario
+                        this._displayErrorDialog(
+                            'Payment Error',
+                            'Unable to initialize payment form. Please refresh the page and try again.'
+                        );
+                        this._enableButton();
+                        return;
                     }
-                })
-                .catch((error) => {
-                    console.error('Error creating form token:', error);
-                    this._displayErrorDialog(
-                        'Payment Error',
-                        'Unable to connect to payment service. Please check your connection and try again.'
-                    );
-                    this._enableButton();
-                    return;
-                });
-        }
+                } else if (data.formToken === 'NO_UPDATE') {
+                    console.log('Payment details did not change on payment submit. Use the existing token.');
+                } else {
+                    formToken = data.formToken;
+                    this._micuentawebStoreToken(data, inlineValues);
+                }
+            })
+            .catch((error) => {
+                console.error('Error creating form token:', error);
+                this._displayErrorDialog(
+                    'Payment Error',
+                    'Unable to connect to payment service. Please check your connection and try again.'
+                );
+                this._enableButton();
+                return;
+            });
 
         // Solo continuar si tenemos un token válido
         if (!formToken) {
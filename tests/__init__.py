@@ -0,0 +1,6 @@
+from . import test_load
+from . import test_operations
+from . import test_recurring
+from . import test_form_render
+from . import test_query_counts
+from . import test_notification
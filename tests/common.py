@@ -0,0 +1,168 @@
+# coding: utf-8
+#
+# Copyright © Lyra Network.
+# This file is part of Izipay plugin for Odoo. See COPYING.md for license details.
+#
+# Author:    Lyra Network (https://www.lyra.com)
+# Copyright: Copyright © Lyra Network
+# License:   http://www.gnu.org/licenses/agpl.html GNU Affero General Public License (AGPL v3)
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import re
+import threading
+from unittest.mock import patch
+
+from odoo.addons.payment import utils as payment_utils
+from odoo.addons.payment.tests.common import PaymentCommon
+
+from ..helpers import constants, tools
+
+# Answer of the stub gateway simulating a failure: HTTP 500 with a body which is not JSON.
+GATEWAY_FAILURE = object()
+
+class StubGateway:
+    """ REST API of the gateway served on localhost: test requests are allowed there, external ones are blocked.
+
+    Each endpoint answers with the responses queued by respond(), the last one is repeated. A response is the decoded
+    JSON answer, a callable building it from the request payload, or GATEWAY_FAILURE. Received requests are recorded.
+    """
+
+    PATH = '/api-payment/'
+
+    def __init__(self):
+        self.requests = []
+        self._responses = {}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s%s' % (self._server.server_address[1], self.PATH)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def reset(self):
+        with self._lock:
+            self.requests = []
+            self._responses = {}
+
+    def respond(self, endpoint, *responses):
+        with self._lock:
+            self._responses[endpoint] = list(responses)
+
+    def requests_to(self, endpoint):
+        with self._lock:
+            return [payload for path, payload in self.requests if path == endpoint]
+
+    def _answer(self, endpoint, payload):
+        with self._lock:
+            self.requests.append((endpoint, payload))
+            responses = self._responses.get(endpoint)
+            if not responses:
+                return None
+
+            response = responses.pop(0) if len(responses) > 1 else responses[0]
+
+        return response(payload) if callable(response) else response
+
+    def _make_handler(self):
+        gateway = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                endpoint = self.path[len(gateway.PATH):] if self.path.startswith(gateway.PATH) else self.path
+                body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+                response = gateway._answer(endpoint, json.loads(body or b'{}'))
+
+                if response is None or response is GATEWAY_FAILURE:
+                    self._send(404 if response is None else 500, b'Stub gateway error.', 'text/plain')
+                else:
+                    self._send(200, json.dumps(response).encode('utf-8'), 'application/json')
+
+            def _send(self, code, body, content_type):
+                self.send_response(code)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+class MicuentawebCommon(PaymentCommon):
+    """ Izipay provider in test mode with REST API keys, its REST API served by a StubGateway. """
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+
+        cls.micuentaweb = cls._prepare_provider('micuentaweb', update_values={
+            'micuentaweb_site_id': '12345678',
+            'micuentaweb_test_password': 'testpassword_stub',
+            'micuentaweb_key_test': '1111111111111111',
+            'micuentaweb_sign_algo': 'SHA-256',
+        })
+        cls.provider = cls.micuentaweb
+        # EUR, the default currency of the payment tests, is not supported by the gateway.
+        cls.currency = cls.currency_usd
+
+        cls.gateway = StubGateway()
+        cls.gateway.start()
+        cls.addClassCleanup(cls.gateway.stop)
+        cls.startClassPatcher(patch.dict(constants.MICUENTAWEB_PARAMS, {'REST_URL': cls.gateway.url}))
+
+    def setUp(self):
+        super().setUp()
+        self.gateway.reset()
+
+    @staticmethod
+    def _gateway_success(**answer):
+        return {'status': 'SUCCESS', 'answer': answer}
+
+    @staticmethod
+    def _gateway_error(code, message='Rejected by the stub gateway.'):
+        return {'status': 'ERROR', 'answer': {'errorCode': code, 'errorMessage': message}}
+
+    def _create_gateway_transaction(self, state, status, reference=None, **values):
+        """ Transaction already notified by the gateway, in the given Odoo state and gateway status. """
+        reference = reference or self.reference
+        return self._create_transaction('redirect', reference=reference, state=state, provider_reference='uuid-' + reference,
+            micuentaweb_trans_status=status, **values)
+
+    def _form_notification(self, tx, status='AUTHORISED'):
+        post = {
+            'vads_site_id': self.provider.micuentaweb_site_id,
+            'vads_ctx_mode': 'TEST',
+            'vads_trans_status': status,
+            'vads_trans_uuid': 'uuid-' + tx.reference,
+            'vads_order_id': re.sub('[^0-9a-zA-Z_-]+', '', tx.reference),
+            'vads_ext_info_order_ref': tx.reference,
+            'vads_result': '00',
+            'vads_amount': str(payment_utils.to_minor_currency_units(tx.amount, tx.currency_id)),
+            'vads_currency': tools.find_currency(tx.currency_id.name),
+            'vads_payment_config': 'SINGLE',
+            'vads_card_brand': 'VISA',
+            'vads_card_number': '497010XXXXXX0003',
+            'vads_expiry_month': '12',
+            'vads_expiry_year': '2030',
+            'vads_threeds_status': 'N',
+            'vads_url_check_src': 'PAY',
+        }
+        post['signature'] = tools.compute_signature(post, self.provider.micuentaweb_key_test, self.provider.micuentaweb_sign_algo)
+        return post
+
+    def _stats_total(self, column):
+        rows = self.env['micuentaweb.stats.daily'].search([('provider_id', '=', self.provider.id)])
+        return sum(rows.mapped(column))
@@ -0,0 +1,127 @@
+# coding: utf-8
+#
+# Copyright © Lyra Network.
+# This file is part of Izipay plugin for Odoo. See COPYING.md for license details.
+#
+# Author:    Lyra Network (https://www.lyra.com)
+# Copyright: Copyright © Lyra Network
+# License:   http://www.gnu.org/licenses/agpl.html GNU Affero General Public License (AGPL v3)
+
+from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
+import threading
+from unittest.mock import Mock, patch
+
+from odoo import api, SUPERUSER_ID
+from odoo.modules.registry import Registry
+from odoo.tests import tagged
+from odoo.tests.common import BaseCase, get_db_name
+
+from ..helpers import form_renderer, tools
+
+_REDIRECT_FIELDS = ['vads_redirect_success_timeout', 'vads_redirect_success_message', 'vads_redirect_error_timeout', 'vads_redirect_error_message']
+
+# Providers of the test: each one signs its own redirection settings, or none when redirection is disabled.
+_PROVIDER_SETTINGS = [
+    {'micuentaweb_site_id': '11111111', 'micuentaweb_key_test': 'KEY-A', 'micuentaweb_sign_algo': 'SHA-256', 'micuentaweb_redirect_enabled': '1',
+        'micuentaweb_redirect_success_timeout': '3', 'micuentaweb_redirect_success_message': 'Success A',
+        'micuentaweb_redirect_error_timeout': '4', 'micuentaweb_redirect_error_message': 'Error A'},
+    {'micuentaweb_site_id': '22222222', 'micuentaweb_key_test': 'KEY-B', 'micuentaweb_sign_algo': 'SHA-1', 'micuentaweb_redirect_enabled': '0',
+        'micuentaweb_redirect_success_timeout': '8', 'micuentaweb_redirect_success_message': 'Success B',
+        'micuentaweb_redirect_error_timeout': '9', 'micuentaweb_redirect_error_message': 'Error B'},
+    {'micuentaweb_site_id': '33333333', 'micuentaweb_key_test': 'KEY-C', 'micuentaweb_sign_algo': 'SHA-256', 'micuentaweb_redirect_enabled': '1',
+        'micuentaweb_redirect_success_timeout': '6', 'micuentaweb_redirect_success_message': 'Success C',
+        'micuentaweb_redirect_error_timeout': '7', 'micuentaweb_redirect_error_message': 'Error C'},
+]
+
+class _FormParser(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.fields = {}
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'input':
+            attrs = dict(attrs)
+            self.fields[attrs['name']] = attrs['value']
+
+def _parse_form(html):
+    parser = _FormParser()
+    parser.feed(str(html))
+    return parser.fields
+
+@tagged('post_install', '-at_install')
+class TestFormRender(BaseCase):
+    """ Redirect forms generated in parallel by the threads of a worker, for differently configured providers.
+
+    Each thread has its own cursor, as a request. The providers are committed for the threads to see them, and deleted
+    once the test is done.
+    """
+
+    RENDER_COUNT = 3000
+    THREAD_COUNT = 8
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.registry = Registry(get_db_name())
+
+        with cls.registry.cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            base_provider = env.ref('payment_micuentaweb.payment_provider_micuentaweb')
+            cls.provider_ids = [
+                base_provider.copy(dict(settings, name='Izipay concurrency %s' % index, state='test')).id
+                for index, settings in enumerate(_PROVIDER_SETTINGS)
+            ]
+
+    @classmethod
+    def tearDownClass(cls):
+        with cls.registry.cursor() as cr:
+            api.Environment(cr, SUPERUSER_ID, {})['payment.provider'].browse(cls.provider_ids).unlink()
+
+        super().tearDownClass()
+
+    def _render_batch(self, thread_index, barrier):
+        forms = []
+        with self.registry.cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            providers = env['payment.provider'].browse(self.provider_ids)
+            currency = env.ref('base.USD')
+
+            barrier.wait()
+            for index in range(thread_index, self.RENDER_COUNT, self.THREAD_COUNT):
+                provider = providers[index % len(providers)]
+                values = provider.micuentaweb_form_generate_values({'reference': 'CONC-%s' % index, 'amount': 10.0 + index, 'currency': currency})
+                values = {key: value.decode('utf-8') for key, value in values.items()}
+
+                html = form_renderer.render(provider.micuentaweb_get_form_action_url(), values, provider._micuentaweb_generate_sign(provider, values))
+                forms.append((index, html))
+
+            cr.rollback()
+
+        return forms
+
+    def test_parallel_renders(self):
+        barrier = threading.Barrier(self.THREAD_COUNT)
+        with patch('odoo.addons.payment_micuentaweb.models.payment_provider.request', Mock(httprequest=Mock(host_url='http://localhost:8069/'))), \
+                ThreadPoolExecutor(max_workers=self.THREAD_COUNT) as executor:
+            batches = list(executor.map(lambda thread_index: self._render_batch(thread_index, barrier), range(self.THREAD_COUNT)))
+
+        forms = [form for batch in batches for form in batch]
+        self.assertEqual(len(forms), self.RENDER_COUNT)
+
+        for index, html in forms:
+            settings = _PROVIDER_SETTINGS[index % len(_PROVIDER_SETTINGS)]
+            fields = _parse_form(html)
+
+            self.assertEqual(fields['vads_site_id'], settings['micuentaweb_site_id'])
+            self.assertEqual(fields['vads_ext_info_order_ref'], 'CONC-%s' % index)
+
+            # Redirection fields of its own provider only.
+            if settings['micuentaweb_redirect_enabled'] == '1':
+                self.assertEqual([fields.get(name) for name in _REDIRECT_FIELDS], [settings['micuentaweb_' + name[len('vads_'):]] for name in _REDIRECT_FIELDS])
+            else:
+                self.assertFalse(set(_REDIRECT_FIELDS) & set(fields))
+
+            # Signed with the key of its own provider.
+            signature = fields.pop('signature')
+            self.assertEqual(signature, tools.compute_signature(fields, settings['micuentaweb_key_test'], settings['micuentaweb_sign_algo']))
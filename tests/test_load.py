@@ -0,0 +1,65 @@
+# coding: utf-8
+#
+# Copyright © Lyra Network.
+# This file is part of Izipay plugin for Odoo. See COPYING.md for license details.
+#
+# Author:    Lyra Network (https://www.lyra.com)
+# Copyright: Copyright © Lyra Network
+# License:   http://www.gnu.org/licenses/agpl.html GNU Affero General Public License (AGPL v3)
+
+import logging
+import subprocess
+import sys
+import time
+
+from odoo.tests import TransactionCase, tagged
+from odoo.tools import config
+
+from ..helpers import constants
+
+_logger = logging.getLogger(__name__)
+
+# Import the addon in a fresh interpreter, after the payment module it depends on, and print the time it took.
+_IMPORT_SCRIPT = """
+import sys, time
+import odoo
+from odoo.tools import config
+config.parse_config(['--addons-path', sys.argv[1]])
+odoo.modules.module.initialize_sys_path()
+import odoo.addons.payment
+start = time.perf_counter()
+import odoo.addons.payment_micuentaweb
+print(time.perf_counter() - start)
+"""
+
+@tagged('post_install', '-at_install')
+class TestLoad(TransactionCase):
+    """ Cold start cost of the addon: import time and seeding of the cards and languages on registry load. """
+
+    # Seconds, generous enough for a loaded CI runner.
+    IMPORT_TIME_BUDGET = 1.0
+
+    def test_import_time(self):
+        output = subprocess.check_output([sys.executable, '-c', _IMPORT_SCRIPT, config['addons_path']], timeout=120)
+        elapsed = float(output.decode().strip().splitlines()[-1])
+
+        _logger.info('Izipay: addon imported in %.1f ms.', elapsed * 1000)
+        self.assertLess(elapsed, self.IMPORT_TIME_BUDGET)
+
+    def test_seed_cards_and_languages(self):
+        for model, expected in (('micuentaweb.card', constants.MICUENTAWEB_CARDS), ('micuentaweb.language', constants.MICUENTAWEB_LANGUAGES)):
+            Model = self.env[model]
+            Model.search([]).unlink()
+
+            start = time.perf_counter()
+            Model.init()
+            elapsed = time.perf_counter() - start
+            _logger.info('Izipay: %s %s records seeded in %.1f ms.', len(expected), model, elapsed * 1000)
+
+            self.assertEqual(set(Model.search([]).mapped('code')), set(expected))
+
+            # Already in sync: only the read of the existing codes.
+            with self.assertQueryCount(1):
+                Model.init()
+
+            self.assertEqual(Model.search_count([]), len(expected))
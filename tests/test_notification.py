@@ -0,0 +1,52 @@
+# coding: utf-8
+#
+# Copyright © Lyra Network.
+# This file is part of Izipay plugin for Odoo. See COPYING.md for license details.
+#
+# Author:    Lyra Network (https://www.lyra.com)
+# Copyright: Copyright © Lyra Network
+# License:   http://www.gnu.org/licenses/agpl.html GNU Affero General Public License (AGPL v3)
+
+import json
+
+from odoo.tests import tagged
+
+from ..helpers import log
+from .common import MicuentawebCommon
+
+@tagged('post_install', '-at_install')
+class TestNotification(MicuentawebCommon):
+    """ Stored notifications: redacted, and replayed only when their signature was verified when received. """
+
+    def _receive(self, post):
+        result = self.env['payment.transaction']._micuentaweb_handle_ipn(post)
+        return self.env['micuentaweb.notification']._micuentaweb_store('ipn', post, result)
+
+    def test_verified_notification_replayed(self):
+        tx = self._create_transaction('redirect')
+        notification = self._receive(self._form_notification(tx))
+
+        self.assertTrue(notification.verified)
+        self.assertEqual(json.loads(notification.payload)['vads_card_number'], log.REDACTED)
+
+        tx.state = 'draft'
+        notification.action_micuentaweb_replay()
+
+        self.assertEqual(notification.state, 'processed')
+        self.assertEqual(tx.state, 'done')
+        # Redacted values never replace the known ones.
+        self.assertEqual(tx.micuentaweb_card_last4, '0003')
+
+    def test_forged_notification_never_replayed(self):
+        tx = self._create_transaction('redirect')
+        post = self._form_notification(tx)
+        post['signature'] = 'forged'
+        notification = self._receive(post)
+
+        self.assertFalse(notification.verified)
+        self.assertEqual(notification.state, 'error')
+
+        notification.action_micuentaweb_replay()
+
+        self.assertEqual(notification.state, 'error')
+        self.assertEqual(tx.state, 'draft')
@@ -0,0 +1,116 @@
+# coding: utf-8
+#
+# Copyright © Lyra Network.
+# This file is part of Izipay plugin for Odoo. See COPYING.md for license details.
+#
+# Author:    Lyra Network (https://www.lyra.com)
+# Copyright: Copyright © Lyra Network
+# License:   http://www.gnu.org/licenses/agpl.html GNU Affero General Public License (AGPL v3)
+
+from odoo.tests import tagged
+
+from .common import GATEWAY_FAILURE, MicuentawebCommon
+
+@tagged('post_install', '-at_install')
+class TestOperations(MicuentawebCommon):
+    """ Validate, cancel and refund against the stub gateway: requests sent, state transitions and statistics. """
+
+    def test_validate(self):
+        tx = self._create_gateway_transaction('pending', 'AUTHORISED_TO_VALIDATE')
+        self.gateway.respond('V4/Transaction/Validate', self._gateway_success(uuid=tx.provider_reference, detailedStatus='AUTHORISED'))
+
+        results = tx._micuentaweb_run_operation('validate')
+
+        self.assertTrue(results[tx.id][0])
+        self.assertEqual(self.gateway.requests_to('V4/Transaction/Validate'), [{'uuid': tx.provider_reference}])
+        self.assertEqual(tx.state, 'done')
+        self.assertEqual(tx.micuentaweb_trans_status, 'AUTHORISED')
+        self.assertEqual(self._stats_total('count_approved'), 1)
+
+    def test_cancel(self):
+        tx = self._create_gateway_transaction('pending', 'AUTHORISED_TO_VALIDATE')
+        self.gateway.respond('V4/Transaction/CancelOrRefund', self._gateway_success(uuid=tx.provider_reference, detailedStatus='CANCELLED'))
+
+        results = tx._micuentaweb_run_operation('cancel')
+
+        self.assertTrue(results[tx.id][0])
+        payload, = self.gateway.requests_to('V4/Transaction/CancelOrRefund')
+        self.assertEqual(payload['resolutionMode'], 'CANCELLATION_ONLY')
+        self.assertEqual(payload['amount'], 111111)
+        self.assertEqual(payload['currency'], self.currency.name)
+        self.assertEqual(tx.state, 'cancel')
+        self.assertEqual(tx.micuentaweb_trans_status, 'CANCELLED')
+        self.assertEqual(self._stats_total('count_cancelled'), 1)
+
+    def test_refund(self):
+        tx = self._create_gateway_transaction('done', 'CAPTURED')
+        self.gateway.respond('V4/Transaction/CancelOrRefund', self._gateway_success(uuid='uuid-refund', detailedStatus='AUTHORISED'))
+
+        refund_tx = tx._send_refund_request(amount_to_refund=100.0)
+
+        payload, = self.gateway.requests_to('V4/Transaction/CancelOrRefund')
+        self.assertEqual(payload['resolutionMode'], 'REFUND_ONLY')
+        self.assertEqual(payload['amount'], 10000)
+        self.assertEqual(refund_tx.amount, -100.0)
+        self.assertEqual(refund_tx.provider_reference, 'uuid-refund')
+        self.assertEqual(refund_tx.state, 'done')
+        self.assertEqual(tx.state, 'done')
+        # Refunds are not payments.
+        self.assertEqual(self._stats_total('count_total'), 0)
+
+    def test_rejected_operation_keeps_state(self):
+        tx = self._create_gateway_transaction('pending', 'AUTHORISED_TO_VALIDATE')
+        self.gateway.respond('V4/Transaction/CancelOrRefund', self._gateway_error('PSP_100'))
+
+        success, message = tx._micuentaweb_run_operation('cancel')[tx.id]
+
+        self.assertFalse(success)
+        self.assertIn('PSP_100', message)
+        self.assertEqual(tx.state, 'pending')
+        self.assertEqual(tx.micuentaweb_trans_status, 'AUTHORISED_TO_VALIDATE')
+        self.assertEqual(self._stats_total('count_total'), 0)
+
+    def test_rejected_refund_sets_refund_in_error(self):
+        tx = self._create_gateway_transaction('done', 'CAPTURED')
+        self.gateway.respond('V4/Transaction/CancelOrRefund', self._gateway_error('PSP_100'))
+
+        refund_tx = tx._send_refund_request(amount_to_refund=100.0)
+
+        self.assertEqual(refund_tx.state, 'error')
+        self.assertIn('PSP_100', refund_tx.state_message)
+        self.assertEqual(tx.state, 'done')
+
+    def test_gateway_failure(self):
+        tx = self._create_gateway_transaction('pending', 'AUTHORISED_TO_VALIDATE')
+        self.gateway.respond('V4/Transaction/Validate', GATEWAY_FAILURE)
+
+        success, message = tx._micuentaweb_run_operation('validate')[tx.id]
+
+        self.assertFalse(success)
+        self.assertIn('NETWORK', message)
+        self.assertEqual(tx.state, 'pending')
+
+    def test_operation_not_allowed(self):
+        tx = self._create_gateway_transaction('draft', 'AUTHORISED_TO_VALIDATE')
+
+        success, _message = tx._micuentaweb_run_operation('validate')[tx.id]
+
+        self.assertFalse(success)
+        self.assertFalse(self.gateway.requests)
+        self.assertEqual(tx.state, 'draft')
+
+    def test_batch_results_per_transaction(self):
+        tx_ok = self._create_gateway_transaction('pending', 'AUTHORISED_TO_VALIDATE', reference='OP-OK')
+        tx_ko = self._create_gateway_transaction('pending', 'AUTHORISED_TO_VALIDATE', reference='OP-KO')
+        self.gateway.respond('V4/Transaction/Validate', lambda payload: (
+            self._gateway_success(uuid=payload['uuid'], detailedStatus='AUTHORISED') if payload['uuid'] == tx_ok.provider_reference
+            else self._gateway_error('PSP_100')
+        ))
+
+        results = (tx_ok | tx_ko)._micuentaweb_run_operation('validate')
+
+        self.assertEqual(len(self.gateway.requests), 2)
+        self.assertTrue(results[tx_ok.id][0])
+        self.assertFalse(results[tx_ko.id][0])
+        self.assertEqual(tx_ok.state, 'done')
+        self.assertEqual(tx_ko.state, 'pending')
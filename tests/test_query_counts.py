@@ -0,0 +1,189 @@
+# coding: utf-8
+#
+# Copyright © Lyra Network.
+# This file is part of Izipay plugin for Odoo. See COPYING.md for license details.
+#
+# Author:    Lyra Network (https://www.lyra.com)
+# Copyright: Copyright © Lyra Network
+# License:   http://www.gnu.org/licenses/agpl.html GNU Affero General Public License (AGPL v3)
+
+import hashlib
+import hmac
+import json
+from urllib.parse import urlencode as url_encode
+
+from odoo import Command
+from odoo.addons.payment import utils as payment_utils
+from odoo.addons.payment.tests.http_common import PaymentHttpCommon
+from odoo.tests import tagged
+
+from ..controllers.main import MicuentawebController
+from ..helpers import constants
+from .common import MicuentawebCommon
+
+@tagged('post_install', '-at_install')
+class TestQueryCounts(MicuentawebCommon, PaymentHttpCommon):
+    """ SQL queries run by a warm worker for each payment route, the REST API being served by the stub gateway.
+
+    Route budgets are the ones of MICUENTAWEB_QUERY_BUDGETS, checked at run time by profiling.query_budget, plus the
+    queries of the request dispatch (session, public user, website detection when installed).
+    """
+
+    DISPATCH_QUERIES = 15
+    # Queries added to the checkout page by the embedded payment fields template.
+    EMBEDDED_FORM_QUERIES = 10
+
+    def _require_module(self, name):
+        if not self.env['ir.module.module'].search_count([('name', '=', name), ('state', '=', 'installed')]):
+            self.skipTest('Module %s is not installed.' % name)
+
+    def _route_budget(self, name):
+        return constants.MICUENTAWEB_QUERY_BUDGETS[name] + self.DISPATCH_QUERIES
+
+    def _rest_notification(self, tx, status='AUTHORISED'):
+        answer = json.dumps({
+            'shopId': self.provider.micuentaweb_site_id,
+            'orderCycle': 'CLOSED',
+            'orderStatus': 'PAID',
+            'orderDetails': {'orderId': tx.reference},
+            'transactions': [{
+                'uuid': 'uuid-' + tx.reference,
+                'detailedStatus': status,
+                'amount': payment_utils.to_minor_currency_units(tx.amount, tx.currency_id),
+                'currency': tx.currency_id.name,
+                'metadata': {'order_ref': tx.reference},
+            }],
+        })
+        password = self.provider.micuentaweb_test_password
+        return {
+            'kr-answer': answer,
+            'kr-answer-type': 'V4/Payment',
+            'kr-hash-algorithm': 'sha256_hmac',
+            'kr-hash': hmac.new(password.encode('utf-8'), answer.encode('utf-8'), hashlib.sha256).hexdigest(),
+        }
+
+    def _post_ipn(self, post):
+        return self.url_open(MicuentawebController._notify_url, data=post)
+
+    def _create_sale_order(self):
+        pricelist = self.env['product.pricelist'].create({'name': 'Izipay', 'currency_id': self.currency.id})
+        product = self.env['product.product'].create({'name': 'Izipay product', 'type': 'service', 'list_price': 100.0})
+        return self.env['sale.order'].create({
+            'partner_id': self.partner.id,
+            'pricelist_id': pricelist.id,
+            'order_line': [Command.create({'product_id': product.id, 'product_uom_qty': 1, 'price_unit': 100.0})],
+        })
+
+    def _post_form_token(self, values):
+        self.gateway.respond('V4/Charge/CreatePayment', self._gateway_success(formToken='stub-form-token'))
+        response = self.url_open('/payment/micuentaweb/createFormToken', data=json.dumps(values),
+            headers={'Content-Type': 'application/json'})
+        return response.json()
+
+    def test_ipn_form(self):
+        self._post_ipn(self._form_notification(self._create_transaction('redirect', reference='IPN-WARM')))
+        tx = self._create_transaction('redirect', reference='IPN-FORM')
+
+        with self.assertQueryCount(self._route_budget('ipn')):
+            response = self._post_ipn(self._form_notification(tx))
+
+        self.assertEqual(response.text, 'Payment processed, order has been updated.')
+        self.env.invalidate_all()
+        self.assertEqual(tx.state, 'done')
+
+    def test_ipn_rest(self):
+        self._post_ipn(self._rest_notification(self._create_transaction('redirect', reference='IPN-WARM')))
+        tx = self._create_transaction('redirect', reference='IPN-REST')
+
+        with self.assertQueryCount(self._route_budget('ipn')):
+            response = self._post_ipn(self._rest_notification(tx))
+
+        self.assertEqual(response.text, 'Payment processed, order has been updated.')
+        self.env.invalidate_all()
+        self.assertEqual(tx.state, 'done')
+
+    def test_return(self):
+        def post_return(tx):
+            return self.url_open(MicuentawebController._return_url, data=self._form_notification(tx), allow_redirects=False)
+
+        post_return(self._create_transaction('redirect', reference='RETURN-WARM'))
+        tx = self._create_transaction('redirect', reference='RETURN')
+
+        with self.assertQueryCount(self._route_budget('return')):
+            response = post_return(tx)
+
+        self.assertIn('/payment/status', response.headers.get('Location', ''))
+        self.env.invalidate_all()
+        self.assertEqual(tx.state, 'done')
+
+    def test_form_token_on_method_display(self):
+        self._require_module('sale')
+        sale_order = self._create_sale_order()
+        values = {
+            'provider_id': self.provider.id,
+            'order_id': sale_order.id,
+            'currency_id': self.currency.id,
+            'partner_id': self.partner.id,
+        }
+        self._post_form_token(values)
+        self.gateway.reset()
+
+        # New session: the cached token of the warm-up request is not reused.
+        self.opener.cookies.clear()
+        with self.assertQueryCount(self._route_budget('form_token')):
+            result = self._post_form_token(values)
+
+        self.assertEqual(result['formToken'], 'stub-form-token')
+        self.assertEqual(len(self.gateway.requests_to('V4/Charge/CreatePayment')), 1)
+
+    def test_form_token_on_submit(self):
+        self._require_module('website_sale')
+
+        def prepare_submit(reference):
+            sale_order = self._create_sale_order()
+            tx = self._create_transaction('direct', reference=reference, amount=sale_order.amount_total,
+                sale_order_ids=[Command.set(sale_order.ids)])
+            return {
+                'provider_id': self.provider.id,
+                'reference': tx.reference,
+                'amount': tx.amount,
+                'currency_id': self.currency.id,
+                'partner_id': self.partner.id,
+            }
+
+        self._post_form_token(prepare_submit('SUBMIT-WARM-1'))
+        values = prepare_submit('SUBMIT-1')
+        self.gateway.reset()
+        self.opener.cookies.clear()
+
+        with self.assertQueryCount(self._route_budget('form_token')):
+            result = self._post_form_token(values)
+
+        self.assertEqual(result['formToken'], 'stub-form-token')
+        self.assertEqual(self.gateway.requests_to('V4/Charge/CreatePayment')[0]['orderId'], 'SUBMIT')
+
+    def test_checkout_render_embedded(self):
+        self._require_module('sale')
+        sale_order = self._create_sale_order()
+        url = '/payment/pay?' + url_encode({
+            'sale_order_id': sale_order.id,
+            'amount': sale_order.amount_total,
+            'access_token': payment_utils.generate_access_token(sale_order.partner_invoice_id.id, sale_order.amount_total, sale_order.currency_id.id),
+        })
+
+        # Same page without the embedded payment fields, as reference.
+        self.provider.micuentaweb_payment_data_entry_mode = 'redirect'
+        self.url_open(url)
+        count = self.cr.sql_log_count
+        self.url_open(url)
+        baseline = self.cr.sql_log_count - count
+
+        self.provider.micuentaweb_payment_data_entry_mode = 'embedded'
+        self.url_open(url)
+
+        with self.assertQueryCount(baseline + self.EMBEDDED_FORM_QUERIES):
+            response = self.url_open(url)
+
+        self.assertIn('o_micuentaweb_element_container', response.text)
+        # The form token is created by the client, the page never calls the gateway.
+        self.assertFalse(self.gateway.requests)
@@ -0,0 +1,144 @@
+# coding: utf-8
+#
+# Copyright © Lyra Network.
+# This file is part of Izipay plugin for Odoo. See COPYING.md for license details.
+#
+# Author:    Lyra Network (https://www.lyra.com)
+# Copyright: Copyright © Lyra Network
+# License:   http://www.gnu.org/licenses/agpl.html GNU Affero General Public License (AGPL v3)
+
+from unittest.mock import patch
+
+from dateutil.relativedelta import relativedelta
+
+from odoo import fields
+from odoo.tests import tagged
+
+from ..models.recurring import MicuentawebRecurringCharge
+from .common import GATEWAY_FAILURE, MicuentawebCommon
+
+@tagged('post_install', '-at_install')
+class TestRecurring(MicuentawebCommon):
+    """ Recurring charges against the stub gateway: payments, interrupted requests and retries. """
+
+    def setUp(self):
+        super().setUp()
+        self.charge = self.env['micuentaweb.recurring.charge'].create({
+            'name': 'Subscription',
+            'partner_id': self.partner.id,
+            'token_id': self._create_token().id,
+            'currency_id': self.currency.id,
+            'amount': 10.0,
+        })
+
+    def _gateway_payment(self, reference, status='CAPTURED'):
+        return self._gateway_success(shopId='12345678', orderCycle='CLOSED', orderStatus='PAID', transactions=[{
+            'uuid': 'uuid-' + reference,
+            'detailedStatus': status,
+            'amount': 1000,
+            'currency': self.currency.name,
+            'metadata': {'order_ref': reference},
+        }])
+
+    def _create_payment(self, payload):
+        return self._gateway_payment(payload['metadata']['order_ref'])
+
+    def test_charge_paid(self):
+        next_date, key = self.charge.next_date, self.charge._micuentaweb_idempotency_key()
+        self.gateway.respond('V4/Charge/CreatePayment', self._create_payment)
+
+        self.charge._micuentaweb_charge()
+
+        tx = self.charge.transaction_ids
+        self.assertEqual(tx.state, 'done')
+        payload, = self.gateway.requests_to('V4/Charge/CreatePayment')
+        self.assertEqual(payload['orderId'], tx._micuentaweb_get_gateway_order_id())
+        self.assertEqual(payload['metadata'], {'order_ref': tx.reference, 'idempotency_key': key})
+        self.assertGreater(self.charge.next_date, next_date)
+        self.assertEqual(self.charge.attempt_count, 0)
+
+    def test_refused_charge_retried_with_backoff(self):
+        self.gateway.respond('V4/Charge/CreatePayment', self._gateway_error('PSP_100'))
+
+        self.charge._micuentaweb_charge()
+
+        self.assertEqual(self.charge.transaction_ids.state, 'error')
+        self.assertEqual(self.charge.attempt_count, 1)
+        self.assertTrue(self.charge.next_retry)
+
+    def test_request_lost_then_unknown_order_is_failed_attempt(self):
+        # The payment request does not reach the gateway: the transaction is left in draft, waiting for its status.
+        self.gateway.respond('V4/Charge/CreatePayment', GATEWAY_FAILURE)
+        self.charge._micuentaweb_charge()
+
+        tx = self.charge.transaction_ids
+        self.assertEqual(tx.state, 'draft')
+        self.assertEqual(self.charge.attempt_count, 0)
+
+        # The gateway does not know the order: failed attempt, no new request before the backoff delay.
+        self.gateway.reset()
+        self.gateway.respond('V4/Order/Get', self._gateway_error('PSP_010'))
+        self.charge._micuentaweb_charge()
+
+        self.assertEqual(tx.state, 'cancel')
+        self.assertEqual(self.charge.attempt_count, 1)
+        self.assertTrue(self.charge.next_retry)
+        self.assertFalse(self.gateway.requests_to('V4/Charge/CreatePayment'))
+
+        # Next attempt of the same period.
+        self.gateway.respond('V4/Charge/CreatePayment', self._create_payment)
+        self.charge._micuentaweb_charge()
+
+        new_tx = self.charge.transaction_ids - tx
+        self.assertEqual(new_tx.state, 'done')
+        self.assertEqual(new_tx.micuentaweb_idempotency_key, tx.micuentaweb_idempotency_key)
+        self.assertEqual(self.charge.attempt_count, 0)
+
+    def test_request_lost_but_paid_on_gateway(self):
+        self.gateway.respond('V4/Charge/CreatePayment', GATEWAY_FAILURE)
+        self.charge._micuentaweb_charge()
+        tx = self.charge.transaction_ids
+
+        self.gateway.reset()
+        self.gateway.respond('V4/Order/Get', self._gateway_payment(tx.reference))
+        self.charge._micuentaweb_charge()
+
+        self.assertEqual(tx.state, 'done')
+        self.assertEqual(len(self.charge.transaction_ids), 1)
+        self.assertFalse(self.gateway.requests_to('V4/Charge/CreatePayment'))
+
+    def test_gateway_unreachable_keeps_waiting(self):
+        self.gateway.respond('V4/Charge/CreatePayment', GATEWAY_FAILURE)
+        self.charge._micuentaweb_charge()
+        tx = self.charge.transaction_ids
+
+        self.gateway.respond('V4/Order/Get', GATEWAY_FAILURE)
+        self.charge._micuentaweb_charge()
+
+        self.assertEqual(tx.state, 'draft')
+        self.assertEqual(self.charge.attempt_count, 0)
+        self.assertEqual(len(self.charge.transaction_ids), 1)
+
+    def test_cron_leases_charges_before_charging(self):
+        leases = []
+
+        def charge(charges):
+            leases.extend(charges.mapped('next_retry'))
+
+        self.env.flush_all()
+        with patch.object(MicuentawebRecurringCharge, '_micuentaweb_charge', autospec=True, side_effect=charge):
+            self.env['micuentaweb.recurring.charge']._micuentaweb_cron_process_recurring_charges()
+
+        self.assertEqual(len(leases), 1)
+        self.assertGreater(leases[0], fields.Datetime.now())
+
+    def test_cron_charges_overdue_charge_once_per_run(self):
+        self.charge.next_date = fields.Date.context_today(self.charge) - relativedelta(months=3)
+        self.env.flush_all()
+        self.gateway.respond('V4/Charge/CreatePayment', self._create_payment)
+
+        processed = self.env['micuentaweb.recurring.charge']._micuentaweb_cron_process_recurring_charges()
+
+        self.assertEqual(processed, 1)
+        self.assertEqual(len(self.gateway.requests_to('V4/Charge/CreatePayment')), 1)
+        self.assertEqual(len(self.charge.transaction_ids), 1)